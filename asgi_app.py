@@ -0,0 +1,477 @@
+"""
+ASGI režim servera (V10.82): webhook i handleri kao korutine u jednoj event petlji.
+
+Ista logika igre kao flask_app (evaluate_command / evaluate_general_message,
+mašina stanja, keš stanja, kontrola naleta), ali bez OS niti po igraču:
+- webhook odmah potvrđuje update, a obrada teče kao zadatak u petlji,
+- poruke se šalju asinhronim Telegram klijentom (AsyncTeleBot), kroz isti limiter,
+- Gemini poziv je korutina (ai_gateway.generate_async),
+- pauze 'kucanja' su asyncio.sleep, pa ne drže nit.
+
+Rad sa stanjem (keš/baza) i dalje je sinhron i ide u nit (asyncio.to_thread).
+Redosled poruka jednog chata čuva brava po chatu; i spojene poruke kontrole
+naleta (V10.90) se vraćaju u petlju, pod istu bravu i u istu isporuku.
+Strimovanje AI odgovora (GEMINI_STREAMING) se u ovom režimu ne koristi.
+
+Pokretanje (jedan proces, bez gunicorn radnika):
+    pip install uvicorn
+    uvicorn asgi_app:app --host 0.0.0.0 --port $PORT
+"""
+import asyncio
+import collections
+import json
+import logging
+import os
+import time
+from urllib.parse import parse_qs
+
+import aiohttp
+import telebot
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+
+import flask_app as game
+
+# Najviše update-a u obradi; preko toga webhook vraća 503 pa Telegram ponavlja isporuku
+ASGI_MAX_PENDING_UPDATES = int(os.environ.get('ASGI_MAX_PENDING_UPDATES', '10000'))
+
+if game.TELEGRAM_API_URL:
+    asyncio_helper.API_URL = game.TELEGRAM_API_URL.rstrip('/') + '/bot{0}/{1}'
+
+async_bot = AsyncTeleBot(game.BOT_TOKEN, validate_token=False)
+
+# V10.84: Bot API preko aiohttp-a - ograničen pool po hostu, keep-alive rok i brojač novih konekcija
+asyncio_helper.REQUEST_TIMEOUT = game.HTTP_READ_TIMEOUT
+telegram_connections = game.ConnectionCounter()
+
+
+async def create_pooled_session():
+    manager = asyncio_helper.session_manager
+    trace = aiohttp.TraceConfig()
+
+    async def on_new_connection(session, context, params):
+        telegram_connections.record(True)
+
+    async def on_reused_connection(session, context, params):
+        telegram_connections.record(False)
+
+    trace.on_connection_create_end.append(on_new_connection)
+    trace.on_connection_reuseconn.append(on_reused_connection)
+    manager.session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit_per_host=game.HTTP_POOL_SIZE, ssl=manager.ssl_context,
+                                       keepalive_timeout=game.HTTP_KEEPALIVE_SECONDS),
+        trace_configs=[trace],
+    )
+    return manager.session
+
+
+if game.HTTP_POOL_MODE == 'shared':
+    asyncio_helper.session_manager.create_session = create_pooled_session
+
+
+# ----------------------------------------------------
+# 1. TELEGRAM POZIVI I ISPORUKA
+# ----------------------------------------------------
+
+async def telegram_call_async(chat_id, fn, /, *args, max_retries=game.TELEGRAM_MAX_RETRIES, **kwargs):
+    """telegram_call za korutine: isti limiter, ali se na termin čeka sa asyncio.sleep."""
+    limiter = game.telegram_limiter
+    for attempt in range(max_retries + 1):
+        wait = limiter.reserve(chat_id)
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                limiter.finish_wait()
+        started = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        except asyncio_helper.ApiTelegramException as e:
+            retry_after = game.get_retry_after(e)
+            if retry_after is None:
+                raise
+            limiter.block(retry_after)
+            if attempt == max_retries:
+                raise
+            limiter.retries += 1
+        finally:
+            game.TELEGRAM_SECONDS.observe(time.perf_counter() - started, fn.__name__)
+
+
+async def send_text_async(chat_id, rendered):
+    """send_text_with_fallback za korutine: na grešku parsiranja ponavlja bez Markdowna."""
+    try:
+        await telegram_call_async(chat_id, async_bot.send_message, chat_id, rendered.text, parse_mode=rendered.parse_mode)
+        return True
+    except Exception as e:
+        if rendered.parse_mode and "Bad Request: can't parse entities" in str(e):
+            logging.error(f"Greška Markdown formatiranja. Pokušavam slanje bez Markdowna: {str(e)}")
+            game.MARKDOWN_RETRIES.inc('send')
+            try:
+                await telegram_call_async(chat_id, async_bot.send_message, chat_id, rendered.source, parse_mode=None)
+                return True
+            except Exception as e2:
+                logging.error(f"Neuspešno slanje ni bez Markdowna: {e2}")
+        else:
+            logging.error(f"Greška pri slanju poruke: {e}")
+        return False
+
+
+class AsyncDelivery:
+    """
+    DeliveryScheduler za event petlju: traka (FIFO) po chatu i jedan zadatak
+    koji je prazni. Pauza 'kucanja' je asyncio.sleep, pa čekanje ništa ne drži.
+    """
+
+    def __init__(self):
+        self._lanes = {}   # chat_id -> deque[OutboundPart]
+        self._tasks = {}   # chat_id -> zadatak koji prazni traku
+        self.sent_count = 0
+        self.failed_count = 0
+
+    def submit(self, chat_id, parts):
+        if not parts:
+            return
+        lane = self._lanes.get(chat_id)
+        if lane is None:
+            self._lanes[chat_id] = collections.deque(parts)
+            self._tasks[chat_id] = asyncio.get_running_loop().create_task(self._drain_lane(chat_id))
+        else:
+            lane.extend(parts)
+
+    def pending_count(self):
+        return sum(len(lane) for lane in self._lanes.values())
+
+    async def _drain_lane(self, chat_id):
+        lane = self._lanes[chat_id]
+        try:
+            while lane:
+                part = lane[0]
+                sent = False
+                try:
+                    if part.delay > 0:
+                        try:
+                            await telegram_call_async(None, async_bot.send_chat_action, chat_id, 'typing', max_retries=0)
+                        except Exception as e:
+                            logging.warning(f"Neuspešna akcija 'typing' za {chat_id}: {e}")
+                        await asyncio.sleep(part.delay)
+                    sent = await send_text_async(chat_id, part.rendered)
+                except Exception as e:
+                    logging.error(f"Greška u isporuci poruke za {chat_id}: {e}")
+                lane.popleft()
+                if sent:
+                    self.sent_count += 1
+                else:
+                    self.failed_count += 1
+        finally:
+            del self._lanes[chat_id]
+            del self._tasks[chat_id]
+
+    async def drain(self, timeout=game.DELIVERY_DRAIN_TIMEOUT):
+        """Čeka da se sve trake isprazne. Vraća True ako je sve poslato."""
+        tasks = list(self._tasks.values())
+        if not tasks:
+            return True
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        return not pending
+
+
+async_delivery = AsyncDelivery()
+
+
+# ----------------------------------------------------
+# 2. HANDLERI
+# ----------------------------------------------------
+
+class ChatLocks:
+    """Brava po chatu: update-i istog chata se obrađuju redom, različiti chatovi paralelno."""
+
+    def __init__(self):
+        self._locks = {}    # chat_id -> [brava, broj korisnika]
+
+    async def run(self, chat_id, coro_fn, *args):
+        entry = self._locks.setdefault(chat_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await coro_fn(*args)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[chat_id]
+
+    def __len__(self):
+        return len(self._locks)
+
+
+chat_locks = ChatLocks()
+
+HANDLER_ERROR_TEXTS = {
+    game.evaluate_command: "Žao mi je, došlo je do greške u sistemu pri komandi. (DB FAILED)",
+    game.evaluate_general_message: "Žao mi je, došlo je do kritične greške u prijemu poruke. Veza je nestabilna. (DB FAILED)",
+}
+
+
+async def respond_with_ai_async(message, player, stage_key, user_text):
+    """AI odgovor kao korutina; AI potez se upisuje u niti. Vraća tekst odgovora."""
+    ai_text, _ = await game.generate_ai_response_async(
+        user_text, player, stage_key, session=game.open_state_session()
+    )
+    await asyncio.to_thread(game.record_ai_turn, str(message.chat.id), ai_text)
+    return ai_text
+
+
+async def handle_message(message, evaluate):
+    """
+    Izvršava ishod iz evaluate_* kao korutina: odluka i upis stanja u niti (pod
+    bravom chata, game.run_handler), AI odgovor u petlji, a poruke kroz asinhronu
+    isporuku.
+    """
+    replies = []
+    try:
+        outcome = await asyncio.to_thread(game.run_handler, evaluate, message)
+        replies.extend(outcome.replies)
+        if outcome.ai_request:
+            stage_key, user_text, elapsed_time = outcome.ai_request
+            ai_text = await respond_with_ai_async(message, outcome.player, stage_key, user_text)
+            # V10.8: Dodajemo upozorenje
+            replies.append((ai_text, True, elapsed_time))
+    except Exception as e:
+        logging.error(f"GREŠKA U BAZI ({evaluate.__name__}): {e}")
+        replies.append((HANDLER_ERROR_TEXTS[evaluate], False, 0))
+
+    for text, add_warning, elapsed_time in replies:
+        async_delivery.submit(message.chat.id, game.build_outbound_parts(text, add_warning, elapsed_time))
+
+
+async def handle_coalesced_messages(stage_key, text, message):
+    """
+    V10.90: process_coalesced_messages za ASGI režim - pod bravom chata (pozivalac
+    je chat_locks.run), pa spojeni odgovor ide kroz async_delivery u redu sa
+    ostalim porukama chata.
+    """
+    try:
+        player = await asyncio.to_thread(game.load_coalesced_player, str(message.chat.id), stage_key)
+        if player is None:
+            return
+        elapsed_time = int(time.time()) - player.start_time
+        ai_text = await respond_with_ai_async(message, player, stage_key, text)
+        async_delivery.submit(message.chat.id, game.build_outbound_parts(ai_text, True, elapsed_time))
+    except Exception as e:
+        logging.error(f"GREŠKA U BAZI (handle_coalesced_messages): {e}")
+
+
+def select_handler(message):
+    """Isti izbor kao dekoratori bot.message_handler u flask_app (samo tekstualne poruke)."""
+    if message.content_type != 'text' or not message.text:
+        return None
+    if telebot.util.extract_command(message.text) in ('start', 'stop', 'pokreni'):
+        return game.evaluate_command
+    if not message.text.startswith('/'):
+        return game.evaluate_general_message
+    return None
+
+
+async def process_update_async(update):
+    started = time.perf_counter()
+    try:
+        message = update.message
+        evaluate = select_handler(message) if message else None
+        if evaluate is not None:
+            await chat_locks.run(message.chat.id, handle_message, message, evaluate)
+    except Exception as e:
+        logging.error(f"Greška u obradi update-a {update.update_id}: {e}")
+    finally:
+        game.UPDATE_SECONDS.observe(time.perf_counter() - started)
+
+
+# ----------------------------------------------------
+# 3. ASGI APLIKACIJA
+# ----------------------------------------------------
+
+class UpdateTasks:
+    """Zadaci obrade update-a u letu - za ograničenje (503) i čekanje pri gašenju."""
+
+    def __init__(self, limit=ASGI_MAX_PENDING_UPDATES):
+        self.limit = limit
+        self._tasks = set()
+        self.accepted_count = 0
+        self.rejected_count = 0
+        self.peak_pending = 0
+
+    def start(self, update):
+        if len(self._tasks) >= self.limit:
+            self.rejected_count += 1
+            return False
+        task = asyncio.get_running_loop().create_task(process_update_async(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        self.accepted_count += 1
+        self.peak_pending = max(self.peak_pending, len(self._tasks))
+        return True
+
+    def add(self, coro):
+        """Zadatak van webhook-a (spojene poruke) - bez ograničenja, ali se čeka pri gašenju."""
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def drain(self, timeout=game.DELIVERY_DRAIN_TIMEOUT):
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=timeout)
+
+    def __len__(self):
+        return len(self._tasks)
+
+
+update_tasks = UpdateTasks()
+
+game.metrics.register_stats('zavet_http_telegram_async', telegram_connections.stats)
+game.metrics.register_stats('zavet_asgi', lambda: {
+    'pending_updates': len(update_tasks), 'peak_pending_updates': update_tasks.peak_pending,
+    'accepted': update_tasks.accepted_count, 'rejected': update_tasks.rejected_count,
+    'active_chats': len(chat_locks), 'sent': async_delivery.sent_count,
+    'failed': async_delivery.failed_count, 'pending_parts': async_delivery.pending_count()})
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        event = await receive()
+        body += event.get('body', b'')
+        if not event.get('more_body'):
+            return body
+
+
+async def respond(send, status, body=b'', content_type=b'text/plain; charset=utf-8'):
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', content_type), (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def webhook(scope, receive, send):
+    headers = dict(scope.get('headers') or [])
+    body = await read_body(receive)
+    if headers.get(b'content-type') != b'application/json':
+        return await respond(send, 403)
+
+    if game.BOT_TOKEN == "DUMMY:TOKEN_FAIL":
+        logging.error("Telegram Webhook pozvan, ali BOT_TOKEN je neispravan.")
+        return await respond(send, 200)
+
+    try:
+        update = telebot.types.Update.de_json(body.decode('utf-8'))
+        if update.message or update.edited_message or update.callback_query or update.channel_post:
+            # Deduplikacija sa bazom (UPDATE_DEDUP_DB) ide u nit
+            if game.UPDATE_DEDUP_DB:
+                duplicate = await asyncio.to_thread(game.update_dedup.is_duplicate, update.update_id)
+            else:
+                duplicate = game.update_dedup.is_duplicate(update.update_id)
+            if duplicate:
+                logging.info(f"Duplikat update-a {update.update_id} ignorisan.")
+                return await respond(send, 200)
+            if not update_tasks.start(update):
+                game.update_dedup.forget(update.update_id)
+                return await respond(send, 503)
+        else:
+            logging.info(f"Primljena neobrađena poruka tipa: {json.loads(body).keys()}")
+    except json.JSONDecodeError as e:
+        logging.error(f"Greška pri parsiranju JSON-a: {e}")
+    except Exception as e:
+        logging.error(f"Nepredviđena greška u obradi Telegram poruke: {e}")
+    return await respond(send, 200)
+
+
+def get_metrics_denial(scope):
+    headers = dict(scope.get('headers') or [])
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    supplied = (query.get('token') or [None])[0] or \
+        headers.get(b'authorization', b'').decode('latin-1').replace('Bearer ', '', 1)
+    return game.get_metrics_denial(supplied)
+
+
+async def metrics_route(scope, receive, send):
+    denial = get_metrics_denial(scope)
+    if denial is not None:
+        return await respond(send, denial)
+    await respond(send, 200, game.metrics.render(), b'text/plain; version=0.0.4')
+
+
+async def stats_route(scope, receive, send):
+    denial = get_metrics_denial(scope)
+    if denial is not None:
+        return await respond(send, denial)
+    report = await asyncio.to_thread(game.funnel_report)
+    await respond(send, 200, json.dumps(report, ensure_ascii=False), b'application/json')
+
+
+async def set_webhook_route(scope, receive, send):
+    result = await asyncio.to_thread(game.set_webhook_route)
+    text = result[0] if isinstance(result, tuple) else result
+    await respond(send, 200, text)
+
+
+ROUTES = {
+    ('POST', '/' + game.BOT_TOKEN): webhook,
+    ('GET', '/metrics'): metrics_route,
+    ('GET', '/stats'): stats_route,
+    ('GET', '/set_webhook'): set_webhook_route,
+}
+
+
+_attached_loop = None
+
+
+def dispatch_coalesced(stage_key, text, message):
+    """V10.90: Poziva se iz niti kontrole naleta - spojene poruke se obrađuju u petlji, pod bravom chata."""
+    _attached_loop.call_soon_threadsafe(
+        update_tasks.add, chat_locks.run(message.chat.id, handle_coalesced_messages, stage_key, text, message)
+    )
+
+
+def attach_event_loop():
+    """Gemini pozivi i spojene poruke kontrole naleta idu kroz petlju servera."""
+    global _attached_loop
+    loop = asyncio.get_running_loop()
+    if _attached_loop is not loop:
+        _attached_loop = loop
+        game.ai_gateway.attach_loop(loop)
+        game.ai_flood_control.attach_dispatcher(dispatch_coalesced)
+        game.session_sweeper.ensure_started()
+
+
+async def lifespan(receive, send):
+    while True:
+        event = await receive()
+        if event['type'] == 'lifespan.startup':
+            attach_event_loop()
+            await send({'type': 'lifespan.startup.complete'})
+        elif event['type'] == 'lifespan.shutdown':
+            await update_tasks.drain()
+            await async_delivery.drain()
+            await async_bot.close_session()
+            await asyncio.to_thread(game.player_cache.flush)
+            await asyncio.to_thread(game.game_events.flush)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+    # Server bez lifespan poruka: petlja se vezuje pri prvom zahtevu
+    attach_event_loop()
+    started = time.perf_counter()
+    route = ROUTES.get((scope['method'], scope['path']))
+    try:
+        if route is None:
+            await read_body(receive)
+            return await respond(send, 404)
+        await route(scope, receive, send)
+    finally:
+        endpoint = route.__name__ if route else 'unknown'
+        game.WEBHOOK_SECONDS.observe(time.perf_counter() - started, endpoint)
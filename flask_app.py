@@ -1,14 +1,33 @@
+import time
+# V10.79: Merenje hladnog starta radnika (od prvog uvoza do spremnosti)
+BOOT_STARTED = time.perf_counter()
+
 import flask
 import telebot
 import os
 import logging
 import random
-import time
+import unicodedata
 import json
-from google import genai
-from google.genai.errors import APIError
+import math
+import re
+import socket
+import queue
+import heapq
+import bisect
+import asyncio
+import atexit
+import contextlib
+import itertools
+import threading
+import hashlib
+import hmac
+import collections
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Union
-from sqlalchemy import create_engine, Column, Integer, String, Boolean
+from sqlalchemy import create_engine, event, inspect, text, Column, Integer, BigInteger, String, Text, Boolean, Index
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from telebot.apihelper import ApiTelegramException 
@@ -19,6 +38,159 @@ from telebot.apihelper import ApiTelegramException
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# V10.79: Trajanje koraka pokretanja u ms (uvoz, moduli, baza, webhook...)
+BOOT_REPORT = collections.OrderedDict()
+_boot_last_mark = BOOT_STARTED
+
+
+def boot_mark(step):
+    """Beleži koliko je trajao korak pokretanja od prethodne oznake."""
+    global _boot_last_mark
+    now = time.perf_counter()
+    BOOT_REPORT[step] = round((now - _boot_last_mark) * 1000, 1)
+    _boot_last_mark = now
+
+
+boot_mark('uvoz')
+
+# ----------------------------------------------------
+# 2.1 METRIKE (V10.80: Prometheus tekstualni format na /metrics)
+# ----------------------------------------------------
+
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+# V10.90: Bez METRICS_TOKEN /metrics i /stats vraćaju 404, osim uz izričito METRICS_PUBLIC=1
+METRICS_PUBLIC = os.environ.get('METRICS_PUBLIC', '0') == '1'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0)
+
+
+def format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    """V10.80: Brojač sa opcionim oznakama; inc() je jedan rečnik pod zaključavanjem."""
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def collect(self):
+        with self._lock:
+            values = dict(self._values)
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{format_labels(self.labelnames, key)} {value}" for key, value in sorted(values.items())]
+        return lines
+
+
+class Histogram:
+    """V10.80: Histogram trajanja (sekunde); observe() je bisect + tri sabiranja."""
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {}  # oznake -> [brojevi po korpama, zbir, ukupno]
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labelvalues)
+            if state is None:
+                state = self._values[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def collect(self):
+        with self._lock:
+            values = {key: (list(counts), total, count) for key, (counts, total, count) in self._values.items()}
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, key, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {total:.6f}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    V10.80: Sve metrike procesa. Pored brojača i histograma, postojeći stats()
+    rečnici (keš, red, limiter...) se čitaju tek pri preuzimanju metrika, pa
+    ne koštaju ništa na putu obrade poruke. Metrike su po gunicorn radniku.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []  # (prefiks, funkcija koja vraća rečnik brojeva)
+
+    def counter(self, name, help_text, labelnames=()):
+        metric = Counter(name, help_text, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help_text, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_stats(self, prefix, stats_fn):
+        self._collectors.append((prefix, stats_fn))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines += metric.collect()
+        for prefix, stats_fn in self._collectors:
+            try:
+                stats = stats_fn()
+            except Exception as e:
+                logging.warning(f"Neuspešno čitanje metrika '{prefix}': {e}")
+                continue
+            for key, value in stats.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                name = f"{prefix}_{key}"
+                lines += [f"# TYPE {name} gauge", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+WEBHOOK_SECONDS = metrics.histogram('zavet_http_request_seconds', 'Trajanje HTTP zahteva po ruti', ('endpoint',))
+UPDATE_SECONDS = metrics.histogram('zavet_update_processing_seconds', 'Trajanje obrade jednog Telegram update-a')
+DB_LOAD_SECONDS = metrics.histogram('zavet_db_load_seconds', 'Čitanje stanja iz skladišta', ('kind',))
+DB_COMMIT_SECONDS = metrics.histogram('zavet_db_commit_seconds', 'Upis serije stanja u skladište')
+GEMINI_SECONDS = metrics.histogram('zavet_gemini_request_seconds', 'Trajanje Gemini poziva', ('mode', 'outcome'))
+TELEGRAM_SECONDS = metrics.histogram('zavet_telegram_request_seconds', 'Trajanje Bot API poziva (bez čekanja u limiteru)', ('method',))
+STAGE_TRANSITIONS = metrics.counter('zavet_stage_transitions_total', 'Prelazi u sledeću fazu igre', ('stage',))
+AI_FALLBACKS = metrics.counter('zavet_ai_fallbacks_total', 'Rezervni odgovori umesto AI odgovora', ('reason',))
+MARKDOWN_RETRIES = metrics.counter('zavet_markdown_retries_total', 'Slanja ponovljena bez Markdowna', ('kind',))
+SESSION_EXPIRATIONS = metrics.counter('zavet_session_expirations_total', 'Sesije završene zbog isteka vremena', ('source',))
+CHAT_LOCK_WAIT_SECONDS = metrics.histogram('zavet_chat_lock_wait_seconds', 'Čekanje na bravu chata pre obrade', ('kind',))
+STATE_CONFLICTS = metrics.counter('zavet_state_conflicts_total', 'Sukobi verzija stanja igrača (isti chat na više radnika)', ('outcome',))
+GEMINI_BREAKER_TRANSITIONS = metrics.counter('zavet_gemini_breaker_transitions_total', 'Prelazi Gemini prekidača kola', ('state',))
+# V10.87: Tokeni po Gemini pozivu - procena pre slanja i stvarni broj iz usage_metadata
+TOKEN_BUCKETS = (64, 128, 256, 512, 768, 1024, 1536, 2048, 4096, 8192)
+GEMINI_PROMPT_TOKENS = metrics.histogram('zavet_gemini_prompt_tokens', 'Ulazni tokeni po Gemini pozivu (bez keširanih)', ('kind',), buckets=TOKEN_BUCKETS)
+GEMINI_TOKENS = metrics.counter('zavet_gemini_tokens_total', 'Tokeni Gemini poziva po vrsti', ('kind',))
+
 # OBAVEZNO: Podesite ove promenljive u vašem okruženju (Render)
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
@@ -30,6 +202,11 @@ if not BOT_TOKEN:
 
 WEBHOOK_URL = os.environ.get('RENDER_EXTERNAL_URL', 'https://placeholder.com/')
 
+# V10.81: Alternativna adresa Bot API-ja (lokalni Bot API server ili lažni server za testiranje)
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL.rstrip('/') + '/bot{0}/{1}'
+
 try:
     bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
 except Exception as e:
@@ -38,6 +215,142 @@ except Exception as e:
 
 app = flask.Flask(__name__)
 
+# ----------------------------------------------------
+# 2.2 IZLAZNI HTTP (V10.84: Trajne konekcije ka Telegramu i Gemini-ju)
+# ----------------------------------------------------
+
+# 'shared' - jedna sesija sa poolom konekcija za sve niti procesa; 'thread' - podrazumevano
+# ponašanje biblioteka (telebot: sesija po niti); 'none' - nova konekcija po pozivu (samo za poređenje)
+HTTP_POOL_MODE = os.environ.get('HTTP_POOL_MODE', 'shared').lower()
+# Najviše trajnih (keep-alive) konekcija po hostu
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '16'))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', '30'))
+# Koliko dugo neaktivna konekcija ostaje otvorena (Gemini; Telegram zatvara sa svoje strane)
+HTTP_KEEPALIVE_SECONDS = float(os.environ.get('HTTP_KEEPALIVE_SECONDS', '60'))
+
+
+class ConnectionCounter:
+    """Broj HTTP zahteva i novih konekcija (TCP/TLS uspostavljanja) za jedno odredište."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+
+    def record(self, new_connection):
+        with self._lock:
+            self.requests += 1
+            if new_connection:
+                self.connections += 1
+
+    def stats(self):
+        reused = self.requests - self.connections
+        return {'requests': self.requests, 'connections': self.connections,
+                'reuse_ratio': round(reused / self.requests, 3) if self.requests else 0.0}
+
+
+gemini_connections = ConnectionCounter()
+
+
+def configure_telegram_http():
+    """
+    Bot API pozivi (apihelper) idu kroz jednu requests sesiju sa poolom od
+    HTTP_POOL_SIZE konekcija po hostu, umesto kroz sesiju po niti koja se
+    obnavlja svakih 10 minuta. Vraća adapter (za metrike) ili None.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    telebot.apihelper.CONNECT_TIMEOUT = HTTP_CONNECT_TIMEOUT
+    telebot.apihelper.READ_TIMEOUT = HTTP_READ_TIMEOUT
+    if HTTP_POOL_MODE == 'none':
+        telebot.apihelper.SESSION_TIME_TO_LIVE = 0
+        return None
+    if HTTP_POOL_MODE != 'shared':
+        return None
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE, max_retries=0)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    telebot.apihelper.session = session
+    telebot.apihelper.SESSION_TIME_TO_LIVE = None
+    return adapter
+
+
+def telegram_connection_stats():
+    """Zbir brojača urllib3 poolova deljene sesije (zahtevi i otvorene konekcije)."""
+    if telegram_http_adapter is None:
+        return {}
+    pools = telegram_http_adapter.poolmanager.pools
+    requests_count = connections = 0
+    for key in list(pools.keys()):
+        pool = pools.get(key)
+        if pool is not None:
+            requests_count += pool.num_requests
+            connections += pool.num_connections
+    reused = requests_count - connections
+    return {'requests': requests_count, 'connections': connections,
+            'reuse_ratio': round(reused / requests_count, 3) if requests_count else 0.0}
+
+
+telegram_http_adapter = configure_telegram_http()
+
+
+def gemini_http_options(base_url=None):
+    """
+    HttpOptions za genai.Client: httpx transporti sa ograničenim poolom, keep-alive
+    rokom i zasebnim rokom za uspostavljanje veze. Async pozivi tada idu kroz httpx
+    (umesto aiohttp-a), pa se nove konekcije mogu brojati (gemini_connections).
+    """
+    from google import genai
+    if HTTP_POOL_MODE != 'shared':
+        return genai.types.HttpOptions(base_url=base_url) if base_url else None
+
+    import httpx
+
+    limits = httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE,
+                          keepalive_expiry=HTTP_KEEPALIVE_SECONDS)
+
+    def with_connect_timeout(request):
+        # genai postavlja jedan rok po zahtevu - uspostavljanje veze dobija svoj, kraći
+        timeouts = dict(request.extensions.get('timeout') or {})
+        timeouts['connect'] = min(timeouts.get('connect') or HTTP_CONNECT_TIMEOUT, HTTP_CONNECT_TIMEOUT)
+        request.extensions['timeout'] = timeouts
+
+    class CountingTransport(httpx.HTTPTransport):
+        def handle_request(self, request):
+            with_connect_timeout(request)
+            opened = []
+            request.extensions['trace'] = lambda name, info: opened.append(name) if name == 'connection.connect_tcp.complete' else None
+            try:
+                return super().handle_request(request)
+            finally:
+                gemini_connections.record(bool(opened))
+
+    class AsyncCountingTransport(httpx.AsyncHTTPTransport):
+        async def handle_async_request(self, request):
+            with_connect_timeout(request)
+            opened = []
+
+            async def trace(name, info):
+                if name == 'connection.connect_tcp.complete':
+                    opened.append(name)
+
+            request.extensions['trace'] = trace
+            try:
+                return await super().handle_async_request(request)
+            finally:
+                gemini_connections.record(bool(opened))
+
+    return genai.types.HttpOptions(
+        base_url=base_url,
+        timeout=int(HTTP_READ_TIMEOUT * 1000),
+        client_args={'transport': CountingTransport(limits=limits)},
+        async_client_args={'transport': AsyncCountingTransport(limits=limits)},
+    )
+
+
 # ----------------------------------------------------
 # 3. SQL ALCHEMY INICIJALIZACIJA (V10.14: Čista inicijalizacija)
 # ----------------------------------------------------
@@ -56,48 +369,1033 @@ class PlayerState(Base):
     score = Column(Integer, default=0) 
     is_disqualified = Column(Boolean, default=False)
     general_conversation_count = Column(Integer, default=0)
+    # V10.71: Zastarelo - istorija je u tabeli conversation_turns; kolona ostaje zbog migracije
     conversation_history = Column(String, default='[]')
     # V10.8: Nova kolona za praćenje vremena sesije
-    start_time = Column(Integer, default=0) 
+    # V10.76: Indeks za pozadinsko čišćenje isteklih sesija
+    start_time = Column(Integer, default=0, index=True)
+    # V10.85: Verzija reda - svaki upis je uslovan (WHERE version = učitana) i povećava je
+    version = Column(Integer, nullable=False, default=0, server_default='0')
 
-def initialize_database():
-    global Session, Engine
+# V10.66: Zajednička evidencija obrađenih update-a (deduplikacija između gunicorn radnika)
+class ProcessedUpdate(Base):
+    __tablename__ = 'processed_updates'
+    update_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    received_at = Column(Integer, index=True)
+
+# V10.71: Istorija razgovora kao tabela poteza (upis = jedan INSERT, čitanje = poslednjih N)
+class ConversationTurn(Base):
+    __tablename__ = 'conversation_turns'
+    id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True, autoincrement=True)
+    chat_id = Column(String, nullable=False)
+    role = Column(String, nullable=False)
+    content = Column(Text, nullable=False)
+    created_at = Column(Integer, default=0)
+    __table_args__ = (Index('ix_conversation_turns_chat_id_id', 'chat_id', 'id'),)
+
+# V10.78: Radnici koji dele globalno ograničenje slanja ka Telegramu (TELEGRAM_LIMIT_DB=1)
+class OutboundWorker(Base):
+    __tablename__ = 'outbound_workers'
+    worker_id = Column(String, primary_key=True)
+    heartbeat_at = Column(Integer, index=True)
+    # Telegram je vratio 429 - niko ne šalje do ovog trenutka (epoch sekunde)
+    blocked_until = Column(Integer, default=0)
+
+# V10.86: Dnevnik događaja igre - samo dodavanje, upisuje ga GameEventLog u serijama
+class GameEvent(Base):
+    __tablename__ = 'game_events'
+    id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True, autoincrement=True)
+    created_at = Column(Integer, nullable=False, index=True)
+    chat_id = Column(String, nullable=False)
+    kind = Column(String, nullable=False)
+    stage = Column(String, nullable=True)
+    next_stage = Column(String, nullable=True)
+    detail = Column(String, nullable=True)
+
+# V10.86: Brojači levka po fazi - uvećavaju se uz svaku seriju događaja, /stats čita samo njih
+class FunnelCounter(Base):
+    __tablename__ = 'funnel_counters'
+    stage = Column(String, primary_key=True)
+    kind = Column(String, primary_key=True)
+    count = Column(BigInteger, nullable=False, default=0)
+
+MAX_HISTORY_ITEMS = 10
+HISTORY_MIGRATION_BATCH = 500
+
+
+def load_recent_turns(session, chat_id, limit=MAX_HISTORY_ITEMS):
+    """V10.71: Poslednjih `limit` poteza, od najstarijeg ka najnovijem."""
+    if session is None:
+        return []
+    rows = (session.query(ConversationTurn.role, ConversationTurn.content)
+            .filter(ConversationTurn.chat_id == chat_id)
+            .order_by(ConversationTurn.id.desc())
+            .limit(limit)
+            .all())
+    return [{'role': role, 'content': content} for role, content in reversed(rows)]
+
+
+def append_turn(session, chat_id, role, content):
+    if session is not None:
+        session.add(ConversationTurn(chat_id=chat_id, role=role, content=content, created_at=int(time.time())))
+
+
+def clear_turns(session, chat_id):
+    if session is not None:
+        session.query(ConversationTurn).filter(ConversationTurn.chat_id == chat_id).delete(synchronize_session=False)
+
+
+def migrate_conversation_history():
+    """
+    V10.71: Prebacuje stare JSON istorije iz player_states.conversation_history u
+    conversation_turns, u serijama. Red se "preuzima" uslovnim UPDATE-om, pa više
+    gunicorn radnika može da pokrene migraciju istovremeno bez dupliranja poteza.
+    """
+    migrated = 0
+    while True:
+        session = Session()
+        try:
+            rows = (session.query(PlayerState.chat_id, PlayerState.conversation_history)
+                    .filter(PlayerState.conversation_history.isnot(None))
+                    .filter(PlayerState.conversation_history.notin_(['[]', '']))
+                    .limit(HISTORY_MIGRATION_BATCH)
+                    .all())
+            if not rows:
+                return migrated
+
+            for chat_id, raw_history in rows:
+                claimed = (session.query(PlayerState)
+                           .filter(PlayerState.chat_id == chat_id, PlayerState.conversation_history == raw_history)
+                           .update({PlayerState.conversation_history: '[]'}, synchronize_session=False))
+                if not claimed:
+                    continue  # Drugi radnik je već preuzeo ovaj red
+                try: history = json.loads(raw_history)
+                except: history = []
+                for entry in history:
+                    append_turn(session, chat_id, entry.get('role', 'model'), entry.get('content', ''))
+                migrated += 1
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logging.error(f"Greška pri migraciji istorije razgovora: {e}")
+            return migrated
+        finally:
+            session.close()
+
+
+PLAYER_COLUMNS = [column.key for column in PlayerState.__table__.columns]
+
+
+def copy_player(player):
+    """Nezavisna (transient) kopija igrača - keš nikada ne deli objekat sa handlerom."""
+    return PlayerState(**{key: getattr(player, key) for key in PLAYER_COLUMNS})
+
+
+def player_values(player):
+    return tuple(getattr(player, key) for key in PLAYER_COLUMNS)
+
+
+# V10.73: Izbor skladišta stanja - 'memory', 'sqlite' ili 'postgres'
+# (prazno = 'postgres' ako postoji DATABASE_URL, 'sqlite' za sqlite:// URL, inače 'memory')
+STATE_BACKEND = os.environ.get('STATE_BACKEND', '').lower()
+SQLITE_PATH = os.environ.get('SQLITE_PATH', 'zavet_state.db')
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', '10'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10'))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', '1800'))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', '1') == '1'
+MEMORY_TURNS_LIMIT = 100
+MEMORY_EVENTS_LIMIT = 1000
+
+state_store = None
+
+
+class MemoryStateStore:
+    """V10.73: Stanje samo u memoriji procesa (razvoj, testovi, rad bez baze)."""
+    name = 'memory'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._players = {}  # chat_id -> PlayerState
+        self._turns = {}    # chat_id -> deque poteza
+        self._events = collections.deque(maxlen=MEMORY_EVENTS_LIMIT)
+        self._funnel = collections.Counter()  # (faza, vrsta) -> broj
+
+    def load_player(self, chat_id):
+        with self._lock:
+            player = self._players.get(chat_id)
+            return copy_player(player) if player else None
+
+    def load_recent_turns(self, chat_id, limit=MAX_HISTORY_ITEMS):
+        with self._lock:
+            return list(self._turns.get(chat_id, ()))[-limit:]
+
+    def write_batch(self, batch):
+        """V10.85: Upis je uslovan po verziji reda; vraća skup chatova u sukobu (nisu upisani)."""
+        conflicts = set()
+        with self._lock:
+            for chat_id, player, turns, clear, version in batch:
+                stored_player = self._players.get(chat_id)
+                if (stored_player.version if stored_player else None) != version:
+                    conflicts.add(chat_id)
+                    continue
+                if clear or player is None:
+                    self._turns.pop(chat_id, None)
+                if player is None:
+                    self._players.pop(chat_id, None)
+                else:
+                    stored_player = self._players[chat_id] = copy_player(player)
+                    stored_player.version = (version or 0) + 1
+                if turns:
+                    stored = self._turns.setdefault(chat_id, collections.deque(maxlen=MEMORY_TURNS_LIMIT))
+                    stored.extend({'role': turn['role'], 'content': turn['content']} for turn in turns)
+        return conflicts
+
+    def player_version(self, chat_id):
+        with self._lock:
+            player = self._players.get(chat_id)
+            return player.version if player else None
+
+    def write_events(self, events, increments):
+        with self._lock:
+            self._events.extend(events)
+            self._funnel.update(increments)
+
+    def load_funnel(self):
+        with self._lock:
+            return dict(self._funnel)
+
+    def expire_sessions(self, cutoff, untimed_stages, end_stage, limit):
+        """
+        V10.76: Obeležava do `limit` isteklih sesija kao završene.
+        V10.86: Vraća [(chat_id, faza u kojoj je sesija istekla)].
+        """
+        with self._lock:
+            expired = [(chat_id, player.current_riddle) for chat_id, player in self._players.items()
+                       if (player.start_time or 0) < cutoff and not player.current_riddle.startswith('END_')
+                       and player.current_riddle not in untimed_stages][:limit]
+            for chat_id, _ in expired:
+                self._players[chat_id].current_riddle = end_stage
+                self._players[chat_id].is_disqualified = True
+                self._players[chat_id].version += 1
+                self._turns.pop(chat_id, None)
+            return expired
+
+    def purge_sessions(self, cutoff, limit):
+        """V10.76: Briše do `limit` sesija starijih od `cutoff`; vraća [(chat_id, faza)]."""
+        with self._lock:
+            purged = [(chat_id, player.current_riddle) for chat_id, player in self._players.items()
+                      if (player.start_time or 0) < cutoff][:limit]
+            for chat_id, _ in purged:
+                del self._players[chat_id]
+                self._turns.pop(chat_id, None)
+            return purged
+
+
+class SqlStateStore:
+    """V10.73: Stanje u SQL bazi (SQLite/WAL za jedan čvor ili Postgres sa podešenim pool-om)."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def load_player(self, chat_id):
+        session = Session()
+        try:
+            player = session.query(PlayerState).filter_by(chat_id=chat_id).first()
+            return copy_player(player) if player else None
+        finally:
+            session.close()
+
+    def load_recent_turns(self, chat_id, limit=MAX_HISTORY_ITEMS):
+        session = Session()
+        try:
+            return load_recent_turns(session, chat_id, limit)
+        finally:
+            session.close()
+
+    def write_batch(self, batch):
+        """
+        Sve izmene serije u jednoj transakciji; greška se prosleđuje pozivaocu.
+        V10.85: Igrač se upisuje uslovno - UPDATE/DELETE ... WHERE version = učitana,
+        a novi igrač kao INSERT koji preskače postojeći red. Chat čiji red je u
+        međuvremenu promenio drugi radnik se ne upisuje (ni njegovi potezi) i vraća
+        se u skupu sukoba; ostatak serije se upisuje normalno.
+        """
+        conflicts = set()
+        session = Session()
+        try:
+            for chat_id, player, turns, clear, version in batch:
+                if not self._write_player(session, chat_id, player, version):
+                    conflicts.add(chat_id)
+                    continue
+                if clear or player is None:
+                    clear_turns(session, chat_id)
+                for turn in turns:
+                    session.add(ConversationTurn(chat_id=chat_id, **turn))
+            session.commit()
+            return conflicts
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def _write_player(self, session, chat_id, player, version):
+        table = PlayerState.__table__
+        if player is None:
+            if version is None:
+                return True  # Igrač nije ni upisan
+            deleted = session.execute(table.delete().where(table.c.chat_id == chat_id, table.c.version == version))
+            return deleted.rowcount == 1
+        values = {key: getattr(player, key) for key in PLAYER_COLUMNS}
+        if version is None:
+            values['version'] = 1
+            inserted = session.execute(insert_ignoring_conflict(table).values(**values))
+            return inserted.rowcount == 1
+        values['version'] = version + 1
+        updated = session.execute(table.update()
+                                  .where(table.c.chat_id == chat_id, table.c.version == version)
+                                  .values(**values))
+        return updated.rowcount == 1
+
+    def player_version(self, chat_id):
+        """V10.85: Trenutna verzija reda (None ako igrač ne postoji)."""
+        session = Session()
+        try:
+            return session.query(PlayerState.version).filter_by(chat_id=chat_id).scalar()
+        finally:
+            session.close()
+
+    def write_events(self, events, increments):
+        """
+        V10.86: Serija događaja jednim INSERT-om (executemany) i brojači levka u istoj
+        transakciji - brojači nikada ne odstupaju od dnevnika. Ključevi se uvećavaju
+        sortirani, pa radnici koji upisuju istovremeno ne upadaju u deadlock.
+        """
+        table = FunnelCounter.__table__
+        session = Session()
+        try:
+            session.execute(GameEvent.__table__.insert(), events)
+            for (stage, kind), amount in sorted(increments.items()):
+                session.execute(insert_ignoring_conflict(table).values(stage=stage, kind=kind, count=0))
+                session.execute(table.update()
+                                .where(table.c.stage == stage, table.c.kind == kind)
+                                .values(count=table.c.count + amount))
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def load_funnel(self):
+        session = Session()
+        try:
+            return {(stage, kind): count for stage, kind, count in
+                    session.query(FunnelCounter.stage, FunnelCounter.kind, FunnelCounter.count)}
+        finally:
+            session.close()
+
+    def expire_sessions(self, cutoff, untimed_stages, end_stage, limit):
+        """
+        V10.76: Obeležava do `limit` isteklih sesija kao završene (jedan UPDATE i jedan
+        DELETE poteza po seriji); vraća [(chat_id, faza)] obeleženih (V10.86). Uslov se
+        ponavlja u UPDATE-u, pa sesija koju je igrač u međuvremenu ponovo pokrenuo
+        (/start) ostaje netaknuta.
+        """
+        live = (PlayerState.start_time < cutoff,
+                ~PlayerState.current_riddle.startswith('END_'),
+                PlayerState.current_riddle.notin_(untimed_stages))
+        session = Session()
+        try:
+            # Postgres: redove koje drugi radnik upravo obrađuje preskačemo (SQLite ignoriše FOR UPDATE)
+            rows = [tuple(row) for row in session.query(PlayerState.chat_id, PlayerState.current_riddle)
+                    .filter(*live).with_for_update(skip_locked=True).limit(limit)]
+            if not rows:
+                return []
+            chat_ids = [chat_id for chat_id, _ in rows]
+            (session.query(PlayerState)
+             .filter(PlayerState.chat_id.in_(chat_ids), *live)
+             .update({PlayerState.current_riddle: end_stage, PlayerState.is_disqualified: True,
+                      PlayerState.version: PlayerState.version + 1},
+                     synchronize_session=False))
+            (session.query(ConversationTurn)
+             .filter(ConversationTurn.chat_id.in_(chat_ids))
+             .delete(synchronize_session=False))
+            session.commit()
+            return rows
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def purge_sessions(self, cutoff, limit):
+        """V10.76: Briše do `limit` sesija starijih od `cutoff` (sa potezima); vraća [(chat_id, faza)]."""
+        session = Session()
+        try:
+            rows = [tuple(row) for row in session.query(PlayerState.chat_id, PlayerState.current_riddle)
+                    .filter(PlayerState.start_time < cutoff)
+                    .with_for_update(skip_locked=True).limit(limit)]
+            if not rows:
+                return []
+            chat_ids = [chat_id for chat_id, _ in rows]
+            (session.query(ConversationTurn)
+             .filter(ConversationTurn.chat_id.in_(chat_ids))
+             .delete(synchronize_session=False))
+            (session.query(PlayerState)
+             .filter(PlayerState.chat_id.in_(chat_ids), PlayerState.start_time < cutoff)
+             .delete(synchronize_session=False))
+            session.commit()
+            return rows
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+
+def insert_ignoring_conflict(table):
+    """V10.85: INSERT koji preskače postojeći primarni ključ (rowcount 0 umesto IntegrityError)."""
+    if Engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(table).on_conflict_do_nothing()
+
+
+def add_missing_columns(table):
+    """V10.85: create_all ne dodaje nove kolone postojećim tabelama (npr. player_states.version)."""
+    existing = {column['name'] for column in inspect(Engine).get_columns(table.name)}
+    for column in table.columns:
+        if column.name in existing:
+            continue
+        ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(Engine.dialect)}"
+        if column.server_default is not None:
+            ddl += f" NOT NULL DEFAULT {column.server_default.arg}"
+        try:
+            with Engine.begin() as connection:
+                connection.execute(text(ddl))
+            logging.info(f"Dodata kolona {table.name}.{column.name}.")
+        except Exception:
+            # Drugi radnik je istovremeno dodao istu kolonu
+            if column.name not in {c['name'] for c in inspect(Engine).get_columns(table.name)}:
+                raise
+
+
+def resolve_state_backend():
+    if STATE_BACKEND:
+        return STATE_BACKEND
     if not DATABASE_URL:
-        logging.warning("DATABASE_URL nedostaje. Aplikacija se pokreće, ali stanje neće biti sačuvano.")
+        return 'memory'
+    return 'sqlite' if DATABASE_URL.startswith('sqlite') else 'postgres'
+
+
+def get_database_url(backend):
+    if backend == 'sqlite' and not (DATABASE_URL or '').startswith('sqlite'):
+        return f"sqlite:///{SQLITE_PATH}"
+    # Render (i Heroku) daju 'postgres://', a SQLAlchemy prihvata samo 'postgresql://'
+    if DATABASE_URL.startswith('postgres://'):
+        return 'postgresql://' + DATABASE_URL[len('postgres://'):]
+    return DATABASE_URL
+
+
+def create_state_engine(backend, url):
+    """V10.73: Engine podešen za izabrano skladište."""
+    if backend == 'sqlite':
+        engine = create_engine(url, connect_args={'check_same_thread': False, 'timeout': 30})
+
+        @event.listens_for(engine, 'connect')
+        def _set_sqlite_pragmas(dbapi_connection, connection_record):
+            # WAL: čitaoci ne čekaju upis; NORMAL je dovoljno bezbedan uz WAL
+            cursor = dbapi_connection.cursor()
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+            cursor.execute('PRAGMA busy_timeout=5000')
+            cursor.close()
+
+        return engine
+
+    return create_engine(
+        url,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING
+    )
+
+
+def initialize_database():
+    """Pravi engine, tabele i skladište stanja. V10.79: Poziva se jednom po procesu, iz startup()."""
+    global Session, Engine, state_store
+    backend = resolve_state_backend()
+    if backend == 'memory':
+        logging.warning("DATABASE_URL nedostaje (ili STATE_BACKEND=memory). Stanje se čuva samo u memoriji procesa.")
+        state_store = MemoryStateStore()
+        chat_guard.configure(backend)
         return
 
     try:
-        Engine = create_engine(DATABASE_URL)
+        Engine = create_state_engine(backend, get_database_url(backend))
         Session = sessionmaker(bind=Engine)
         
         # Kreira tabelu (ako ne postoji)
         Base.metadata.create_all(Engine) 
-        
-        logging.info("Baza podataka i modeli uspešno inicijalizovani i tabele kreirane.")
+        # V10.76: create_all ne dodaje nove indekse postojećim tabelama
+        for index in PlayerState.__table__.indexes:
+            index.create(Engine, checkfirst=True)
+        add_missing_columns(PlayerState.__table__)
+
+        # V10.71: Stare JSON istorije prelaze u conversation_turns
+        migrated = migrate_conversation_history()
+        if migrated:
+            logging.info(f"Migrirana istorija razgovora za {migrated} igrača.")
+
+        state_store = SqlStateStore(backend)
+        chat_guard.configure(backend)
+        logging.info(f"Baza podataka ({backend}) i modeli uspešno inicijalizovani i tabele kreirane.")
     except Exception as e:
         # Greška pri inicijalizaciji baze se i dalje loguje
         logging.error(f"FATALNA GREŠKA: Neuspešno kreiranje/povezivanje baze. Greška: {e}") 
         Session = None
+        state_store = None
+
+# ----------------------------------------------------
+# 3.1 KEŠ STANJA IGRAČA (V10.72: Read-through keš sa odloženim upisom)
+# ----------------------------------------------------
+
+# V10.72: PLAYER_CACHE=0 vraća ponašanje "svaka poruka čita i upisuje direktno u bazu"
+PLAYER_CACHE_ENABLED = os.environ.get('PLAYER_CACHE', '1') == '1'
+PLAYER_CACHE_FLUSH_INTERVAL = float(os.environ.get('PLAYER_CACHE_FLUSH_INTERVAL', '2.0'))
+PLAYER_CACHE_IDLE_TTL = int(os.environ.get('PLAYER_CACHE_IDLE_TTL', '900'))
+PLAYER_CACHE_SIZE = int(os.environ.get('PLAYER_CACHE_SIZE', '10000'))
+
+class StaleStateError(Exception):
+    """V10.85: Red igrača je u međuvremenu promenio drugi radnik - upis je odbijen."""
+
+    def __init__(self, chat_ids):
+        super().__init__(f"Stanje promenjeno u međuvremenu: {sorted(chat_ids)}")
+        self.chat_ids = chat_ids
+
+
+class CachedPlayer:
+    """V10.72: Unos keša za jedan chat (player=None znači da igrač ne postoji)."""
+    __slots__ = ('player', 'version', 'turns', 'pending_turns', 'clear_turns', 'deleted', 'dirty', 'last_access')
+
+    def __init__(self, player):
+        self.player = player
+        # V10.85: Verzija reda u skladištu na koju se unos oslanja (None = red ne postoji)
+        self.version = player.version if player is not None else None
+        self.turns = None          # poslednji potezi; None dok se ne učitaju iz baze
+        self.pending_turns = []    # potezi koji još nisu upisani
+        self.clear_turns = False   # stari potezi u bazi treba da se obrišu
+        self.deleted = False
+        self.dirty = False
+        self.last_access = time.monotonic()
+
+
+class PlayerStateCache:
+    """
+    V10.72: Stanje aktivnih igrača u memoriji, ključ je chat_id.
+
+    Čitanje: prvo keš, a skladište (V10.73: state_store) samo kada chat nije u kešu.
+    Upis: commit menja samo keš i obeležava unos kao prljav; pozadinska nit upisuje
+    sve prljave unose jednom transakcijom na PLAYER_CACHE_FLUSH_INTERVAL sekundi.
+    Prelazi faza (i komande) traže trajni upis odmah (flush samo tog chata).
+
+    Sigurnost: posle pada procesa gubi se najviše poslednji interval promena van
+    prelaza faza; pri gašenju radnika sve se upisuje (atexit). Iz keša se izbacuju
+    samo čisti unosi, a neuspeli upis vraća unos u prljave za sledeći pokušaj.
+    Keš je po procesu - sa više gunicorn radnika isti chat mora stići u isti proces
+    ili se keš isključuje (PLAYER_CACHE=0).
+
+    V10.85: Upis je uslovan po verziji reda. Kada je red u međuvremenu promenio
+    drugi radnik (ili čistač sesija), unos se izbacuje umesto da prepiše tuđu
+    izmenu; trajni upis tada podiže StaleStateError i handler ponavlja obradu nad
+    svežim stanjem. Uz CHAT_CONCURRENCY 'lock'/'optimistic' svaki commit se upisuje
+    odmah (write_through), pa keš služi samo za čitanje između radnika.
+    """
+
+    def __init__(self, caching=PLAYER_CACHE_ENABLED):
+        self.caching = caching
+        self.write_through = False
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # chat_id -> CachedPlayer
+        self._pid = None
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.flush_failures = 0
+        self.evictions = 0
+        self.conflicts = 0
+
+    def _ensure_started(self):
+        # Lenjo pokretanje (i ponovo posle fork-a gunicorn radnika)
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        threading.Thread(target=self._run, name='player-cache-flusher', daemon=True).start()
+
+    # --- čitanje ---
+
+    def _entry(self, chat_id, reuse=False):
+        with self._lock:
+            self._ensure_started()
+            entry = self._entries.get(chat_id)
+            if entry is not None and not self.caching and not entry.dirty and not reuse:
+                # Bez keširanja čist unos ne važi - stanje se uvek čita iz baze
+                del self._entries[chat_id]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(chat_id)
+                entry.last_access = time.monotonic()
+                self.hits += 1
+                return entry
+
+        started = time.perf_counter()
+        player = state_store.load_player(chat_id)
+        DB_LOAD_SECONDS.observe(time.perf_counter() - started, 'player')
+        with self._lock:
+            # Druga nit je možda učitala isti chat u međuvremenu - njen unos ima prednost
+            entry = self._entries.get(chat_id)
+            if entry is None:
+                entry = self._entries[chat_id] = CachedPlayer(player)
+                self.misses += 1
+            entry.last_access = time.monotonic()
+            return entry
+
+    def get_player(self, chat_id):
+        return self.checkout(chat_id)[0]
+
+    def checkout(self, chat_id):
+        """V10.85: Kopija igrača i unos iz kog je pročitana (apply proverava da je unos isti)."""
+        entry = self._entry(chat_id)
+        with self._lock:
+            return (copy_player(entry.player) if entry.player is not None else None), entry
+
+    def recent_turns(self, chat_id, limit=MAX_HISTORY_ITEMS):
+        entry = self._entry(chat_id)
+        with self._lock:
+            if entry.turns is not None:
+                return list(entry.turns[-limit:])
+        # Pod flush zaključavanjem: potezi u bazi + još neupisani = tačna slika bez duplikata
+        with self._flush_lock:
+            with self._lock:
+                clear, pending = entry.clear_turns, list(entry.pending_turns)
+            started = time.perf_counter()
+            stored = [] if clear else state_store.load_recent_turns(chat_id, limit)
+            DB_LOAD_SECONDS.observe(time.perf_counter() - started, 'turns')
+            with self._lock:
+                entry.turns = (stored + pending)[-MAX_HISTORY_ITEMS:]
+                return list(entry.turns[-limit:])
+
+    # --- upis ---
+
+    def apply(self, state_session):
+        """
+        Prenosi izmene jedinice rada u keš. Vraća skup chatova koji su promenjeni.
+        V10.85: Ako je unos iz kog je igrač pročitan u međuvremenu zamenjen (ponovo
+        učitan iz skladišta), izmene su zasnovane na zastarelom stanju - StaleStateError.
+        """
+        touched = (set(state_session.players) | state_session.deleted | state_session.cleared
+                   | {chat_id for chat_id, _ in state_session.new_turns})
+        entries = {chat_id: self._entry(chat_id, reuse=True) for chat_id in touched}
+        with self._lock:
+            stale = {chat_id for chat_id, source in state_session.sources.items()
+                     if chat_id in touched and self._entries.get(chat_id) is not source}
+            if stale:
+                raise StaleStateError(stale)
+            for chat_id, entry in entries.items():
+                if chat_id in state_session.deleted:
+                    entry.player = None
+                    entry.deleted = True
+                    entry.turns, entry.pending_turns, entry.clear_turns = [], [], True
+                    entry.dirty = True
+                    continue
+                if chat_id in state_session.players:
+                    entry.player = copy_player(state_session.players[chat_id])
+                    entry.deleted = False
+                    entry.dirty = True
+                if chat_id in state_session.cleared:
+                    entry.turns, entry.pending_turns, entry.clear_turns = [], [], True
+                    entry.dirty = True
+            for chat_id, turn in state_session.new_turns:
+                entry = entries[chat_id]
+                entry.pending_turns.append(turn)
+                if entry.turns is not None:
+                    entry.turns = (entry.turns + [turn])[-MAX_HISTORY_ITEMS:]
+                entry.dirty = True
+        return touched
+
+    def flush(self, chat_ids=None):
+        """
+        Upisuje prljave unose (sve ili samo zadate chatove) jednom transakcijom.
+        V10.85: Unosi u sukobu verzija se izbacuju; za zadate chatove to je StaleStateError.
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch = []
+                for chat_id, entry in self._entries.items():
+                    if entry.dirty and (chat_ids is None or chat_id in chat_ids):
+                        player = copy_player(entry.player) if entry.player is not None else None
+                        batch.append((chat_id, player, entry.pending_turns, entry.clear_turns, entry.version))
+                        entry.pending_turns, entry.clear_turns, entry.dirty = [], False, False
+            if not batch:
+                return True
+
+            conflicts = self._write(batch)
+            if conflicts is not None:
+                self.flushes += 1
+                self.flushed_rows += len(batch) - len(conflicts)
+                with self._lock:
+                    for chat_id, player, _, _, version in batch:
+                        if chat_id in conflicts:
+                            # Tuđa izmena ima prednost; sledeće čitanje ide u skladište
+                            self._entries.pop(chat_id, None)
+                            self.conflicts += 1
+                        elif chat_id in self._entries:
+                            self._entries[chat_id].version = (version or 0) + 1 if player is not None else None
+                if conflicts and chat_ids is None:
+                    STATE_CONFLICTS.inc('discarded', amount=len(conflicts))
+                    logging.warning(f"Odložen upis odbačen zbog novije verzije u bazi: {sorted(conflicts)}")
+                elif conflicts:
+                    raise StaleStateError(conflicts)
+                return True
+
+            # Neuspeh: unosi ponovo postaju prljavi, stariji potezi ostaju ispred novijih
+            self.flush_failures += 1
+            with self._lock:
+                for chat_id, _, turns, clear, _ in batch:
+                    entry = self._entries.get(chat_id)
+                    if entry is not None:
+                        entry.pending_turns = turns + entry.pending_turns
+                        entry.clear_turns = entry.clear_turns or clear
+                        entry.dirty = True
+            return False
+
+    def _write(self, batch):
+        """Vraća skup chatova u sukobu verzija, ili None kada upis nije uspeo."""
+        started = time.perf_counter()
+        try:
+            conflicts = state_store.write_batch(batch)
+            DB_COMMIT_SECONDS.observe(time.perf_counter() - started)
+            return conflicts
+        except Exception as e:
+            logging.error(f"GREŠKA U BAZI (upis keša stanja, {len(batch)} igrača): {e}")
+            return None
+
+    def discard(self, chat_ids):
+        """
+        V10.76: Izbacuje čiste unose čije je stanje promenjeno direktno u skladištu
+        (čišćenje isteklih sesija); sledeće čitanje ide u skladište. Prljavi unosi
+        ostaju - noviji su od onoga što je čistač video (V10.85: ali čistač je povećao
+        verziju reda, pa se njihov upis odbacuje kao sukob).
+        """
+        with self._lock:
+            for chat_id in chat_ids:
+                entry = self._entries.get(chat_id)
+                if entry is not None and not entry.dirty:
+                    del self._entries[chat_id]
+
+    def revalidate(self, chat_id, version):
+        """V10.85: Izbacuje čist unos zastareo u odnosu na verziju reda u skladištu."""
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is not None and not entry.dirty and entry.version != version:
+                del self._entries[chat_id]
+
+    def _evict(self):
+        now = time.monotonic()
+        with self._lock:
+            for chat_id in list(self._entries):
+                entry = self._entries[chat_id]
+                too_many = len(self._entries) > PLAYER_CACHE_SIZE
+                if entry.dirty or (not too_many and now - entry.last_access < PLAYER_CACHE_IDLE_TTL):
+                    continue
+                del self._entries[chat_id]
+                self.evictions += 1
+
+    def _run(self):
+        while True:
+            time.sleep(PLAYER_CACHE_FLUSH_INTERVAL)
+            try:
+                self.flush()
+                # Izbacivanje pod flush zaključavanjem - unos koji se upravo upisuje ne sme da nestane
+                with self._flush_lock:
+                    self._evict()
+            except Exception as e:
+                logging.error(f"Greška u pozadinskom upisu keša stanja: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'dirty': sum(1 for entry in self._entries.values() if entry.dirty),
+                'hits': self.hits,
+                'misses': self.misses,
+                'flushes': self.flushes,
+                'flushed_rows': self.flushed_rows,
+                'flush_failures': self.flush_failures,
+                'evictions': self.evictions,
+                'conflicts': self.conflicts,
+            }
+
+
+class StateSession:
+    """
+    V10.72: Jedinica rada nad kešom stanja, u obliku koji handleri već koriste
+    (get/add/delete/commit/rollback/close). Izmene se vide u kešu tek na commit(),
+    pa rollback posle greške ne ostavlja polovično stanje.
+    """
+
+    def __init__(self, cache):
+        self._cache = cache
+        self._reset()
+
+    def _reset(self):
+        self.players = {}      # chat_id -> igrač koga handler menja
+        self._originals = {}   # chat_id -> vrednosti kolona pri učitavanju (praćenje izmena)
+        self.sources = {}      # V10.85: chat_id -> unos keša iz kog je igrač pročitan
+        self.deleted = set()
+        self.cleared = set()
+        self.new_turns = []    # [(chat_id, potez)]
+        self._durable = False
+
+    def get_player(self, chat_id):
+        player, self.sources[chat_id] = self._cache.checkout(chat_id)
+        if player is not None:
+            self.players[chat_id] = player
+            self._originals[chat_id] = player_values(player)
+        return player
+
+    def add(self, player):
+        self.players[player.chat_id] = player
+        self._originals.pop(player.chat_id, None)
+        self.deleted.discard(player.chat_id)
+
+    def delete(self, player):
+        self.players.pop(player.chat_id, None)
+        self.deleted.add(player.chat_id)
+
+    def recent_turns(self, chat_id, limit=MAX_HISTORY_ITEMS):
+        base = [] if chat_id in self.cleared else self._cache.recent_turns(chat_id, limit)
+        own = [turn for turn_chat_id, turn in self.new_turns if turn_chat_id == chat_id]
+        return (base + own)[-limit:]
+
+    def append_turn(self, chat_id, role, content):
+        self.new_turns.append((chat_id, {'role': role, 'content': content, 'created_at': int(time.time())}))
+
+    def clear_turns(self, chat_id):
+        self.cleared.add(chat_id)
+        self.new_turns = [(turn_chat_id, turn) for turn_chat_id, turn in self.new_turns if turn_chat_id != chat_id]
+
+    def mark_durable(self):
+        """Prelaz faze / komanda: promene ovog commit-a se odmah upisuju u bazu."""
+        self._durable = True
+
+    def commit(self):
+        # Praćenje izmena: nepromenjeni igrači ne prljaju keš
+        for chat_id, original in self._originals.items():
+            if chat_id in self.players and player_values(self.players[chat_id]) == original:
+                del self.players[chat_id]
+        touched = self._cache.apply(self)
+        durable = self._durable or not self._cache.caching or self._cache.write_through
+        self._reset()
+        if touched and durable:
+            # V10.85: StateSession je posle ovoga prazna i kada upis podigne StaleStateError
+            if not self._cache.flush(touched):
+                logging.error(f"Trajni upis nije uspeo za {sorted(touched)}. Pokušaće se ponovo u pozadini.")
+
+    def rollback(self):
+        self._reset()
+
+    def close(self):
+        self._reset()
+
+
+player_cache = PlayerStateCache()
+atexit.register(player_cache.flush)
+
+
+def open_state_session():
+    """V10.72: Jedinica rada nad stanjem igrača, ili None kada skladište stanja nije dostupno."""
+    return StateSession(player_cache) if state_store is not None else None
+
+
+# ----------------------------------------------------
+# 3.2 ISTI CHAT NA VIŠE RADNIKA (V10.85: Brava po chatu i verzija reda)
+# ----------------------------------------------------
+
+# V10.85: Usklađivanje update-a istog chata koji stignu u različite procese ili čvorove
+#   'local'      - samo brava u procesu (jedan radnik, ili isti chat uvek u istom procesu)
+#   'lock'       - + Postgres advisory brava po chatu dok traju odluka i upis
+#   'optimistic' - bez brave u bazi; sukob verzija reda ponavlja obradu nad svežim stanjem
+# Prazno = 'lock' za Postgres, 'optimistic' za SQLite, 'local' za memoriju.
+CHAT_CONCURRENCY = os.environ.get('CHAT_CONCURRENCY', '').lower()
+CHAT_CONFLICT_RETRIES = int(os.environ.get('CHAT_CONFLICT_RETRIES', '3'))
+CHAT_LOCK_TIMEOUT = float(os.environ.get('CHAT_LOCK_TIMEOUT', '10'))
+
+
+def advisory_lock_key(chat_id):
+    """Stabilan 64-bitni ključ za pg_advisory_xact_lock (isti u svim procesima)."""
+    digest = hashlib.blake2b(f"zavet-chat:{chat_id}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+class ChatGuard:
+    """
+    V10.85: Kritična sekcija jednog chata - čitanje stanja, odluka i upis. Gemini poziv
+    je van nje (AI potez se upisuje u zasebnoj kratkoj sekciji, record_ai_turn), pa
+    brava traje koliko upis u bazu, a ne koliko AI odgovor.
+
+    U procesu je to brava po chatu. Uz 'lock' se drži i Postgres advisory brava na
+    zasebnoj konekciji (oslobađa je kraj transakcije, i kada radnik padne), a unos u
+    kešu se pre čitanja proverava prema verziji reda. Uz 'optimistic' sukob otkriva
+    uslovni upis (StaleStateError), a run_chat_unit ponavlja obradu.
+    """
+
+    def __init__(self):
+        self.mode = 'local'
+        self._lock = threading.Lock()
+        self._locks = {}  # chat_id -> [brava, broj korisnika]
+        # Nosilac advisory brave drži dve konekcije (bravu i upis) - najviše pola pool-a
+        self._database_slots = threading.BoundedSemaphore(max(1, (DB_POOL_SIZE + DB_MAX_OVERFLOW) // 2))
+        self.local_waits = 0
+        self.db_waits = 0
+
+    def configure(self, backend):
+        mode = CHAT_CONCURRENCY or {'postgres': 'lock', 'sqlite': 'optimistic'}.get(backend, 'local')
+        if backend == 'memory':
+            mode = 'local'  # Stanje u memoriji ionako ne dele procesi
+        elif mode == 'lock' and backend != 'postgres':
+            logging.warning(f"CHAT_CONCURRENCY=lock traži Postgres (skladište: {backend}). Koristi se 'optimistic'.")
+            mode = 'optimistic'
+        self.mode = mode
+        # Između procesa keš ne sme da drži neupisane izmene
+        player_cache.write_through = mode != 'local'
+        logging.info(f"Usklađivanje istog chata: {mode}.")
+
+    @contextlib.contextmanager
+    def hold(self, chat_id):
+        with self._lock:
+            entry = self._locks.setdefault(chat_id, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            if not entry[0].acquire(blocking=False):
+                started = time.perf_counter()
+                entry[0].acquire()
+                self.local_waits += 1
+                CHAT_LOCK_WAIT_SECONDS.observe(time.perf_counter() - started, 'local')
+            try:
+                if self.mode == 'lock' and Engine is not None:
+                    with self._database_lock(chat_id):
+                        yield
+                else:
+                    yield
+            finally:
+                entry[0].release()
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[chat_id]
+
+    @contextlib.contextmanager
+    def _database_lock(self, chat_id):
+        key = advisory_lock_key(chat_id)
+        with self._database_slots, Engine.connect() as connection, connection.begin():
+            # Bez čekanja kada chat niko drugi ne obrađuje (jedan upit)
+            if not connection.execute(text('SELECT pg_try_advisory_xact_lock(:key)'), {'key': key}).scalar():
+                started = time.perf_counter()
+                connection.execute(text(f"SET LOCAL lock_timeout = '{int(CHAT_LOCK_TIMEOUT * 1000)}ms'"))
+                connection.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': key})
+                self.db_waits += 1
+                CHAT_LOCK_WAIT_SECONDS.observe(time.perf_counter() - started, 'database')
+            # Drugi radnik je možda upisao ovaj chat posle našeg poslednjeg čitanja
+            player_cache.revalidate(chat_id, state_store.player_version(chat_id))
+            yield
+
+    def stats(self):
+        with self._lock:
+            active = len(self._locks)
+        return {
+            'mode': self.mode,
+            'active_chats': active,
+            'local_waits': self.local_waits,
+            'database_waits': self.db_waits,
+        }
+
+
+chat_guard = ChatGuard()
+
+
+def run_chat_unit(chat_id, work, *args):
+    """
+    V10.85: work(session, *args) pod bravom chata. Kada upis naiđe na noviju verziju
+    reda (drugi radnik je u međuvremenu upisao isti chat), rezultat pokušaja se
+    odbacuje i work se ponavlja nad svežim stanjem, do CHAT_CONFLICT_RETRIES puta.
+    """
+    for attempt in range(CHAT_CONFLICT_RETRIES + 1):
+        with chat_guard.hold(chat_id):
+            session = open_state_session()
+            try:
+                return work(session, *args)
+            except StaleStateError:
+                STATE_CONFLICTS.inc('conflict')
+                logging.info(f"Sukob verzija za {chat_id} (pokušaj {attempt + 1}). Obrada se ponavlja.")
+            finally:
+                if session: session.close()
+    STATE_CONFLICTS.inc('exhausted')
+    raise StaleStateError({chat_id})
 
-# Pozivamo inicijalizaciju pri pokretanju skripte
-initialize_database()
 
 # ----------------------------------------------------
 # 4. AI KLIJENT I DATA (V10.61 - Vraćanje Long Uvoda)
 # ----------------------------------------------------
 
 GEMINI_MODEL_NAME = 'gemini-2.5-flash' 
+# V10.67: Alternativna adresa Gemini API-ja (npr. lokalni lažni server za testiranje)
+GEMINI_BASE_URL = os.environ.get('GEMINI_BASE_URL')
 ai_client = None
+_ai_client_lock = threading.Lock()
+_ai_client_ready = False
 
-if GEMINI_API_KEY:
-    try:
-        ai_client = genai.Client(api_key=GEMINI_API_KEY)
-        logging.info("Gemini klijent uspešno inicijalizovan.")
-    except Exception as e:
-        logging.error(f"Neuspešna inicijalizacija Gemini klijenta. Bot će koristiti Fallback. Greška: {e}")
-else:
+if not GEMINI_API_KEY:
      logging.warning("GEMINI_API_KEY nedostaje. Bot će koristiti samo hardkodovane odgovore.")
 
+
+def genai_types():
+    """V10.79: google.genai se uvozi tek kada zatreba (uvoz traje i do sekunde)."""
+    from google.genai import types
+    return types
+
+
+def get_ai_client():
+    """
+    V10.79: Gemini klijent se pravi pri prvoj upotrebi (ili u pozadini posle
+    pokretanja), ne pri uvozu modula. Vraća None bez ključa ili posle greške.
+    """
+    global ai_client, _ai_client_ready
+    if _ai_client_ready:
+        return ai_client
+    with _ai_client_lock:
+        if _ai_client_ready:
+            return ai_client
+        if GEMINI_API_KEY:
+            started = time.perf_counter()
+            try:
+                from google import genai
+                # V10.84: Podešen HTTP klijent (pool, keep-alive, rokovi)
+                ai_client = genai.Client(api_key=GEMINI_API_KEY, http_options=gemini_http_options(GEMINI_BASE_URL))
+                logging.info(f"Gemini klijent uspešno inicijalizovan ({(time.perf_counter() - started) * 1000:.0f} ms).")
+            except Exception as e:
+                logging.error(f"Neuspešna inicijalizacija Gemini klijenta. Bot će koristiti Fallback. Greška: {e}")
+        _ai_client_ready = True
+        return ai_client
+
 # KRITIČNE INSTRUKCIJE ZA AI (V10.62 - Manja korekcija za AI ponavljanje)
 SYSTEM_INSTRUCTION = (
     "Ti si **Dimitrije**, član pokreta otpora pod nazivom **'Zavet'** iz 2049. godine. Tvoja misija je da braniš istinu, pravdu i slobodu protiv totalitarne vlade **GSA** (Global Synthesis Authority). Komuniciraš sa korisnikom preko nestabilnog kvantnog transmittera. "
@@ -109,6 +1407,20 @@ SYSTEM_INSTRUCTION = (
     "Tvoji odgovori moraju biti kratki i fokusirani na test."
 )
 
+# V10.87: Stalna pravila zadatka putuju uz instrukcije (keš/system_instruction), a svaki
+# poziv nosi samo poruku igrača, poslednju frazu i oznaku pravila koje važi
+TASK_RULES = (
+    "\n\nPRAVILA ZADATKA (poslednja poruka navodi koje pravilo važi):\n"
+    "[PITANJE] Generiši kratak odgovor (maks. 4 rečenice), dajući traženo objašnjenje i/ili pojačavajući pritisak, "
+    "a zatim OBAVEZNO zatraži od igrača da ODGOVORI na poslednje, već postavljeno pitanje. Ne ponavljaj duge A, B, C "
+    "opcije pitanja, samo referenciraj da MORAJU da odgovore. Vreme je kritično!\n"
+    "[TRANZIT] Generiši kratak odgovor (maks. 3 rečenice), dajući objašnjenje i pojačavajući pritisak, a zatim "
+    "OBAVEZNO zatraži od igrača da POTVRDI da je spreman za nastavak.\n"
+    "Ne ponavljaj doslovno svoje ranije odgovore. "
+    "**ODGOVORI MORAJU BITI PLAIN TEXT, BEZ MARKDOWN FORMATIRANJA (npr. bez boldovanja, kurziva).**"
+)
+PROMPT_INSTRUCTION = SYSTEM_INSTRUCTION + TASK_RULES
+
 # V10.61: Vraćanje Long Monologa
 GAME_STAGES = {
     # Početna Provera Signala
@@ -116,7 +1428,12 @@ GAME_STAGES = {
         "text": [
             "DA LI VIDIŠ MOJU PORUKU?"
         ],
-        "responses": {"da": "FAZA_2_UVOD_LONG", "ne": "END_NO_SIGNAL"} # V10.61: Vodi direktno na LONG
+        "responses": {"da": "FAZA_2_UVOD_LONG", "ne": "END_NO_SIGNAL", "ne vidim": "END_NO_SIGNAL", "ne vidimo": "END_NO_SIGNAL", "necu": "END_NO_SIGNAL"}, # V10.61: Vodi direktno na LONG
+        # V10.74: Samo ceo unos se poredi; bilo koji drugi odgovor znači da je veza uspostavljena
+        "match": "exact",
+        "default": "FAZA_2_UVOD_LONG",
+        # Vremenski limit ne važi dok se veza ne uspostavi
+        "timed": False
     },
     
     # NOVA FAZA - LONG MONOLOG (Obogaćen tekst)
@@ -131,7 +1448,8 @@ GAME_STAGES = {
         # Ključne reči za prelazak na FAZA_2_TEST_1
         "responses": {"nastavi": "FAZA_2_TEST_1", "potvrđujem": "FAZA_2_TEST_1", "potvrdjujem": "FAZA_2_TEST_1", "ok": "FAZA_2_TEST_1", "spreman": "FAZA_2_TEST_1", "da": "FAZA_2_TEST_1", "jesam": "FAZA_2_TEST_1",
                       "razumeo": "FAZA_2_TEST_1", "razumeo sam": "FAZA_2_TEST_1", "spreman sam": "FAZA_2_TEST_1", "potvrdio sam": "FAZA_2_TEST_1"}, 
-        "prompt": "Potvrdi da si spreman za prvi, najvažniji test. Lociraće me svakog trena!"
+        "prompt": "Potvrdi da si spreman za prvi, najvažniji test. Lociraće me svakog trena!",
+        "transitional": True
     },
     
     # TEST FAZA - 1: Prvo Pitanje 
@@ -170,8 +1488,10 @@ GAME_STAGES = {
             "Pitanje:\nAko saznaš istinu koja može uništiti sve u šta veruješ, da li bi je ipak tražio?\n\nA) Ne, istina je preopasna\nB) Da, tražim istinu bez obzira na posledice\nC) Čekam, možda neko drugi treba da je pronađe"
         ],
         "correct_response": "b", 
-        # Responses sada vode do EVALUACIJE u handle_general_message, a ne direktno do sledeće faze
-        "responses": {"b": "EVALUATE_SCORE", "a": "EVALUATE_SCORE", "c": "EVALUATE_SCORE"} 
+        # Responses sada vode do EVALUACIJE skora, a ne direktno do sledeće faze
+        "responses": {"b": "EVALUATE_SCORE", "a": "EVALUATE_SCORE", "c": "EVALUATE_SCORE"},
+        # V10.74: Pravilo evaluacije (ranije ugrađeno u handle_general_message)
+        "evaluate": {"pass_score": 4, "pass": "FAZA_3_FINAL_PROMPT", "fail": "END_FAILED_TEST"}
     },
 
     # NOVA FAZA: Finalni Prompt (Prikazuje se SAMO ako je skor 4/4)
@@ -180,7 +1500,8 @@ GAME_STAGES = {
              "Test je završen.\nUspešno si proša proveru.\nČestitam!", 
              "Da li si spreman da primiš saznanja o strukturi sistema koji drži ljude pod kontrolom?\n\nOdgovori:\n**DA ili NE**" 
             ],
-        "responses": {"da": "END_SHARE", "ne": "END_WAIT"}
+        "responses": {"da": "END_SHARE", "ne": "END_WAIT"},
+        "transitional": True
     }
 }
 
@@ -209,21 +1530,391 @@ END_MESSAGES = {
     )
 }
 
-# V10.8: Definisanje vremenskog limita
-TIME_LIMIT_SECONDS = 180 # 3 minuta
-TIME_LIMIT_MESSAGE = "Vreme za igru je isteklo. Pokušaj ponovo kasnije."
-GAME_ACTIVE = True 
-GLITCH_CHARS = "$#%&!@*^"
+# ----------------------------------------------------
+# 4.1 MAŠINA STANJA IGRE (V10.74: GAME_STAGES preveden u tabelu prelaza)
+# ----------------------------------------------------
 
-def is_game_active(): return GAME_ACTIVE 
+# V10.74: Opciono učitavanje kviza iz JSON fajla: {"stages": {...}, "end_messages": {...}}
+GAME_STAGES_FILE = os.environ.get('GAME_STAGES_FILE')
+EVALUATE_SCORE = "EVALUATE_SCORE"
 
-def generate_glitch_text(length=30, max_lines=4):
-    """Generiše nasumičan tekst koji simulira grešku/glitch. V10.58: Korišćenje Code Block formata za sigurnost."""
-    num_lines = random.randint(2, max_lines) 
-    glitch_parts = []
-    
-    for _ in range(num_lines):
-        line_length = random.randint(10, length)
+CompiledStage = collections.namedtuple('CompiledStage', [
+    'key', 'text', 'required_phrase', 'responses', 'exact', 'subset_index',
+    'default', 'correct_response', 'evaluate', 'transitional', 'timed', 'exact_only'
+])
+Transition = collections.namedtuple('Transition', ['keyword', 'next_stage', 'score_delta', 'is_terminal', 'confidence'])
+
+
+DIACRITIC_MAP = str.maketrans({'đ': 'dj', 'č': 'c', 'ć': 'c', 'š': 's', 'ž': 'z'})
+
+
+def normalize_user_text(text):
+    """
+    V10.68: Mala slova, bez dijakritika i interpunkcije, sa jednim razmakom između reči.
+    V10.75: Koristi se i za prepoznavanje namere - emoji i simboli se uklanjaju (nisu alfanumerički).
+    """
+    text = (text or "").lower().translate(DIACRITIC_MAP)
+    text = unicodedata.normalize('NFKD', text)
+    text = "".join(ch if ch.isalnum() else " " for ch in text if not unicodedata.combining(ch))
+    return " ".join(text.split())
+
+
+# V10.75: Prepoznavanje namere van tačnog poklapanja (pre nego što se pozove Gemini)
+FUZZY_MATCHING_ENABLED = os.environ.get('FUZZY_MATCHING', '1') == '1'
+FUZZY_MATCH_THRESHOLD = float(os.environ.get('FUZZY_MATCH_THRESHOLD', '0.7'))
+# Reči koje prate odgovor, a ne menjaju ga ("odgovor b", "spreman sam")
+ANSWER_FILLER_WORDS = frozenset({
+    'odgovor', 'odgovaram', 'moj', 'moje', 'izbor', 'biram', 'opcija', 'slovo', 'pod',
+    'mislim', 'je', 'ja', 'sam', 'tacno', 'tacan', 'naravno', 'hvala', 'evo', 'hajde', 'ajde', 'ajmo'
+})
+# 'da' je odgovor u igri - kao veznik ("mislim da je b") se preskače samo posle ovih reči
+CONJUNCTION_DA_AFTER = frozenset({'mislim', 'verujem', 'kazem'})
+NEGATION_WORDS = frozenset({'ne', 'nisam', 'necu', 'nije', 'nemoj', 'nikako', 'nemam'})
+# Pitanja i neodlučni unosi nikada nisu potez u igri - idu AI-ju ("da li je opasno?", "ne znam")
+QUESTION_PHRASES = ('da li', 'jel', 'je l')
+NON_ANSWER_PHRASES = ('ne znam', 'neznam', 'ne razumem', 'nisam siguran', 'nisam sigurna', 'nemam pojma')
+# V10.90: Odrečne reči (i prva, odrečna reč neodlučnih fraza) - prepoznaju se i sa slovnom greškom ("nesam")
+NEGATION_FORMS = NEGATION_WORDS | frozenset(phrase.split()[0] for phrase in NON_ANSWER_PHRASES)
+
+IntentMatch = collections.namedtuple('IntentMatch', ['keyword', 'confidence', 'method'])
+
+
+def bounded_edit_distance(a, b, max_distance):
+    """Levenshtein rastojanje, ili None čim pređe max_distance (rani izlaz po redu matrice)."""
+    if abs(len(a) - len(b)) > max_distance:
+        return None
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > max_distance:
+            return None
+        previous = current
+    return previous[-1] if previous[-1] <= max_distance else None
+
+
+def is_question_or_non_answer(user_text, normalized):
+    """V10.75: '?' posle poslednje reči, "da li" ili "ne znam" - igrač pita ili ne zna, ne odgovara."""
+    last_word_end = max((i for i, ch in enumerate(user_text) if ch.isalnum()), default=-1)
+    if '?' in user_text[last_word_end + 1:]:
+        return True
+    padded = f" {normalized} "
+    return any(f" {phrase} " in padded for phrase in QUESTION_PHRASES + NON_ANSWER_PHRASES)
+
+
+def max_typos_for(word):
+    # Kratke reči (da, ne, ok, a/b/c) moraju biti tačne - jedna greška bi promenila značenje
+    if len(word) < 4:
+        return 0
+    return 1 if len(word) < 8 else 2
+
+
+def is_negation_word(token):
+    """V10.90: Odrečna reč, i sa slovnom greškom u granicama max_typos_for ("nesam" je "nisam")."""
+    return token in NEGATION_FORMS or any(
+        bounded_edit_distance(token, word, max_typos_for(word)) is not None for word in NEGATION_FORMS
+    )
+
+
+class KeywordTrie:
+    """V10.75: Trie po rečima nad ključnim rečima faze - sva pojavljivanja u jednom prolazu kroz unos."""
+
+    def __init__(self, phrases):
+        self._root = {}
+        for phrase, keyword in phrases.items():
+            node = self._root
+            for word in phrase.split():
+                node = node.setdefault(word, {})
+            node[None] = keyword  # None označava kraj ključne reči
+
+    def find_all(self, tokens):
+        """Lista (početak, dužina, ključna reč) za svako pojavljivanje u nizu reči."""
+        matches = []
+        for start in range(len(tokens)):
+            node = self._root
+            position = start
+            while position < len(tokens) and tokens[position] in node:
+                node = node[tokens[position]]
+                position += 1
+                if None in node:
+                    matches.append((start, position - start, node[None]))
+        return matches
+
+
+class StageIntentIndex:
+    """V10.75: Indeks jedne faze - normalizovani tačni unosi, trie i reči za proveru slovnih grešaka."""
+
+    def __init__(self, stage):
+        normalized = {}
+        for keyword in stage.responses:
+            normalized.setdefault(normalize_user_text(keyword), keyword)
+        self.stage = stage
+        self.exact = normalized
+        self.trie = KeywordTrie(normalized)
+        self.typo_words = tuple((phrase, keyword) for phrase, keyword in normalized.items()
+                                if ' ' not in phrase and max_typos_for(phrase) > 0)
+        # Kod pitanja sa bodovanjem svaka ključna reč je poseban odgovor, čak i kada vode u istu fazu
+        self.keywords_are_distinct = stage.correct_response is not None
+
+
+class IntentMatcher:
+    """
+    V10.75: Brzo lokalno prepoznavanje odgovora koje tačno poklapanje propusti
+    ("b)", "B.", "odgovor b", "potvrđujem!", "spreman sam 👍", "spremam").
+
+    Redom: normalizacija (dijakritici, interpunkcija, emoji), pretraga svih ključnih
+    reči faze kroz trie, ograničeno Levenshtein rastojanje za duže reči. Pouzdanost
+    raste sa udelom unosa koji je objašnjen ključnom reči ili rečima-punjačima, a
+    pada uz slovne greške i negaciju van ključne reči (i sa slovnom greškom, "nesam").
+    Odrečna reč se nikada ne čita kao slovna greška potvrdne ("nesam" nije "jesam").
+    Dvosmislen unos ("a ili b", "da ili ne"), pitanje ("a zašto?", "da li moram?")
+    i "ne znam" se ne prepoznaju, a kratke ključne reči (da, ne, a, b, c) važe samo kao ceo unos uz reči-punjače.
+    """
+
+    def __init__(self, stages, threshold=FUZZY_MATCH_THRESHOLD):
+        self.threshold = threshold
+        self._indexes = {key: StageIntentIndex(stage) for key, stage in stages.items()}
+        self.matches = 0
+        self.rejections = 0
+
+    def match(self, stage_key, user_text):
+        index = self._indexes.get(stage_key)
+        normalized = normalize_user_text(user_text)
+        if index is None or not normalized:
+            return None
+        if is_question_or_non_answer(user_text, normalized):
+            self.rejections += 1
+            return None
+        intent = self._match(index, normalized)
+        if intent is None or intent.confidence < self.threshold:
+            self.rejections += 1
+            return None
+        self.matches += 1
+        return intent
+
+    def _match(self, index, normalized):
+        keyword = index.exact.get(normalized)
+        if keyword is not None:
+            return IntentMatch(keyword, 0.95, 'normalized')
+
+        tokens = normalized.split()
+        if index.stage.exact_only:
+            # Faze sa tačnim poređenjem: samo ceo unos, eventualno sa slovnom greškom
+            return self._typo_match(index, normalized)
+
+        found = {}  # ključna reč -> (pozicije reči, broj slovnih grešaka)
+        for start, length, keyword in index.trie.find_all(tokens):
+            positions, typos = found.get(keyword, (set(), 0))
+            found[keyword] = (positions | set(range(start, start + length)), typos)
+        for position, token in enumerate(tokens):
+            if any(position in positions for positions, _ in found.values()):
+                continue
+            # "nesam" je jednu grešku od "jesam" - odrečna reč nikada nije slovna greška potvrdne
+            negation = is_negation_word(token)
+            for phrase, keyword in index.typo_words:
+                if negation and not is_negation_word(phrase):
+                    continue
+                distance = bounded_edit_distance(token, phrase, max_typos_for(phrase))
+                if distance:
+                    positions, typos = found.get(keyword, (set(), 0))
+                    found[keyword] = (positions | {position}, typos + distance)
+                    break
+        if not found:
+            return None
+
+        targets = {index.stage.responses[keyword] for keyword in found}
+        if len(targets) > 1 or (index.keywords_are_distinct and len(found) > 1):
+            return None  # dvosmislen odgovor - neka odluči AI/igrač
+
+        keyword = max(found, key=lambda k: len(found[k][0]))
+        covered = set().union(*(positions for positions, _ in found.values()))
+        covered |= {i for i, token in enumerate(tokens) if token in ANSWER_FILLER_WORDS}
+        covered |= {i for i, token in enumerate(tokens)
+                    if token == 'da' and i > 0 and tokens[i - 1] in CONJUNCTION_DA_AFTER}
+        if len(covered) < len(tokens) and any(' ' not in k and max_typos_for(k) == 0 for k in found):
+            return None  # "a šta je to" nije odgovor A - kratka reč mora biti ceo odgovor
+        typos = sum(typo for _, typo in found.values())
+        negated = any(i not in covered and is_negation_word(token) for i, token in enumerate(tokens))
+
+        confidence = 0.6 + 0.35 * len(covered) / len(tokens) - 0.1 * typos - (0.3 if negated else 0.0)
+        return IntentMatch(keyword, round(confidence, 3), 'typo' if typos else 'trie')
+
+    def _typo_match(self, index, normalized):
+        negation = is_negation_word(normalized)
+        for phrase, keyword in index.exact.items():
+            if negation and not is_negation_word(phrase):
+                continue
+            distance = bounded_edit_distance(normalized, phrase, max_typos_for(phrase))
+            if distance is not None:
+                return IntentMatch(keyword, round(0.9 - 0.1 * distance, 3), 'typo')
+        return None
+
+
+def tokenize_words(text_lower):
+    # V10.61: Robusnija tokenizacija
+    return set(text_lower.replace(',', ' ').replace('?', ' ').replace('.', ' ').split())
+
+
+class StageMachine:
+    """
+    V10.74: GAME_STAGES preveden jednom pri pokretanju u nepromenljivu tabelu prelaza.
+
+    Po fazi: rečnik tačnih unosa (ceo tekst -> ključna reč), indeks višesložnih
+    ključnih reči po prvoj reči (provera podskupa samo za kandidate), pravilo
+    bodovanja, pravilo evaluacije skora i podrazumevani prelaz. Svaki cilj mora
+    biti postojeća faza, epilog iz END_MESSAGES ili EVALUATE_SCORE uz pravilo.
+    """
+
+    def __init__(self, stages, end_messages, fuzzy=FUZZY_MATCHING_ENABLED):
+        self.end_keys = frozenset(end_messages)
+        compiled = {key: self._compile(key, data) for key, data in stages.items()}
+        self.stages = MappingProxyType(compiled)
+        self._validate()
+        # V10.76: Faze bez vremenskog ograničenja (čistač isteklih sesija ih preskače)
+        self.untimed_stages = tuple(key for key, stage in compiled.items() if not stage.timed)
+        # V10.75: Rezervno, približno prepoznavanje kada tačno poklapanje ne uspe
+        self.intent_matcher = IntentMatcher(self.stages) if fuzzy else None
+
+    @staticmethod
+    def _compile(key, data):
+        text = tuple(data.get("text", ()))
+        if "prompt" in data:
+            # V10.7: Tranzitna faza gde se postavlja prompt za nastavak
+            required_phrase = data["prompt"].strip()
+        else:
+            # Poslednja poruka u nizu je uvek pitanje koje traži odgovor
+            required_phrase = (text[-1] if text else "Signal se gubi...").strip()
+
+        responses = MappingProxyType({keyword.lower(): target for keyword, target in data.get("responses", {}).items()})
+        exact = {keyword: keyword for keyword in responses}
+        subset_index = {}
+        exact_only = data.get("match", "subset") == "exact"
+        if not exact_only:
+            # Višesložne ključne reči: dovoljno je da se sve reči pojave u unosu
+            for order, keyword in enumerate(responses):
+                words = frozenset(keyword.split())
+                if len(words) > 1:
+                    first_word = sorted(words)[0]
+                    subset_index.setdefault(first_word, []).append((order, words, keyword))
+
+        correct = data.get("correct_response")
+        return CompiledStage(
+            key=key,
+            text=text,
+            required_phrase=required_phrase,
+            responses=responses,
+            exact=MappingProxyType(exact),
+            subset_index=MappingProxyType({word: tuple(entries) for word, entries in subset_index.items()}),
+            default=data.get("default"),
+            correct_response=correct.lower() if correct else None,
+            evaluate=MappingProxyType(dict(data["evaluate"])) if data.get("evaluate") else None,
+            transitional=bool(data.get("transitional", False)),
+            timed=bool(data.get("timed", True)),
+            exact_only=exact_only
+        )
+
+    def _is_known_target(self, target):
+        return target in self.stages or target in self.end_keys
+
+    def _validate(self):
+        errors = []
+        for stage in self.stages.values():
+            targets = list(stage.responses.values()) + ([stage.default] if stage.default else [])
+            for target in targets:
+                if target == EVALUATE_SCORE:
+                    if not stage.evaluate:
+                        errors.append(f"{stage.key}: {EVALUATE_SCORE} bez pravila 'evaluate'")
+                elif not self._is_known_target(target):
+                    errors.append(f"{stage.key}: nepoznata ciljna faza '{target}'")
+            if stage.evaluate:
+                for outcome in ("pass", "fail"):
+                    if not self._is_known_target(stage.evaluate.get(outcome)):
+                        errors.append(f"{stage.key}: nepoznata faza za evaluate.{outcome}")
+            if stage.correct_response and stage.correct_response not in stage.responses:
+                errors.append(f"{stage.key}: correct_response nije među odgovorima")
+        if errors:
+            raise ValueError("Neispravna definicija faza igre: " + "; ".join(errors))
+
+    def get(self, stage_key):
+        return self.stages.get(stage_key)
+
+    def is_terminal(self, stage_key):
+        return stage_key.startswith("END_")
+
+    def match_keyword(self, stage, text_lower):
+        """Ključna reč koja odgovara unosu (ceo unos ili podskup reči), ili None."""
+        keyword = stage.exact.get(text_lower)
+        if keyword is not None or not stage.subset_index:
+            return keyword
+        words = tokenize_words(text_lower)
+        best = None
+        for word in words:
+            for order, keyword_words, candidate in stage.subset_index.get(word, ()):
+                if (best is None or order < best[0]) and keyword_words <= words:
+                    best = (order, candidate)
+        return best[1] if best else None
+
+    def transition_for(self, stage, keyword, score, confidence=1.0):
+        """Prelaz za prepoznatu ključnu reč (None = podrazumevani prelaz faze)."""
+        target = stage.responses[keyword] if keyword is not None else stage.default
+        if target is None:
+            return None
+        score_delta = 1 if keyword is not None and keyword == stage.correct_response else 0
+        if target == EVALUATE_SCORE:
+            rule = stage.evaluate
+            target = rule["pass"] if score + score_delta >= rule["pass_score"] else rule["fail"]
+        return Transition(keyword, target, score_delta, self.is_terminal(target), confidence)
+
+    def resolve(self, stage_key, user_text, score):
+        """O(1) prelaz za unos igrača, ili None kada unos nije prepoznat."""
+        stage = self.stages[stage_key]
+        keyword = self.match_keyword(stage, user_text.lower().strip())
+        confidence = 1.0
+        if keyword is None and self.intent_matcher is not None:
+            # V10.75: Tek kada tačno poklapanje ne uspe - pre podrazumevanog prelaza i pre AI-ja
+            intent = self.intent_matcher.match(stage_key, user_text)
+            if intent is not None:
+                keyword, confidence = intent.keyword, intent.confidence
+        return self.transition_for(stage, keyword, score, confidence)
+
+
+def load_game_definition():
+    """V10.74: Ugrađene faze, ili faze iz GAME_STAGES_FILE (ako je zadat i ispravan)."""
+    if GAME_STAGES_FILE:
+        try:
+            with open(GAME_STAGES_FILE, encoding='utf-8') as f:
+                data = json.load(f)
+            stages = data["stages"]
+            end_messages = {**END_MESSAGES, **data.get("end_messages", {})}
+            machine = StageMachine(stages, end_messages)
+            GAME_STAGES.clear()
+            GAME_STAGES.update(stages)
+            END_MESSAGES.update(end_messages)
+            logging.info(f"Faze igre učitane iz {GAME_STAGES_FILE} ({len(stages)} faza).")
+            return machine
+        except Exception as e:
+            logging.critical(f"Neuspešno učitavanje faza iz {GAME_STAGES_FILE}. Koriste se ugrađene faze. Greška: {e}")
+    return StageMachine(GAME_STAGES, END_MESSAGES)
+
+
+stage_machine = load_game_definition()
+
+# V10.8: Definisanje vremenskog limita
+TIME_LIMIT_SECONDS = 180 # 3 minuta
+TIME_LIMIT_MESSAGE = "Vreme za igru je isteklo. Pokušaj ponovo kasnije."
+GAME_ACTIVE = True 
+GLITCH_CHARS = "$#%&!@*^"
+
+def is_game_active(): return GAME_ACTIVE 
+
+def generate_glitch_text(length=30, max_lines=4):
+    """Generiše nasumičan tekst koji simulira grešku/glitch. V10.58: Korišćenje Code Block formata za sigurnost."""
+    num_lines = random.randint(2, max_lines) 
+    glitch_parts = []
+    
+    for _ in range(num_lines):
+        line_length = random.randint(10, length)
         line = "".join(random.choice(GLITCH_CHARS) for _ in range(line_length))
         glitch_parts.append(line)
     
@@ -231,163 +1922,2473 @@ def generate_glitch_text(length=30, max_lines=4):
     glitch_text = "\n".join(glitch_parts)
     return f"```\n{glitch_text}\n```"
 
-def get_required_phrase(current_stage_key):
-    # V10.7: Sada proveravamo i 'prompt' za tranzitne faze
-    current_stage = GAME_STAGES.get(current_stage_key)
-    if not current_stage:
-        return "Signal se gubi..."
+def get_required_phrase(current_stage_key):
+    # V10.7: Sada proveravamo i 'prompt' za tranzitne faze (V10.74: izračunato pri prevođenju faza)
+    current_stage = stage_machine.get(current_stage_key)
+    if not current_stage:
+        return "Signal se gubi..."
+    return current_stage.required_phrase
+
+def get_time_warning_suffix(elapsed_seconds):
+    """V10.8: Generiše upozorenje o preostalom vremenu."""
+    remaining_seconds = TIME_LIMIT_SECONDS - elapsed_seconds
+    
+    if remaining_seconds <= 0:
+        return "" # Vreme je isteklo, završavamo igru
+    elif remaining_seconds <= 10:
+        # V10.9: Promena Kolektiv u GSA
+        return "\n\n**GSA JE NA LOKACIJI! NEMA VREMENA! Odgovori SADA!**"
+    elif remaining_seconds <= 60:
+        return "\n\n**CRVENI KOD! Manje od 60 sekundi! BRZO!**"
+    elif remaining_seconds <= 120:
+        return "\n\nVeza se gubi! Ostalo nam je manje od dve minute dok nas ne lociraju!"
+    else:
+        return "" # Bez upozorenja dok ne uđe u zonu opasnosti
+
+
+# ----------------------------------------------------
+# 5. ISPORUKA PORUKA (V10.64: Neblokirajući raspoređivač slanja)
+# ----------------------------------------------------
+
+# V10.64: Pauza "kucanja" (u sekundama) pre svakog dela niza / pojedinačne poruke
+# V10.81: PACING_ENABLED=0 isključuje veštačke pauze (benchmark, lokalni testovi)
+PACING_ENABLED = os.environ.get('PACING_ENABLED', '1') == '1'
+TYPING_DELAY_SEQUENCE = (1.0, 2.5) if PACING_ENABLED else (0.0, 0.0)
+TYPING_DELAY_SINGLE = (1.2, 2.8) if PACING_ENABLED else (0.0, 0.0)
+DELIVERY_WORKERS = int(os.environ.get('DELIVERY_WORKERS', '4'))
+DELIVERY_DRAIN_TIMEOUT = float(os.environ.get('DELIVERY_DRAIN_TIMEOUT', '10'))
+
+# V10.78: Ograničenje slanja ka Telegram Bot API-ju (oko 30 poruka/s ukupno, oko 1/s po chatu)
+TELEGRAM_GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', '30'))
+TELEGRAM_GLOBAL_BURST = int(os.environ.get('TELEGRAM_GLOBAL_BURST', '5'))
+TELEGRAM_CHAT_RATE = float(os.environ.get('TELEGRAM_CHAT_RATE', '1'))
+TELEGRAM_CHAT_BURST = int(os.environ.get('TELEGRAM_CHAT_BURST', '3'))
+TELEGRAM_MAX_RETRIES = int(os.environ.get('TELEGRAM_MAX_RETRIES', '3'))
+# Deljenje globalnog ograničenja između gunicorn radnika preko baze
+TELEGRAM_LIMIT_DB = os.environ.get('TELEGRAM_LIMIT_DB', '0') == '1'
+TELEGRAM_LIMIT_SYNC_INTERVAL = float(os.environ.get('TELEGRAM_LIMIT_SYNC_INTERVAL', '2.0'))
+TELEGRAM_CHAT_STATE_TTL = 300
+
+
+def get_retry_after(error):
+    """
+    Vraća retry_after (sekunde) iz Telegram 429 greške, ili None za druge greške.
+    V10.82: Prepoznaje i grešku asinhronog klijenta (telebot.asyncio_helper), druga klasa istog oblika.
+    """
+    if getattr(error, 'error_code', None) == 429 and hasattr(error, 'result_json'):
+        parameters = (error.result_json or {}).get('parameters') or {}
+        return int(parameters.get('retry_after', 1))
+    return None
+
+
+class TelegramRateLimiter:
+    """
+    V10.78: Zajednički limiter za sve pozive ka Telegramu iz procesa.
+
+    Leaky bucket u obliku virtuelnog rasporeda (GCRA): svaki poziv rezerviše
+    sledeći slobodan termin - globalni (1/TELEGRAM_GLOBAL_RATE) i po chatu
+    (1/TELEGRAM_CHAT_RATE), uz dozvoljen kratak nalet (*_BURST) - pa čeka do tog
+    termina. Rezervacija je pod zaključavanjem, a čekanje van njega.
+
+    Telegram u 429 odgovoru ne kaže da li je ograničenje globalno ili po chatu;
+    privatni chatovi sa pauzama 'kucanja' retko dostižu ograničenje po chatu, pa
+    retry_after zaustavlja sva slanja. Sa TELEGRAM_LIMIT_DB=1 radnici se javljaju
+    u tabelu outbound_workers: globalna brzina se deli na broj živih radnika, a
+    blokada posle 429 važi za sve radnike.
+    """
+
+    def __init__(self, global_rate=TELEGRAM_GLOBAL_RATE, global_burst=TELEGRAM_GLOBAL_BURST,
+                 chat_rate=TELEGRAM_CHAT_RATE, chat_burst=TELEGRAM_CHAT_BURST, use_db=TELEGRAM_LIMIT_DB):
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.chat_interval = 1.0 / chat_rate
+        self.chat_burst = chat_burst
+        self.use_db = use_db
+        self._lock = threading.Lock()
+        self._global_tat = 0.0        # teorijsko vreme dolaska (GCRA) - globalno
+        self._chat_tat = {}           # chat_id -> teorijsko vreme dolaska
+        self._blocked_until = 0.0     # monotono vreme do kog je slanje zaustavljeno (429)
+        self._published_block = 0     # epoch sekunde blokade koju javljamo ostalim radnicima
+        self._wake = threading.Event()
+        self._pid = None
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.peers = 1
+        self.calls = 0
+        self.throttled = 0
+        self.waiting = 0
+        self.peak_waiting = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.rate_limited = 0
+        self.retries = 0
+
+    @property
+    def global_interval(self):
+        return self.peers / self.global_rate
+
+    def _ensure_started(self):
+        # Lenjo pokretanje (i ponovo posle fork-a gunicorn radnika)
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        if self.use_db:
+            threading.Thread(target=self._run, name='telegram-limit-sync', daemon=True).start()
+
+    @staticmethod
+    def _reserve(tat, interval, burst, not_before):
+        """GCRA: najraniji termin >= not_before koji poštuje interval i nalet; vraća (termin, novi tat)."""
+        slot = max(not_before, tat - interval * (burst - 1))
+        return slot, max(tat, slot) + interval
+
+    def reserve(self, chat_id=None):
+        """
+        Rezerviše termin za jedan poziv ka Telegramu i vraća koliko treba sačekati (s), bez čekanja.
+        Bez chat_id važi samo globalno ograničenje (npr. akcija 'typing' nije poruka u chatu).
+        Posle pozitivnog čekanja pozivalac javlja kraj preko finish_wait() (V10.82: ASGI režim).
+        """
+        with self._lock:
+            self._ensure_started()
+            now = time.monotonic()
+            not_before = max(now, self._blocked_until)
+            slot, _ = self._reserve(self._global_tat, self.global_interval, self.global_burst, not_before)
+            if chat_id is not None:
+                chat_id = str(chat_id)
+                chat_tat = self._chat_tat.get(chat_id, 0.0)
+                slot, self._chat_tat[chat_id] = self._reserve(chat_tat, self.chat_interval, self.chat_burst, slot)
+            # Globalni termin se rezerviše tek kada je poznat i termin chata
+            slot, self._global_tat = self._reserve(self._global_tat, self.global_interval, self.global_burst, slot)
+
+            wait = slot - now
+            self.calls += 1
+            if wait > 0:
+                self.throttled += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                self.waiting += 1
+                self.peak_waiting = max(self.peak_waiting, self.waiting)
+            if len(self._chat_tat) > 1000 and self.calls % 1000 == 0:
+                self._chat_tat = {key: tat for key, tat in self._chat_tat.items() if tat > now - TELEGRAM_CHAT_STATE_TTL}
+        return max(wait, 0.0)
+
+    def finish_wait(self):
+        with self._lock:
+            self.waiting -= 1
+
+    def acquire(self, chat_id=None):
+        """Čeka na slobodan termin za jedan poziv ka Telegramu. Vraća vreme čekanja u sekundama."""
+        wait = self.reserve(chat_id)
+        if wait > 0:
+            time.sleep(wait)
+            self.finish_wait()
+        return wait
+
+    def block(self, retry_after):
+        """Telegram je vratio 429: niko ne šalje narednih retry_after sekundi."""
+        with self._lock:
+            self.rate_limited += 1
+            self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+            self._published_block = max(self._published_block, int(math.ceil(time.time() + retry_after)))
+        logging.warning(f"Telegram 429: slanje zaustavljeno na {retry_after}s.")
+        self._wake.set()
+
+    def _sync_with_peers(self):
+        now = int(time.time())
+        session = Session()
+        try:
+            session.merge(OutboundWorker(worker_id=self.worker_id, heartbeat_at=now, blocked_until=self._published_block))
+            alive_since = now - int(3 * TELEGRAM_LIMIT_SYNC_INTERVAL) - 1
+            live = (session.query(OutboundWorker.blocked_until)
+                    .filter(OutboundWorker.heartbeat_at >= alive_since).all())
+            session.query(OutboundWorker).filter(OutboundWorker.heartbeat_at < now - 60).delete(synchronize_session=False)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+        blocked_until = max((blocked or 0 for (blocked,) in live), default=0)
+        with self._lock:
+            self.peers = max(1, len(live))
+            if blocked_until > time.time():
+                self._blocked_until = max(self._blocked_until, time.monotonic() + blocked_until - time.time())
+
+    def _run(self):
+        while True:
+            self._wake.wait(TELEGRAM_LIMIT_SYNC_INTERVAL)
+            self._wake.clear()
+            if Session is None:
+                continue
+            try:
+                self._sync_with_peers()
+            except Exception as e:
+                logging.error(f"Neuspešna koordinacija ograničenja slanja preko baze: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'throttled': self.throttled,
+                'waiting': self.waiting,
+                'peak_waiting': self.peak_waiting,
+                'total_wait_seconds': round(self.total_wait, 3),
+                'max_wait_seconds': round(self.max_wait, 3),
+                'rate_limited_429': self.rate_limited,
+                'retries': self.retries,
+                'blocked_for_seconds': round(max(0.0, self._blocked_until - time.monotonic()), 3),
+                'peers': self.peers,
+            }
+
+
+telegram_limiter = TelegramRateLimiter()
+
+
+def telegram_call(chat_id, fn, /, *args, max_retries=TELEGRAM_MAX_RETRIES, **kwargs):
+    """
+    V10.78: Poziv Bot API-ja kroz limiter. Na 429 beleži blokadu i ponavlja poziv
+    (limiter čeka retry_after); ostale greške se prosleđuju pozivaocu. Prva dva
+    argumenta su samo pozicioni, pa fn može da primi i svoj chat_id=.
+    """
+    for attempt in range(max_retries + 1):
+        telegram_limiter.acquire(chat_id)
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except ApiTelegramException as e:
+            retry_after = get_retry_after(e)
+            if retry_after is None:
+                raise
+            telegram_limiter.block(retry_after)
+            if attempt == max_retries:
+                raise
+            telegram_limiter.retries += 1
+        finally:
+            TELEGRAM_SECONDS.observe(time.perf_counter() - started, fn.__name__)
+
+
+# V10.83: Tekstovi se pišu u jednostavnom Markdownu (**podebljano**, *kurziv*, `kod`, ```blok```)
+# i lokalno prevode u MarkdownV2 sa svim obaveznim escape znacima. Tekst čiji Markdown nije
+# uparen ide kao običan tekst - Telegram ga nikad ne odbija, pa nema drugog poziva.
+MARKDOWN_V2_SPECIAL = re.compile(r'([_*\[\]()~`>#+\-=|{}.!\\])')
+MARKDOWN_V2_CODE_SPECIAL = re.compile(r'([`\\])')
+MARKDOWN_TOKENS = re.compile(
+    r'```\n?(?P<pre>.*?)```'
+    r'|`(?P<code>[^`\n]+)`'
+    r'|\*\*(?P<bold>[^\s*](?:[^\n]*?[^\s*])?)\*\*'
+    r'|\*(?P<italic>[^\s*](?:[^*\n]*?[^\s*])?)\*',
+    re.DOTALL
+)
+
+RenderedText = collections.namedtuple('RenderedText', ['text', 'parse_mode', 'source'])
+
+
+def plain_text(text):
+    return RenderedText(text, None, text)
+
+
+class MarkdownRenderer:
+    """
+    V10.83: Prevodi tekst poruke u MarkdownV2 (ili bira običan tekst) pre slanja.
+
+    Statički tekstovi (faze, epilozi) se proveravaju i prevode jednom pri pokretanju
+    (preload); AI odgovori i tekstovi sa upozorenjem se prevode pri slanju. Sve što
+    nije oznaka (tačka, crtica, zagrade, '_') se escape-uje, pa ni tekst modela ne
+    može da pokvari parsiranje.
+    """
+
+    def __init__(self):
+        self._static = {}
+        self.rendered_count = 0
+        self.plain_count = 0
+        self.static_hits = 0
+
+    @staticmethod
+    def _escape(text):
+        return MARKDOWN_V2_SPECIAL.sub(r'\\\1', text)
+
+    @staticmethod
+    def _convert(text):
+        """MarkdownV2 tekst, ili None kada oznake nisu uparene (npr. usamljena '*')."""
+        out = []
+        position = 0
+        for match in MARKDOWN_TOKENS.finditer(text):
+            between = text[position:match.start()]
+            if '*' in between or '`' in between:
+                return None
+            out.append(MarkdownRenderer._escape(between))
+            kind = match.lastgroup
+            inner = match.group(kind)
+            if kind == 'pre':
+                out.append("```\n" + MARKDOWN_V2_CODE_SPECIAL.sub(r'\\\1', inner) + "```")
+            elif kind == 'code':
+                out.append("`" + MARKDOWN_V2_CODE_SPECIAL.sub(r'\\\1', inner) + "`")
+            elif kind == 'bold':
+                out.append("*" + MarkdownRenderer._escape(inner) + "*")
+            else:
+                out.append("_" + MarkdownRenderer._escape(inner) + "_")
+            position = match.end()
+        rest = text[position:]
+        if '*' in rest or '`' in rest:
+            return None
+        out.append(MarkdownRenderer._escape(rest))
+        return "".join(out)
+
+    def render(self, text):
+        rendered = self._static.get(text)
+        if rendered is not None:
+            self.static_hits += 1
+            return rendered
+        return self._render(text)
+
+    def _render(self, text):
+        converted = self._convert(text)
+        if converted is None:
+            self.plain_count += 1
+            return plain_text(text)
+        self.rendered_count += 1
+        return RenderedText(converted, 'MarkdownV2', text)
+
+    def preload(self, texts):
+        """Pri pokretanju: prevodi statičke tekstove i upozorava na one sa neuparenim oznakama."""
+        for text in texts:
+            if not text or text in self._static:
+                continue
+            rendered = self._render(text)
+            if rendered.parse_mode is None:
+                logging.warning(f"Statički tekst nema ispravan Markdown i šalje se kao običan tekst: {text[:60]!r}")
+            self._static[text] = rendered
+        logging.info(f"Pripremljeno {len(self._static)} statičkih tekstova (MarkdownV2).")
+
+    def stats(self):
+        return {'static': len(self._static), 'static_hits': self.static_hits,
+                'rendered': self.rendered_count, 'plain': self.plain_count}
+
+
+markdown_renderer = MarkdownRenderer()
+
+
+def static_message_texts():
+    """Svi tekstovi koji se šalju bez izmene: faze, epilozi i stalne poruke."""
+    for stage in stage_machine.stages.values():
+        yield from stage.text
+    yield from END_MESSAGES.values()
+    yield TIME_LIMIT_MESSAGE
+
+
+class OutboundPart:
+    """
+    V10.64: Jedan deo izlazne sekvence - tekst i pauza 'kucanja' pre slanja.
+    V10.83: Tekst se prevodi (MarkdownV2 ili običan) već pri pravljenju dela.
+    """
+    __slots__ = ('text', 'rendered', 'delay', 'typing_sent')
+
+    def __init__(self, text, delay):
+        self.text = text
+        self.rendered = markdown_renderer.render(text)
+        self.delay = delay
+        self.typing_sent = False
+
+
+class DeliveryScheduler:
+    """
+    V10.64: Isporučuje sekvence poruka iz pozadine umesto iz webhook zahteva.
+
+    Svaki chat ima svoju traku (FIFO), pa je redosled unutar chata očuvan, dok se
+    različiti chatovi isporučuju paralelno. Pauza 'kucanja' ne drži radnu nit
+    (nema time.sleep) - deo se samo ponovo zakazuje u heap-u za kasnije.
+    """
+
+    def __init__(self, workers=DELIVERY_WORKERS):
+        self._cond = threading.Condition()
+        self._lanes = {}   # chat_id -> deque[OutboundPart]; postoji dok chat ima posla
+        self._heap = []    # (rok, redni_broj, chat_id) - najviše jedan unos po chatu
+        self._seq = itertools.count()
+        self._workers = workers
+        self._executor = None
+        self._thread = None
+        self._pid = None
+        self.sent_count = 0
+        self.failed_count = 0
+
+    def _ensure_started(self):
+        # Lenjo pokretanje (i ponovo posle fork-a gunicorn radnika)
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='delivery')
+        self._thread = threading.Thread(target=self._run, name='delivery-scheduler', daemon=True)
+        self._thread.start()
+
+    def _schedule(self, chat_id, due):
+        heapq.heappush(self._heap, (due, next(self._seq), chat_id))
+        self._cond.notify_all()
+
+    def submit(self, chat_id, parts: List[OutboundPart]):
+        if not parts:
+            return
+        with self._cond:
+            self._ensure_started()
+            lane = self._lanes.get(chat_id)
+            if lane is None:
+                # Traka je bila prazna - chat odmah ulazi u raspored
+                self._lanes[chat_id] = collections.deque(parts)
+                self._schedule(chat_id, time.monotonic())
+            else:
+                # Traka je aktivna - delovi čekaju iza prethodnih (redosled po chatu)
+                lane.extend(parts)
+
+    def pending_count(self):
+        with self._cond:
+            return sum(len(lane) for lane in self._lanes.values())
+
+    def wait_idle(self, chat_id, timeout=DELIVERY_DRAIN_TIMEOUT):
+        """V10.70: Čeka da traka jednog chata bude prazna (npr. pre strimovanog odgovora)."""
+        with self._cond:
+            return self._cond.wait_for(lambda: chat_id not in self._lanes, timeout=timeout)
+
+    def drain(self, timeout=DELIVERY_DRAIN_TIMEOUT):
+        """Čeka da se sve trake isprazne (gašenje radnika, testovi). Vraća True ako je sve poslato."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._lanes:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    timeout = (self._heap[0][0] - time.monotonic()) if self._heap else None
+                    self._cond.wait(timeout)
+                _, _, chat_id = heapq.heappop(self._heap)
+                part = self._lanes[chat_id][0]
+            try:
+                self._executor.submit(self._step, chat_id, part)
+            except RuntimeError:
+                # Gašenje interpretera zatvara izvršioca pre atexit drain-a - šaljemo iz ove niti
+                self._step(chat_id, part)
+
+    def _step(self, chat_id, part):
+        next_due = time.monotonic()
+        done = False
+        sent = False
+        try:
+            if not part.typing_sent and part.delay > 0:
+                # Prvi korak: akcija 'kucanja', pa se slanje zakazuje posle pauze
+                part.typing_sent = True
+                next_due += part.delay
+                try:
+                    telegram_call(None, bot.send_chat_action, chat_id, 'typing', max_retries=0)
+                except Exception as e:
+                    logging.warning(f"Neuspešna akcija 'typing' za {chat_id}: {e}")
+            else:
+                done = True
+                sent = send_text_with_fallback(chat_id, part.rendered)
+        except Exception as e:
+            done = True
+            logging.error(f"Greška u isporuci poruke za {chat_id}: {e}")
+        finally:
+            with self._cond:
+                lane = self._lanes[chat_id]
+                if done:
+                    lane.popleft()
+                    if sent:
+                        self.sent_count += 1
+                    else:
+                        self.failed_count += 1
+                if lane:
+                    self._schedule(chat_id, next_due)
+                else:
+                    del self._lanes[chat_id]
+                    self._cond.notify_all()
+
+
+delivery = DeliveryScheduler()
+# Pri gašenju radnika pokušavamo da isporučimo ono što je već u redu
+atexit.register(delivery.drain)
+
+
+def send_text_with_fallback(chat_id, rendered):
+    """
+    Šalje jednu prevedenu poruku (RenderedText); na grešku parsiranja ponavlja bez Markdowna.
+    V10.83: Tekst je preveden lokalno, pa se ponovljeno slanje očekuje samo kao izuzetak.
+    """
+    try:
+        telegram_call(chat_id, bot.send_message, chat_id, rendered.text, parse_mode=rendered.parse_mode)
+        return True
+    except Exception as e:
+        # V10.6: Dodata provera za Bad Request (Markdown greške)
+        if rendered.parse_mode and "Bad Request: can't parse entities" in str(e):
+            logging.error(f"Greška Markdown formatiranja. Pokušavam slanje bez Markdowna: {str(e)}")
+            MARKDOWN_RETRIES.inc('send')
+            try:
+                # Pokušaj bez Markdowna (V10.64: samo za deo koji nije prošao)
+                telegram_call(chat_id, bot.send_message, chat_id, rendered.source, parse_mode=None)
+                return True
+            except Exception as e2:
+                logging.error(f"Neuspešno slanje ni bez Markdowna: {e2}")
+        else:
+            logging.error(f"Greška pri slanju poruke: {e}")
+        return False
+
+
+def build_outbound_parts(text: Union[str, List[str]], add_warning=False, elapsed_time=0):
+    """V10.82: Sekvenca delova sa pauzama 'kucanja' (deli je send_msg i ASGI isporuka)."""
+    # V10.8: Dodavanje upozorenja na poslednju poruku u sekvenci
+    warning_suffix = ""
+    if add_warning and elapsed_time > 0:
+        warning_suffix = get_time_warning_suffix(elapsed_time)
+
+    if isinstance(text, list):
+        texts, delay_range = text, TYPING_DELAY_SEQUENCE
+    else:
+        texts, delay_range = [text], TYPING_DELAY_SINGLE
+
+    parts = []
+    for i, part in enumerate(texts):
+        final_part = part
+        # Dodaje upozorenje samo na poslednju poruku u nizu
+        if i == len(texts) - 1:
+            final_part += warning_suffix
+        parts.append(OutboundPart(final_part, random.uniform(*delay_range)))
+    return parts
+
+
+def send_msg(message, text: Union[str, List[str]], add_warning=False, elapsed_time=0):
+    """
+    V10.64: Ne šalje direktno - pakuje sekvencu sa pauzama 'kucanja' i predaje je
+    raspoređivaču, tako da se handler vraća odmah.
+    """
+    if not bot: return
+    delivery.submit(message.chat.id, build_outbound_parts(text, add_warning, elapsed_time))
+
+# V10.70: Strimovani AI odgovori - prva poruka odmah, zatim izmene najviše jednom u intervalu
+GEMINI_STREAMING = os.environ.get('GEMINI_STREAMING', '0') == '1'
+STREAM_EDIT_INTERVAL = float(os.environ.get('STREAM_EDIT_INTERVAL', '1.5'))
+
+
+def edit_text_with_fallback(chat_id, message_id, rendered, max_retries=0):
+    """V10.70: Izmena poruke; na grešku parsiranja ponavlja bez Markdowna. Vraća True ako je izmena prošla."""
+    try:
+        telegram_call(chat_id, bot.edit_message_text, rendered.text, chat_id=chat_id, message_id=message_id,
+                      parse_mode=rendered.parse_mode, max_retries=max_retries)
+        return True
+    except Exception as e:
+        if "message is not modified" in str(e):
+            return True
+        if rendered.parse_mode and "Bad Request: can't parse entities" in str(e):
+            logging.error(f"Greška Markdown formatiranja pri izmeni. Pokušavam bez Markdowna: {str(e)}")
+            MARKDOWN_RETRIES.inc('edit')
+            return edit_text_with_fallback(chat_id, message_id, plain_text(rendered.source), max_retries=max_retries)
+        raise
+
+
+class StreamedReply:
+    """
+    V10.70: Isporuka jednog strimovanog odgovora u chat.
+
+    Prvi deo teksta se šalje kao nova poruka čim stigne, a ostatak se dopisuje
+    izmenama (edit_message_text) najviše jednom u STREAM_EDIT_INTERVAL sekundi.
+    Međukoraci idu kao običan tekst (nedovršen Markdown bi pao), a tek završna
+    izmena - sa upozorenjem o vremenu - se prevodi (V10.83: MarkdownV2 ili običan tekst).
+    """
+
+    def __init__(self, chat_id, warning_suffix=""):
+        self.chat_id = chat_id
+        self.warning_suffix = warning_suffix
+        self.text = ""
+        self.message_id = None
+        self._shown = ""
+        self._next_edit_at = 0.0
+
+    @property
+    def started(self):
+        return self.message_id is not None
+
+    def feed(self, chunk):
+        self.text += chunk
+        now = time.monotonic()
+        if not self.started:
+            if self.text.strip():
+                sent = telegram_call(self.chat_id, bot.send_message, self.chat_id, self.text.strip(), parse_mode=None)
+                self.message_id = sent.message_id
+                self._shown = self.text
+                self._next_edit_at = now + STREAM_EDIT_INTERVAL
+        elif now >= self._next_edit_at and self.text != self._shown:
+            self._edit(plain_text(self.text.strip()), now=now)
+
+    def finish(self, final_text=None):
+        """Završna izmena: ceo tekst (ili zamenski tekst posle greške) + upozorenje."""
+        final = (final_text if final_text is not None else self.text.strip()) + self.warning_suffix
+        if final != self._shown:
+            self._edit(markdown_renderer.render(final), now=time.monotonic(), final=True)
+
+    def _edit(self, rendered, now, final=False):
+        try:
+            # V10.78: Završna izmena ne sme da se izgubi - limiter čeka retry_after i ponavlja
+            edit_text_with_fallback(self.chat_id, self.message_id, rendered,
+                                    max_retries=TELEGRAM_MAX_RETRIES if final else 0)
+            self._shown = rendered.source
+            self._next_edit_at = now + STREAM_EDIT_INTERVAL
+        except Exception as e:
+            retry_after = get_retry_after(e)
+            if retry_after is None or final:
+                logging.error(f"Greška pri izmeni strimovane poruke: {e}")
+                return
+            self._next_edit_at = now + retry_after
+
+
+def deliver_stream(chat_id, chunks, fallback_text, warning_suffix=""):
+    """
+    V10.70: Strimuje AI odgovor u chat. Vraća (tekst, isporučeno).
+
+    Ako greška nastane pre prve poruke, ništa nije poslato i pozivalac šalje
+    rezervni odgovor na uobičajen način. Ako nastane usred strima, poslata
+    poruka se menja u rezervni tekst.
+    """
+    # Prethodne poruke istog chata moraju stići pre odgovora
+    delivery.wait_idle(chat_id)
+    try:
+        telegram_call(None, bot.send_chat_action, chat_id, 'typing', max_retries=0)
+    except Exception as e:
+        logging.warning(f"Neuspešna akcija 'typing' za {chat_id}: {e}")
+
+    reply = StreamedReply(chat_id, warning_suffix)
+    try:
+        for chunk in chunks:
+            reply.feed(chunk)
+    except Exception:
+        if not reply.started:
+            raise
+        logging.error("AI strim prekinut usred odgovora. Poruka se menja u rezervni tekst.")
+        reply.finish(fallback_text)
+        return fallback_text, True
+
+    if not reply.started:
+        return "", False
+    reply.finish()
+    return reply.text.strip(), True
+
+
+# ----------------------------------------------------
+# 5.1 AI SLOJ (V10.67: Async Gemini sa ograničenjem i rokom po pozivu)
+# ----------------------------------------------------
+
+AI_FALLBACK_MESSAGES = ["Veza je nestabilna. Ponavljaj poruku.", "Čujem samo šum… ponovi!"]
+
+# V10.67: Najviše istovremenih poziva ka Gemini-ju po procesu
+GEMINI_MAX_CONCURRENCY = int(os.environ.get('GEMINI_MAX_CONCURRENCY', '8'))
+# Gornja granica trajanja jednog poziva i deo vremena igre koji uvek ostavljamo igraču
+GEMINI_TIMEOUT_SECONDS = float(os.environ.get('GEMINI_TIMEOUT_SECONDS', '20'))
+GEMINI_TIME_RESERVE_SECONDS = float(os.environ.get('GEMINI_TIME_RESERVE_SECONDS', '10'))
+GEMINI_MIN_DEADLINE_SECONDS = 1.5
+
+
+# V10.88: Prekidač kola oko Gemini poziva - kada je Gemini degradiran, rezervni odgovor ide odmah
+GEMINI_BREAKER_ENABLED = os.environ.get('GEMINI_BREAKER', '1') == '1'
+GEMINI_BREAKER_WINDOW_SECONDS = float(os.environ.get('GEMINI_BREAKER_WINDOW_SECONDS', '20'))
+# Najmanje poziva u prozoru pre odluke i udeo neuspešnih (greška, rok ili spor odgovor) koji otvara kolo
+GEMINI_BREAKER_MIN_CALLS = int(os.environ.get('GEMINI_BREAKER_MIN_CALLS', '10'))
+GEMINI_BREAKER_FAILURE_RATE = float(os.environ.get('GEMINI_BREAKER_FAILURE_RATE', '0.5'))
+# Uzastopni neuspesi otvaraju kolo odmah, i kada je prozor pun ranijih uspeha
+GEMINI_BREAKER_CONSECUTIVE_FAILURES = int(os.environ.get('GEMINI_BREAKER_CONSECUTIVE_FAILURES', '5'))
+GEMINI_BREAKER_SLOW_SECONDS = float(os.environ.get('GEMINI_BREAKER_SLOW_SECONDS', '8'))
+# Koliko dugo je kolo otvoreno pre probnih poziva i koliko uspešnih proba ga zatvara
+GEMINI_BREAKER_OPEN_SECONDS = float(os.environ.get('GEMINI_BREAKER_OPEN_SECONDS', '15'))
+GEMINI_BREAKER_PROBES = int(os.environ.get('GEMINI_BREAKER_PROBES', '2'))
+# Proba bez ishoda duže od ovoga (izgubljen record) oslobađa mesto - kolo ne ostaje zaglavljeno u half_open
+GEMINI_BREAKER_PROBE_TIMEOUT_SECONDS = float(
+    os.environ.get('GEMINI_BREAKER_PROBE_TIMEOUT_SECONDS', str(GEMINI_TIMEOUT_SECONDS + 5))
+)
+
+# V10.88: Zaštitni (hedged) poziv - drugi zahtev posle p95 kašnjenja, pobeđuje prvi odgovor
+GEMINI_HEDGE_ENABLED = os.environ.get('GEMINI_HEDGE', '0') == '1'
+GEMINI_HEDGE_PERCENTILE = float(os.environ.get('GEMINI_HEDGE_PERCENTILE', '95'))
+GEMINI_HEDGE_MIN_DELAY = float(os.environ.get('GEMINI_HEDGE_MIN_DELAY', '0.3'))
+# Najviše zaštitnih poziva kao udeo svih poziva (dodatni trošak je ograničen)
+GEMINI_HEDGE_MAX_RATIO = float(os.environ.get('GEMINI_HEDGE_MAX_RATIO', '0.1'))
+GEMINI_HEDGE_MIN_SAMPLES = 20
+GEMINI_LATENCY_SAMPLES = 200
+
+BREAKER_STATES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+
+class CircuitOpenError(Exception):
+    """V10.88: Kolo je otvoreno - Gemini se ne poziva, igrač odmah dobija rezervni odgovor."""
+
+
+class CircuitBreaker:
+    """
+    V10.88: Prekidač sa kliznim prozorom ishoda Gemini poziva.
+
+    'closed': pozivi prolaze; kada u poslednjih window sekundi bude bar min_calls
+    poziva i udeo neuspešnih (greška, istek roka ili sporije od slow_seconds)
+    dostigne failure_rate, ili kada `consecutive` poziva zaredom ne uspe, kolo
+    se otvara. 'open': pozivi se odbijaju odmah
+    (CircuitOpenError) do isteka open_seconds. 'half_open': propušta najviše
+    `probes` istovremenih probnih poziva; toliko uspešnih zatvara kolo, a prvi
+    neuspešan ga ponovo otvara. Probe bez ishoda duže od probe_timeout se
+    smatraju izgubljenim i njihova mesta se oslobađaju.
+    """
+
+    def __init__(self, enabled=GEMINI_BREAKER_ENABLED, window=GEMINI_BREAKER_WINDOW_SECONDS,
+                 min_calls=GEMINI_BREAKER_MIN_CALLS, failure_rate=GEMINI_BREAKER_FAILURE_RATE,
+                 consecutive=GEMINI_BREAKER_CONSECUTIVE_FAILURES, slow_seconds=GEMINI_BREAKER_SLOW_SECONDS,
+                 open_seconds=GEMINI_BREAKER_OPEN_SECONDS, probes=GEMINI_BREAKER_PROBES,
+                 probe_timeout=GEMINI_BREAKER_PROBE_TIMEOUT_SECONDS):
+        self.enabled = enabled
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.consecutive = consecutive
+        self.slow_seconds = slow_seconds
+        self.open_seconds = open_seconds
+        self.probes = probes
+        self.probe_timeout = probe_timeout
+        self._lock = threading.Lock()
+        self._outcomes = collections.deque()  # (vreme, neuspešan)
+        self._failures = 0
+        self._streak = 0  # uzastopni neuspesi
+        self.state = 'closed'
+        self._open_until = 0.0
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        self._probe_started = 0.0  # kada je dodeljena poslednja proba
+        self.rejected = 0
+        self.trips = 0
+
+    def _transition(self, state, now):
+        self.state = state
+        if state == 'open':
+            self._open_until = now + self.open_seconds
+            self.trips += 1
+        self._outcomes.clear()
+        self._failures = 0
+        self._streak = 0
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        GEMINI_BREAKER_TRANSITIONS.inc(state)
+
+    def is_open(self):
+        """Brza provera pre pripreme poziva (bez zauzimanja probnog mesta)."""
+        return self.enabled and self.state == 'open' and time.monotonic() < self._open_until
+
+    def is_healthy(self):
+        """Zatvoreno kolo bez skorašnjih neuspeha - samo tada hedging sme da doda zahtev."""
+        if not self.enabled:
+            return True
+        with self._lock:
+            total = len(self._outcomes)
+            return (self.state == 'closed' and self._streak == 0
+                    and (not total or self._failures < self.failure_rate / 2 * total))
+
+    def acquire(self):
+        """Pre poziva: vraća True za probni poziv, False za običan; podiže CircuitOpenError."""
+        if not self.enabled:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            if self.state == 'open' and now >= self._open_until:
+                self._transition('half_open', now)
+                logging.info("Gemini prekidač: probni pozivi (half-open).")
+            if self.state == 'closed':
+                return False
+            if (self.state == 'half_open' and self._probes_in_flight >= self.probes
+                    and now - self._probe_started >= self.probe_timeout):
+                logging.warning(f"Gemini prekidač: {self._probes_in_flight} proba bez ishoda "
+                                f"{self.probe_timeout:.0f}s, mesta se oslobađaju.")
+                self._probes_in_flight = 0
+            if self.state == 'half_open' and self._probes_in_flight < self.probes:
+                self._probes_in_flight += 1
+                self._probe_started = now
+                return True
+            self.rejected += 1
+        raise CircuitOpenError("Gemini prekidač je otvoren.")
+
+    def record(self, ok, latency, probe=False):
+        if not self.enabled:
+            return
+        failed = not ok or latency >= self.slow_seconds
+        now = time.monotonic()
+        with self._lock:
+            if probe:
+                if self.state != 'half_open':
+                    return  # Kolo je u međuvremenu promenilo stanje
+                # Zakasneli ishod probe čije je mesto već oslobođeno ne spušta brojač ispod nule
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                if failed:
+                    self._transition('open', now)
+                    logging.warning(f"Gemini prekidač: proba neuspešna, ponovo otvoren na {self.open_seconds:.0f}s.")
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.probes:
+                        self._transition('closed', now)
+                        logging.info("Gemini prekidač zatvoren - Gemini ponovo odgovara.")
+                return
+            if self.state != 'closed':
+                return  # Zakasneli ishod poziva započetog pre otvaranja
+            self._outcomes.append((now, failed))
+            self._failures += failed
+            self._streak = self._streak + 1 if failed else 0
+            while self._outcomes and self._outcomes[0][0] < now - self.window:
+                self._failures -= self._outcomes.popleft()[1]
+            total = len(self._outcomes)
+            if self._streak >= self.consecutive or (total >= self.min_calls
+                                                    and self._failures >= self.failure_rate * total):
+                failures, streak = self._failures, self._streak
+                self._transition('open', now)
+                logging.warning(
+                    f"Gemini prekidač otvoren: {failures}/{total} neuspešnih poziva za {self.window:.0f}s "
+                    f"({streak} zaredom). Rezervni odgovori narednih {self.open_seconds:.0f}s."
+                )
+
+    def stats(self):
+        with self._lock:
+            total = len(self._outcomes)
+            return {
+                'state': BREAKER_STATES[self.state],
+                'window_calls': total,
+                'window_failure_rate': (self._failures / total) if total else 0.0,
+                'rejected': self.rejected,
+                'trips': self.trips,
+            }
+
+
+def consume_task_result(task):
+    # Poraženi zaštitni poziv se otkazuje ili pada - njegova greška nije za log
+    if not task.cancelled():
+        task.exception()
+
+
+class AsyncAIGateway:
+    """
+    V10.67: Gemini pozivi preko async klijenta (client.aio) u zasebnoj event petlji.
+
+    Sinhroni handleri predaju korutinu petlji i čekaju rezultat najduže do roka.
+    Semafor ograničava broj poziva u letu; po isteku roka poziv se otkazuje
+    (čekanje na semafor se računa u rok).
+    V10.88: Svaki poziv prolazi kroz prekidač kola, a uz hedging se posle p95
+    kašnjenja pojedinačnog zahteva šalje i drugi, pa pobeđuje prvi odgovor.
+    """
+
+    def __init__(self, max_concurrency=GEMINI_MAX_CONCURRENCY, breaker=None, hedging=GEMINI_HEDGE_ENABLED):
+        self.max_concurrency = max_concurrency
+        self.breaker = breaker or CircuitBreaker()
+        self.hedging = hedging
+        self._lock = threading.Lock()
+        self._loop = None
+        self._semaphore = None
+        self._pid = None
+        self._latencies = collections.deque(maxlen=GEMINI_LATENCY_SAMPLES)
+        # p95 se računa u petlji (jedina nit koja menja _latencies); ostale niti čitaju gotovu vrednost
+        self._latency_percentile = None
+        self.in_flight = 0
+        self.calls = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.rejected = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def _ensure_loop(self):
+        # Lenjo pokretanje (i ponovo posle fork-a gunicorn radnika)
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._loop = asyncio.new_event_loop()
+                self._semaphore = asyncio.Semaphore(self.max_concurrency)
+                threading.Thread(target=self._loop.run_forever, name='ai-loop', daemon=True).start()
+            return self._loop
+
+    def attach_loop(self, loop):
+        """
+        V10.82: ASGI režim - pozivi idu kroz event petlju servera (generate_async),
+        a sinhroni pozivi iz pozadinskih niti se predaju istoj petlji.
+        """
+        with self._lock:
+            self._pid = os.getpid()
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def _generate(self, contents, config):
+        async with self._semaphore:
+            self.in_flight += 1
+            started = time.perf_counter()
+            try:
+                response = await get_ai_client().aio.models.generate_content(
+                    model=GEMINI_MODEL_NAME,
+                    contents=contents,
+                    config=config
+                )
+                # Trajanje pojedinačnog zahteva (bez čekanja na semafor) - osnova za kašnjenje hedging-a
+                self._record_latency(time.perf_counter() - started)
+                return response
+            finally:
+                self.in_flight -= 1
+
+    def _record_latency(self, seconds):
+        # Samo iz petlje - /metrics nit ne sme da iterira deque dok se menja
+        self._latencies.append(seconds)
+        if len(self._latencies) >= GEMINI_HEDGE_MIN_SAMPLES:
+            ordered = sorted(self._latencies)
+            self._latency_percentile = ordered[min(len(ordered) - 1, int(len(ordered) * GEMINI_HEDGE_PERCENTILE / 100.0))]
+
+    def hedge_delay(self):
+        """Posle koliko sekundi ide zaštitni poziv (None = bez hedging-a). Bezbedno iz bilo koje niti."""
+        percentile = self._latency_percentile
+        if not self.hedging or percentile is None or not self.breaker.is_healthy():
+            return None
+        return max(GEMINI_HEDGE_MIN_DELAY, percentile)
+
+    async def _hedged(self, contents, config, delay):
+        primary = asyncio.ensure_future(self._generate(contents, config))
+        primary.add_done_callback(consume_task_result)
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            # Drugi zahtev samo dok ima slobodnih mesta i u okviru dozvoljenog udela
+            if done or self.in_flight >= self.max_concurrency or self.hedges >= GEMINI_HEDGE_MAX_RATIO * self.calls:
+                return await primary
+            self.hedges += 1
+            backup = asyncio.ensure_future(self._generate(contents, config))
+            backup.add_done_callback(consume_task_result)
+            tasks.add(backup)
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is backup:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in (primary, *tasks):
+                task.cancel()
+
+    async def _guarded(self, contents, config):
+        """Poziv kroz prekidač; istek roka (otkazivanje) se računa kao neuspeh."""
+        probe = self.breaker.acquire()
+        started = time.perf_counter()
+        ok = False
+        try:
+            # Probni poziv ide sam - njegov ishod odlučuje o zatvaranju kola
+            delay = None if probe else self.hedge_delay()
+            if delay is None:
+                response = await self._generate(contents, config)
+            else:
+                response = await self._hedged(contents, config, delay)
+            ok = True
+            return response
+        finally:
+            self.breaker.record(ok, time.perf_counter() - started, probe)
+
+    def generate(self, contents, deadline, config=None):
+        """Vraća Gemini odgovor ili podiže TimeoutError kada rok istekne (poziv se otkazuje)."""
+        loop = self._ensure_loop()
+        self.calls += 1
+        started = time.perf_counter()
+        outcome = 'error'
+        future = asyncio.run_coroutine_threadsafe(
+            asyncio.wait_for(self._guarded(contents, config), timeout=deadline), loop
+        )
+        try:
+            # Mala rezerva iznad roka - wait_for u petlji je taj koji otkazuje poziv
+            response = future.result(timeout=deadline + 1.0)
+            outcome = 'ok'
+            return response
+        except TimeoutError:
+            future.cancel()
+            self.timeouts += 1
+            outcome = 'timeout'
+            raise
+        except CircuitOpenError:
+            self.rejected += 1
+            outcome = 'rejected'
+            raise
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            GEMINI_SECONDS.observe(time.perf_counter() - started, 'generate', outcome)
+
+    async def generate_async(self, contents, deadline, config=None):
+        """V10.82: Isto što i generate(), kao korutina u petlji iz attach_loop()."""
+        self.calls += 1
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            response = await asyncio.wait_for(self._guarded(contents, config), timeout=deadline)
+            outcome = 'ok'
+            return response
+        except TimeoutError:
+            self.timeouts += 1
+            outcome = 'timeout'
+            raise
+        except CircuitOpenError:
+            self.rejected += 1
+            outcome = 'rejected'
+            raise
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            GEMINI_SECONDS.observe(time.perf_counter() - started, 'generate', outcome)
+
+    def stream(self, contents, deadline, config=None, on_usage=None):
+        """
+        V10.70: Sinhroni generator delova teksta iz generate_content_stream.
+        Rok važi za ceo strim; po isteku podiže TimeoutError i otkazuje poziv.
+        V10.87: on_usage dobija usage_metadata poslednjeg dela strima (zbir za ceo poziv).
+        V10.88: Prekidač meri vreme do prvog dela teksta; strim se ne duplira (hedging).
+        """
+        loop = self._ensure_loop()
+        self.calls += 1
+        chunks = queue.Queue()
+        end_of_stream = object()
+
+        async def pump():
+            probe = self.breaker.acquire()
+            started = time.perf_counter()
+            first_chunk_after = None
+            # Ishod se beleži i kada je poziv otkazan još na semaforu (inače probno mesto ostaje zauzeto)
+            try:
+                async with self._semaphore:
+                    self.in_flight += 1
+                    try:
+                        stream = await get_ai_client().aio.models.generate_content_stream(
+                            model=GEMINI_MODEL_NAME,
+                            contents=contents,
+                            config=config
+                        )
+                        usage = None
+                        async for chunk in stream:
+                            usage = chunk.usage_metadata or usage
+                            if chunk.text:
+                                if first_chunk_after is None:
+                                    first_chunk_after = time.perf_counter() - started
+                                chunks.put(chunk.text)
+                        if on_usage is not None:
+                            on_usage(usage)
+                    finally:
+                        self.in_flight -= 1
+            finally:
+                self.breaker.record(first_chunk_after is not None, first_chunk_after or 0.0, probe)
+
+        async def run():
+            try:
+                await asyncio.wait_for(pump(), timeout=deadline)
+                chunks.put(end_of_stream)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                chunks.put(e)
+
+        future = asyncio.run_coroutine_threadsafe(run(), loop)
+        give_up_at = time.monotonic() + deadline + 1.0
+        started = time.perf_counter()
+        outcome = 'cancelled'
+        try:
+            while True:
+                try:
+                    item = chunks.get(timeout=max(0.0, give_up_at - time.monotonic()))
+                except queue.Empty:
+                    raise TimeoutError("AI strim nije završen u roku.")
+                if item is end_of_stream:
+                    outcome = 'ok'
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        except TimeoutError:
+            self.timeouts += 1
+            outcome = 'timeout'
+            raise
+        except CircuitOpenError:
+            self.rejected += 1
+            outcome = 'rejected'
+            raise
+        except Exception:
+            self.errors += 1
+            outcome = 'error'
+            raise
+        finally:
+            # Ako potrošač prekine ranije (ili je rok istekao), otkazujemo poziv
+            future.cancel()
+            GEMINI_SECONDS.observe(time.perf_counter() - started, 'stream', outcome)
+
+
+ai_gateway = AsyncAIGateway()
+
+
+# V10.69: Kako se SYSTEM_INSTRUCTION šalje modelu:
+# 'cache' (keširani kontekst na Gemini strani), 'system' (system_instruction u konfiguraciji),
+# 'inline' (stari način - instrukcije kao prvi 'user' blok)
+# V10.89: Podrazumevano 'system' - Gemini kešira samo kontekst od bar GEMINI_CACHE_MIN_TOKENS
+# tokena, a persona instrukcije su znatno kraće; 'cache' važi tek kada instrukcije prerastu prag
+GEMINI_PROMPT_MODE = os.environ.get('GEMINI_PROMPT_MODE', 'system').lower()
+GEMINI_CACHE_MIN_TOKENS = int(os.environ.get('GEMINI_CACHE_MIN_TOKENS', '1024'))
+# Procena bez tokenizera (znakova po tokenu); V10.87: PromptBuilder je kalibriše iz usage_metadata
+GEMINI_CHARS_PER_TOKEN = float(os.environ.get('GEMINI_CHARS_PER_TOKEN', '4'))
+GEMINI_CACHE_TTL = int(os.environ.get('GEMINI_CACHE_TTL', '3600'))
+GEMINI_CACHE_REFRESH_MARGIN = 120
+# Posle neuspešnog kreiranja keša ne pokušavamo ponovo odmah
+GEMINI_CACHE_RETRY_SECONDS = int(os.environ.get('GEMINI_CACHE_RETRY_SECONDS', '900'))
+# V10.89: Keš koji Gemini više ne prepoznaje (404) se pravi ponovo tek posle kratke pauze
+GEMINI_CACHE_LOST_RETRY_SECONDS = 60
+# V10.89: Rok za kreiranje/brisanje keša - poziv ide sa puta obrade poruke
+GEMINI_CACHE_CALL_TIMEOUT = float(os.environ.get('GEMINI_CACHE_CALL_TIMEOUT', '5'))
+
+
+class PromptContextCache:
+    """
+    V10.69: Jednom registruje persona instrukcije i referencira ih u svakom pozivu.
+
+    U 'cache' režimu pravi Gemini cached content sa PROMPT_INSTRUCTION i osvežava ga
+    pre isteka TTL-a. Ako keširanje nije dostupno (npr. prekratak prompt za keš,
+    greška API-ja), koristi system_instruction u konfiguraciji poziva, a u
+    'inline' režimu instrukcije idu kao prvi blok sadržaja.
+    V10.89: Keš se pravi samo za instrukcije iznad minimuma za keširanje, samo jedna
+    nit ga pravi (ostale ne čekaju mrežni poziv), a odbacuje se samo kada ga Gemini
+    ne prepoznaje ili mu nema pristup.
+    """
+
+    def __init__(self, mode=GEMINI_PROMPT_MODE, ttl=GEMINI_CACHE_TTL, min_tokens=GEMINI_CACHE_MIN_TOKENS):
+        if mode == 'cache':
+            tokens = len(PROMPT_INSTRUCTION) / GEMINI_CHARS_PER_TOKEN
+            if tokens < min_tokens:
+                logging.warning(
+                    f"GEMINI_PROMPT_MODE=cache: instrukcije imaju ~{tokens:.0f} tokena, manje od minimuma "
+                    f"za keš ({min_tokens}). Koristi se 'system'."
+                )
+                mode = 'system'
+        self.mode = mode
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._cache_name = None
+        self._expires_at = 0
+        self._retry_at = 0
+        self.refreshes = 0
+        self.failures = 0
+        self.invalidations = 0
+
+    def uses_inline_instruction(self):
+        return self.mode == 'inline'
+
+    def get_config(self):
+        """Vraća GenerateContentConfig za poziv (ili None u 'inline' režimu)."""
+        if self.mode == 'inline':
+            return None
+        if self.mode == 'cache':
+            cache_name = self._get_cache_name()
+            if cache_name:
+                return genai_types().GenerateContentConfig(cached_content=cache_name)
+        return genai_types().GenerateContentConfig(system_instruction=PROMPT_INSTRUCTION)
+
+    def is_cached_config(self, config):
+        return config is not None and getattr(config, 'cached_content', None) is not None
+
+    def sent_instruction(self, config):
+        """V10.87: Instrukcije koje poziv zaista šalje (ulaze u budžet tokena); keširane se ne šalju."""
+        if config is None or self.is_cached_config(config):
+            return ''
+        return getattr(config, 'system_instruction', None) or ''
+
+    def _get_cache_name(self):
+        now = time.time()
+        if self._cache_name and now < self._expires_at - GEMINI_CACHE_REFRESH_MARGIN:
+            return self._cache_name
+        if now < self._retry_at:
+            return None
+        if not self._lock.acquire(blocking=False):
+            # Druga nit upravo pravi keš - ne čekamo je; stari keš važi do isteka, inače system_instruction
+            return self._cache_name if self._cache_name and now < self._expires_at else None
+        try:
+            # Druga nit je možda već osvežila keš pre nego što smo uzeli bravu
+            if self._cache_name and now < self._expires_at - GEMINI_CACHE_REFRESH_MARGIN:
+                return self._cache_name
+            if now < self._retry_at:
+                return None
+            self._refresh(now)
+            return self._cache_name
+        finally:
+            self._lock.release()
+
+    def _http_options(self):
+        return genai_types().HttpOptions(timeout=int(GEMINI_CACHE_CALL_TIMEOUT * 1000))
+
+    def _refresh(self, now):
+        old_name = self._cache_name
+        try:
+            cached = get_ai_client().caches.create(
+                model=GEMINI_MODEL_NAME,
+                config=genai_types().CreateCachedContentConfig(
+                    system_instruction=PROMPT_INSTRUCTION,
+                    display_name='zavet-dimitrije-persona',
+                    ttl=f"{self.ttl}s",
+                    http_options=self._http_options()
+                )
+            )
+            self._cache_name = cached.name
+            self._expires_at = now + self.ttl
+            self.refreshes += 1
+            logging.info(f"Gemini keš instrukcija osvežen: {cached.name}")
+        except Exception as e:
+            self._cache_name = None
+            self._retry_at = now + GEMINI_CACHE_RETRY_SECONDS
+            self.failures += 1
+            logging.warning(f"Gemini keš instrukcija nije dostupan, koristi se system_instruction. Greška: {e}")
+            return
+
+        if old_name:
+            self._delete(old_name)
+
+    def _delete(self, cache_name):
+        # Stari keš je i dalje važeći do isteka; brišemo ga da ne bi trošio kvotu
+        try:
+            get_ai_client().caches.delete(
+                name=cache_name, config=genai_types().DeleteCachedContentConfig(http_options=self._http_options())
+            )
+        except Exception as e:
+            logging.warning(f"Neuspešno brisanje starog Gemini keša {cache_name}: {e}")
+
+    def invalidate(self, config, error):
+        """
+        Poziva se kada je poziv sa keširanim kontekstom pao. V10.89: Keš se odbacuje samo
+        kada ga Gemini ne prepoznaje (404, npr. obrisan na serveru) ili mu nema pristup (403),
+        uz pauzu pre novog keša; ostale greške (rok, 5xx, prazan odgovor) ga ne diraju.
+        Vraća True kada je keš odbačen.
+        """
+        code = getattr(error, 'code', None)
+        if not self.is_cached_config(config) or code not in (403, 404):
+            return False
+        backoff = GEMINI_CACHE_LOST_RETRY_SECONDS if code == 404 else GEMINI_CACHE_RETRY_SECONDS
+        # Bez brave: dok druga nit pravi novi keš (do GEMINI_CACHE_CALL_TIMEOUT), ovde se ne čeka
+        if self._cache_name != config.cached_content:
+            return False
+        self._cache_name = None
+        self._expires_at = 0
+        self._retry_at = time.time() + backoff
+        self.invalidations += 1
+        logging.warning(f"Gemini keš {config.cached_content} odbačen ({code}); novi keš za {backoff}s. Greška: {error}")
+        return True
+
+
+prompt_context = PromptContextCache()
+
+
+def get_ai_deadline(player):
+    """V10.67: Rok za AI poziv - ograničen preostalim vremenom igre (uz rezervu za igrača)."""
+    elapsed_time = int(time.time()) - (player.start_time or 0)
+    remaining_seconds = TIME_LIMIT_SECONDS - elapsed_time
+    return min(GEMINI_TIMEOUT_SECONDS, remaining_seconds - GEMINI_TIME_RESERVE_SECONDS)
+
+
+def get_ai_fallback_text(required_phrase):
+    narrative_starter = random.choice(AI_FALLBACK_MESSAGES)
+    return f"{narrative_starter}\n\n{required_phrase}"
+
+
+# V10.68: Keš AI odgovora na česta pitanja van teme, po fazi i normalizovanom tekstu
+AI_CACHE_SIZE = int(os.environ.get('AI_CACHE_SIZE', '2000'))
+AI_CACHE_TTL = int(os.environ.get('AI_CACHE_TTL', '21600'))
+# Koliko različitih odgovora skupljamo po ključu pre nego što počnemo da služimo iz keša
+AI_CACHE_VARIANTS = int(os.environ.get('AI_CACHE_VARIANTS', '3'))
+AI_CACHE_MAX_KEY_LENGTH = 80
+AI_CACHE_PRELOAD_FILE = os.environ.get('AI_CACHE_PRELOAD_FILE')
+
+class AIResponseCache:
+    """
+    V10.68: LRU keš sa TTL-om za AI odgovore, ključ je (faza, normalizovan tekst).
+
+    Po ključu čuva nekoliko varijanti odgovora. Dok ih nema AI_CACHE_VARIANTS,
+    upit se tretira kao promašaj (poziva se Gemini i odgovor se dodaje), a posle
+    toga se nasumično bira jedna varijanta da odgovori ne bi delovali šablonski.
+    Unosi učitani iz fajla ne ističu i služe se odmah.
+    """
+
+    def __init__(self, maxsize=AI_CACHE_SIZE, ttl=AI_CACHE_TTL, variants=AI_CACHE_VARIANTS):
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # ključ -> {'variants', 'created', 'pinned'}
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.variants = variants
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def _key(self, stage_key, user_text):
+        normalized = normalize_user_text(user_text)
+        if not normalized or len(normalized) > AI_CACHE_MAX_KEY_LENGTH:
+            return None
+        return (stage_key, normalized)
+
+    def get(self, stage_key, user_text):
+        key = self._key(stage_key, user_text) if self.maxsize > 0 else None
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and not entry['pinned'] and time.time() - entry['created'] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if not entry or (len(entry['variants']) < self.variants and not entry['pinned']):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return random.choice(entry['variants'])
+
+    def put(self, stage_key, user_text, reply, pinned=False):
+        key = self._key(stage_key, user_text) if self.maxsize > 0 else None
+        if key is None:
+            return
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = {'variants': [], 'created': time.time(), 'pinned': pinned}
+            if reply not in entry['variants'] and len(entry['variants']) < self.variants:
+                entry['variants'].append(reply)
+                self.stores += 1
+            entry['pinned'] = entry['pinned'] or pinned
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def preload(self, path):
+        """Učitava JSON oblika {"FAZA": {"pitanje": ["odgovor", ...]}}. Vraća broj učitanih odgovora."""
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        loaded = 0
+        for stage_key, questions in data.items():
+            for question, replies in questions.items():
+                for reply in replies:
+                    self.put(stage_key, question, reply, pinned=True)
+                    loaded += 1
+        return loaded
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'stores': self.stores,
+                'hit_rate': (self.hits / lookups) if lookups else 0.0,
+                # Svaki pogodak je jedan Gemini poziv manje
+                'gemini_calls_saved': self.hits,
+            }
+
+
+ai_response_cache = AIResponseCache()
+
+if AI_CACHE_PRELOAD_FILE:
+    try:
+        loaded = ai_response_cache.preload(AI_CACHE_PRELOAD_FILE)
+        logging.info(f"AI keš: učitano {loaded} odgovora iz {AI_CACHE_PRELOAD_FILE}.")
+    except Exception as e:
+        logging.error(f"Neuspešno učitavanje AI keša iz {AI_CACHE_PRELOAD_FILE}: {e}")
+
+
+# V10.87: Budžet ulaznih tokena po Gemini pozivu (keširane instrukcije se ne računaju)
+GEMINI_INPUT_TOKEN_BUDGET = int(os.environ.get('GEMINI_INPUT_TOKEN_BUDGET', '1000'))
+# Najviše tokena jednog poteza iz istorije - duži potez se skraćuje
+GEMINI_TURN_TOKEN_LIMIT = int(os.environ.get('GEMINI_TURN_TOKEN_LIMIT', '120'))
+GEMINI_SUMMARY_TOKEN_LIMIT = 60
+SUMMARY_SNIPPET_CHARS = 60
+
+PromptPlan = collections.namedtuple('PromptPlan', 'contents chars estimated_tokens')
+
+
+def build_task_prompt(user_input, current_stage_key, required_phrase):
+    """V10.68: Finalni prompt sa zadatkom (V10.87: pravila su u instrukcijama, ovde samo oznaka)."""
+    # V10.61: Provera za novu Long uvodnu fazu
+    current_stage = stage_machine.get(current_stage_key)
+    if current_stage is not None and current_stage.transitional:
+        required_phrase, rule = "Potvrda (nastavi/ok/spreman sam)", "TRANZIT"
+    else:
+        rule = "PITANJE"
+    return (
+        f"Korisnik je postavio kontekstualno pitanje/komentar: '{user_input}'. "
+        f"Tvoj poslednji zadatak je bio: '{required_phrase}'. Primeni pravilo [{rule}]."
+    )
+
+
+class PromptBuilder:
+    """
+    V10.87: Sastavlja sadržaj Gemini poziva u budžetu ulaznih tokena.
+
+    Tokeni se procenjuju iz dužine teksta (bez tokenizera), a odnos znakova po
+    tokenu se pokretnim prosekom usklađuje sa prompt_token_count iz odgovora.
+    Ponovljeni odgovori modela se šalju jednom, predugi potezi se skraćuju, a
+    istorija se puni od najnovijeg poteza dok ima mesta; izbačeni stariji potezi
+    se svode na jedan kratak red da model ne bi ponavljao iste rečenice.
+    """
+
+    def __init__(self, budget=GEMINI_INPUT_TOKEN_BUDGET, turn_limit=GEMINI_TURN_TOKEN_LIMIT,
+                 chars_per_token=GEMINI_CHARS_PER_TOKEN):
+        self.budget = budget
+        self.turn_limit = turn_limit
+        self.chars_per_token = chars_per_token
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.turns_kept = 0
+        self.turns_dropped = 0
+        self.turns_deduped = 0
+        self.turns_truncated = 0
+        self.summaries = 0
+        self.calibrations = 0
+
+    def estimate(self, text):
+        return int(len(text) / self.chars_per_token) + 1 if text else 0
+
+    def _prepare(self, history):
+        """Potezi od najnovijeg ka najstarijem, bez ponovljenih odgovora modela i skraćeni na limit."""
+        turns, seen, deduped, truncated = [], set(), 0, 0
+        limit_chars = int(self.turn_limit * self.chars_per_token)
+        for entry in reversed(history):
+            role = 'user' if entry['role'] == 'user' else 'model'
+            text = entry['content']
+            if role == 'model':
+                key = normalize_user_text(text)
+                if key in seen:
+                    deduped += 1
+                    continue
+                seen.add(key)
+            if len(text) > limit_chars:
+                text = text[:limit_chars].rstrip() + "…"
+                truncated += 1
+            turns.append((role, text))
+        return turns, deduped, truncated
+
+    def _summarize(self, dropped, room):
+        """Jedan red umesto izbačenih poteza: koliko ih je bilo i početak svakog (najnoviji prvi)."""
+        room = min(room, GEMINI_SUMMARY_TOKEN_LIMIT)
+        summary = f"[Ranije u razgovoru si odgovorio još {len(dropped)} put(a), ne ponavljaj se:"
+        if self.estimate(summary) > room:
+            return None
+        for _, text in dropped:
+            snippet = f" «{text[:SUMMARY_SNIPPET_CHARS].rstrip()}…»"
+            if self.estimate(summary + snippet + "]") > room:
+                break
+            summary += snippet
+        return summary + "]"
+
+    def build(self, user_input, history, current_stage_key, required_phrase, include_instruction=True, instruction=''):
+        """
+        Vraća PromptPlan. include_instruction: instrukcije kao prvi 'user' blok ('inline');
+        instruction: tekst koji ide kroz system_instruction (ulazi u budžet, ali ne u sadržaj).
+        """
+        head = []
+        if include_instruction:
+            # Sistemske instrukcije ugrađene u prvi 'user' blok za stabilnost (V10.69: samo u 'inline' režimu)
+            instruction = PROMPT_INSTRUCTION + "\n\n--- KONTEKST FIKCIJE JE POSTAVLJEN ---"
+            head.append({'role': 'user', 'parts': [{'text': instruction}]})
+        task_text = build_task_prompt(user_input, current_stage_key, required_phrase)
+        chars = len(instruction) + len(task_text)
+        used = self.estimate(instruction) + self.estimate(task_text)
+
+        turns, deduped, truncated = self._prepare(history)
+        kept = []
+        for role, text in turns:
+            cost = self.estimate(text)
+            if used + cost > self.budget:
+                break
+            kept.append((role, text))
+            used += cost
+            chars += len(text)
+        dropped = turns[len(kept):]
+
+        summary = self._summarize(dropped, self.budget - used) if dropped else None
+        if summary:
+            head.append({'role': 'user', 'parts': [{'text': summary}]})
+            used += self.estimate(summary)
+            chars += len(summary)
+        contents = head + [{'role': role, 'parts': [{'text': text}]} for role, text in reversed(kept)]
+        contents.append({'role': 'user', 'parts': [{'text': task_text}]})
+
+        with self._lock:
+            self.calls += 1
+            self.turns_kept += len(kept)
+            self.turns_dropped += len(dropped)
+            self.turns_deduped += deduped
+            self.turns_truncated += truncated
+            self.summaries += 1 if summary else 0
+        GEMINI_PROMPT_TOKENS.observe(used, 'estimated')
+        return PromptPlan(contents, chars, used)
+
+    def observe_usage(self, plan, usage):
+        """Stvarni tokeni iz odgovora: metrike i kalibracija procene (keširani deo se ne šalje)."""
+        if usage is None:
+            return
+        cached = getattr(usage, 'cached_content_token_count', None) or 0
+        sent = max(0, (usage.prompt_token_count or 0) - cached)
+        GEMINI_PROMPT_TOKENS.observe(sent, 'actual')
+        GEMINI_TOKENS.inc('input', amount=sent)
+        GEMINI_TOKENS.inc('cached', amount=cached)
+        GEMINI_TOKENS.inc('output', amount=usage.candidates_token_count or 0)
+        if sent > 0 and plan.chars > 0:
+            observed = min(8.0, max(1.5, plan.chars / sent))
+            with self._lock:
+                self.chars_per_token += 0.05 * (observed - self.chars_per_token)
+                self.calibrations += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'turns_kept': self.turns_kept,
+                'turns_dropped': self.turns_dropped,
+                'turns_deduped': self.turns_deduped,
+                'turns_truncated': self.turns_truncated,
+                'summaries': self.summaries,
+                'calibrations': self.calibrations,
+                'chars_per_token': round(self.chars_per_token, 3),
+            }
+
+
+prompt_builder = PromptBuilder()
+
+
+def record_ai_fallback(reason, player, current_stage_key):
+    AI_FALLBACKS.inc(reason)
+    # V10.86: I u dnevnik događaja - levak pokazuje u kojoj fazi AI ne odgovara
+    game_events.record('ai_fallback', player.chat_id, current_stage_key, None, reason)
+
+
+def get_ai_gate_text(player, current_stage_key, required_phrase, deadline, has_client):
+    """V10.90: Rezervni odgovor kada Gemini ne vredi zvati; None kada poziv može da ide."""
+    if not has_client:
+        reason = 'no_client'
+    elif deadline < GEMINI_MIN_DEADLINE_SECONDS:
+        logging.info(f"Premalo preostalog vremena za AI poziv ({deadline:.1f}s). Fallback.")
+        reason = 'deadline'
+    elif ai_gateway.breaker.is_open():
+        # V10.88: Gemini je degradiran - bez čekanja na poziv koji će verovatno pasti
+        reason = 'circuit_open'
+    else:
+        return None
+    record_ai_fallback(reason, player, current_stage_key)
+    return get_ai_fallback_text(required_phrase)
+
+
+def build_ai_prompt(user_input, history, current_stage_key, required_phrase, config):
+    # V10.87: Istorija se sažima u budžet ulaznih tokena
+    return prompt_builder.build(
+        user_input, history, current_stage_key, required_phrase,
+        include_instruction=prompt_context.uses_inline_instruction(),
+        instruction=prompt_context.sent_instruction(config)
+    )
+
+
+def read_ai_response(plan, response):
+    """Tekst Gemini odgovora; prazan ili prekratak odgovor je greška (ide u rezervni odgovor)."""
+    prompt_builder.observe_usage(plan, response.usage_metadata)
+    text = response.text.strip()
+    if not text or len(text) < 5:
+        raise ValueError("AI vratio prazan odgovor.")
+    return text
+
+
+def get_ai_failure_text(error, player, current_stage_key, required_phrase, deadline, config):
+    """V10.90: Neuspeo Gemini poziv -> razlog u metrike/dnevnik i rezervni odgovor."""
+    if isinstance(error, TimeoutError):
+        logging.error(f"AI Call prekoračio rok od {deadline:.1f}s. Falling back.")
+        reason = 'timeout'
+    elif isinstance(error, CircuitOpenError):
+        reason = 'circuit_open'
+    else:
+        logging.error(f"AI Call failed. Falling back. Error: {error}")
+        reason = 'error'
+        prompt_context.invalidate(config, error)
+    record_ai_fallback(reason, player, current_stage_key)
+    return get_ai_fallback_text(required_phrase)
+
+
+def generate_ai_response(user_input, player, current_stage_key, session=None, stream_message=None, elapsed_time=0):
+    """
+    Vraća (ai_text, player, streamed). V10.70: Uz stream_message i GEMINI_STREAMING odgovor
+    se strimuje direktno u chat i tada je streamed=True (pozivalac ga ne šalje ponovo).
+    V10.85: session služi samo za čitanje istorije; AI potez upisuje record_ai_turn.
+    """
+    # V10.7: AI sada koristi get_required_phrase, koji vraća prompt za tranzitne faze
+    required_phrase = get_required_phrase(current_stage_key)
+    # V10.67: Rok poziva zavisi od preostalog vremena igrača
+    deadline = get_ai_deadline(player)
+
+    # V10.68: Česta pitanja po fazi služimo iz keša, bez Gemini poziva
+    ai_text = ai_response_cache.get(current_stage_key, user_input) or get_ai_gate_text(
+        player, current_stage_key, required_phrase, deadline, bool(get_ai_client())
+    )
+    if ai_text:
+        return ai_text, player, False
+
+    streamed = False
+    config = None
+    try:
+        # V10.69: Instrukcije se referenciraju kroz keš/konfiguraciju umesto da se šalju svaki put
+        config = prompt_context.get_config()
+        # V10.71: Čitamo samo poslednjih MAX_HISTORY_ITEMS poteza (V10.72: iz keša stanja)
+        history = session.recent_turns(player.chat_id) if session else []
+        plan = build_ai_prompt(user_input, history, current_stage_key, required_phrase, config)
+        if stream_message is not None and GEMINI_STREAMING:
+            # V10.70: Igrač vidi prvi deo odgovora čim ga model pošalje
+            stream_fallback = get_ai_fallback_text(required_phrase)
+            warning_suffix = get_time_warning_suffix(elapsed_time) if elapsed_time > 0 else ""
+            ai_text, streamed = deliver_stream(
+                stream_message.chat.id,
+                ai_gateway.stream(plan.contents, deadline=deadline, config=config,
+                                  on_usage=lambda usage: prompt_builder.observe_usage(plan, usage)),
+                stream_fallback, warning_suffix
+            )
+            is_model_text = ai_text != stream_fallback
+            if streamed and not is_model_text:
+                record_ai_fallback('stream_error', player, current_stage_key)
+            if not streamed and (not ai_text or len(ai_text) < 5):
+                raise ValueError("AI vratio prazan odgovor.")
+        else:
+            ai_text = read_ai_response(plan, ai_gateway.generate(plan.contents, deadline=deadline, config=config))
+            is_model_text = True
+        if is_model_text:
+            ai_response_cache.put(current_stage_key, user_input, ai_text)
+    except Exception as e:
+        ai_text = get_ai_failure_text(e, player, current_stage_key, required_phrase, deadline, config)
+
+    return ai_text or "Signal se raspao. Pokušaj /start.", player, streamed
+
+
+async def generate_ai_response_async(user_input, player, current_stage_key, session=None):
+    """
+    V10.82: generate_ai_response za ASGI režim. Gemini poziv je korutina u petlji
+    servera; konfiguracija i istorija se čitaju u niti (mogu ići u bazu/mrežu).
+    Strimovanje se ovde ne koristi. Vraća (ai_text, player); AI potez upisuje record_ai_turn.
+    """
+    required_phrase = get_required_phrase(current_stage_key)
+    deadline = get_ai_deadline(player)
+
+    ai_text = ai_response_cache.get(current_stage_key, user_input) or get_ai_gate_text(
+        player, current_stage_key, required_phrase, deadline, bool(await asyncio.to_thread(get_ai_client))
+    )
+    if ai_text:
+        return ai_text, player
+
+    config = None
+    try:
+        config = await asyncio.to_thread(prompt_context.get_config)
+        history = await asyncio.to_thread(session.recent_turns, player.chat_id) if session else []
+        plan = build_ai_prompt(user_input, history, current_stage_key, required_phrase, config)
+        response = await ai_gateway.generate_async(plan.contents, deadline=deadline, config=config)
+        ai_text = read_ai_response(plan, response)
+        ai_response_cache.put(current_stage_key, user_input, ai_text)
+    except Exception as e:
+        ai_text = get_ai_failure_text(e, player, current_stage_key, required_phrase, deadline, config)
+
+    return ai_text, player
+
+def append_ai_turn(session, chat_id, ai_text):
+    if session is None:
+        return
+    player = session.get_player(chat_id)
+    if player is None:
+        return  # Igra je u međuvremenu završena ili prekinuta
+    # Ažuriranje istorije razgovora novim odgovorom bota (V10.71: jedan novi red)
+    session.append_turn(chat_id, 'model', ai_text)
+    player.general_conversation_count += 1
+    session.commit()
+
+
+def record_ai_turn(chat_id, ai_text):
+    """
+    V10.85: AI potez i brojač razgovora se upisuju posle Gemini poziva, u zasebnoj
+    kratkoj sekciji nad svežim stanjem - za vreme poziva igra je mogla da pređe u
+    drugu fazu (u drugom radniku), a brava se ne drži dok AI odgovara.
+    """
+    try:
+        run_chat_unit(chat_id, append_ai_turn, chat_id, ai_text)
+    except Exception as e:
+        logging.error(f"GREŠKA U BAZI (upis AI poteza za {chat_id}): {e}")
+
+
+def get_epilogue_message(end_key):
+    return END_MESSAGES.get(end_key, f"[{end_key}] VEZA PREKINUTA.")
+
+
+# ----------------------------------------------------
+# 5.2 ČIŠĆENJE ISTEKLIH SESIJA (V10.76: Pozadinski čistač sa grupnim upisom)
+# ----------------------------------------------------
+
+SESSION_SWEEP_ENABLED = os.environ.get('SESSION_SWEEP', '1') == '1'
+SESSION_SWEEP_INTERVAL = float(os.environ.get('SESSION_SWEEP_INTERVAL', '60'))
+SESSION_SWEEP_BATCH = int(os.environ.get('SESSION_SWEEP_BATCH', '500'))
+# Završene (i napuštene) sesije se brišu posle ovog vremena od početka igre
+SESSION_RETENTION_SECONDS = int(os.environ.get('SESSION_RETENTION_SECONDS', '86400'))
+# Igrač kome je sesija istekla dobija END_LOCATED odmah, a ne tek na sledeću poruku
+SESSION_SWEEP_NOTIFY = os.environ.get('SESSION_SWEEP_NOTIFY', '1') == '1'
+
+
+class SessionSweeper:
+    """
+    V10.76: Povremeno završava istekle sesije u serijama umesto jedne po jedne.
+
+    Istek se ranije proveravao samo kada igrač pošalje poruku, pa su napuštene
+    sesije ostajale u player_states zauvek. Čistač (preko indeksa na start_time):
+    1. obeležava istekle sesije kao END_LOCATED (jedan UPDATE po seriji) i po
+       želji odmah šalje epilog,
+    2. briše sesije starije od SESSION_RETENTION_SECONDS (jedan DELETE po seriji).
+    Više gunicorn radnika može da čisti istovremeno - red obeležava samo jedan.
+    """
+
+    def __init__(self, enabled=SESSION_SWEEP_ENABLED, interval=SESSION_SWEEP_INTERVAL,
+                 batch_size=SESSION_SWEEP_BATCH, retention=SESSION_RETENTION_SECONDS, notify=SESSION_SWEEP_NOTIFY):
+        self.enabled = enabled
+        self.interval = interval
+        self.batch_size = batch_size
+        self.retention = retention
+        self.notify = notify
+        self._lock = threading.Lock()
+        self._pid = None
+        self.runs = 0
+        self.expired_count = 0
+        self.purged_count = 0
+        self.notified_count = 0
+        self.failures = 0
+
+    def ensure_started(self):
+        # Lenjo pokretanje (i ponovo posle fork-a gunicorn radnika)
+        if not self.enabled or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='session-sweeper', daemon=True).start()
+
+    def _in_batches(self, step):
+        rows = []
+        while True:
+            batch = step()
+            # Keš ne sme da vrati staro stanje (niti da ga kasnije upiše preko obeleženog)
+            player_cache.discard([chat_id for chat_id, _ in batch])
+            rows.extend(batch)
+            if len(batch) < self.batch_size:
+                return rows
+
+    def sweep(self, now=None):
+        """Jedan prolaz čistača. Vraća (broj obeleženih, broj obrisanih) sesija."""
+        if state_store is None:
+            return 0, 0
+        now = int(time.time()) if now is None else now
+        # Prljavi unosi keša prvo u skladište - čistač odlučuje na osnovu najnovijeg stanja
+        player_cache.flush()
+
+        expired = self._in_batches(lambda: state_store.expire_sessions(
+            now - TIME_LIMIT_SECONDS, stage_machine.untimed_stages, "END_LOCATED", self.batch_size))
+        purged = self._in_batches(lambda: state_store.purge_sessions(now - self.retention, self.batch_size))
+
+        if expired and self.notify and bot:
+            epilogue = get_epilogue_message("END_LOCATED")
+            for chat_id, _ in expired:
+                delivery.submit(int(chat_id), [OutboundPart(epilogue, 0)])
+            self.notified_count += len(expired)
+        for chat_id, stage in expired:
+            game_events.record('expired', chat_id, stage, "END_LOCATED", 'sweeper')
+
+        self.runs += 1
+        if expired:
+            SESSION_EXPIRATIONS.inc('sweeper', amount=len(expired))
+        self.expired_count += len(expired)
+        self.purged_count += len(purged)
+        if expired or purged:
+            logging.info(f"Čistač sesija: {len(expired)} isteklih obeleženo, {len(purged)} starih obrisano.")
+        return len(expired), len(purged)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                self.failures += 1
+                logging.error(f"Greška u čistaču isteklih sesija: {e}")
+
+    def stats(self):
+        return {
+            'runs': self.runs,
+            'expired': self.expired_count,
+            'purged': self.purged_count,
+            'notified': self.notified_count,
+            'failures': self.failures,
+        }
+
+
+session_sweeper = SessionSweeper()
+
+
+# ----------------------------------------------------
+# 5.3 KONTROLA NALETA PORUKA (V10.77: Kofa tokena i spajanje poruka pre AI poziva)
+# ----------------------------------------------------
+
+AI_FLOOD_CONTROL_ENABLED = os.environ.get('AI_FLOOD_CONTROL', '1') == '1'
+# Najviše AI_BUCKET_CAPACITY poziva odjednom, zatim jedan na AI_BUCKET_REFILL_SECONDS po chatu
+AI_BUCKET_CAPACITY = float(os.environ.get('AI_BUCKET_CAPACITY', '3'))
+AI_BUCKET_REFILL_SECONDS = float(os.environ.get('AI_BUCKET_REFILL_SECONDS', '10'))
+# Poruke stigle u prozoru posle AI poziva spajaju se u jedan sledeći poziv
+AI_COALESCE_WINDOW = float(os.environ.get('AI_COALESCE_WINDOW', '2.0'))
+AI_COALESCE_MAX_MESSAGES = int(os.environ.get('AI_COALESCE_MAX_MESSAGES', '5'))
+# Kada chat nema token: 'defer' (spojene poruke čekaju token) ili 'drop' (odbacuju se)
+AI_FLOOD_POLICY = os.environ.get('AI_FLOOD_POLICY', 'defer').lower()
+AI_FLOOD_IDLE_TTL = 600
+
+AI_ADMITTED = 'admitted'   # poziv odmah, u samom handleru
+AI_BUFFERED = 'buffered'   # poruka čeka zajednički poziv na kraju prozora
+AI_DROPPED = 'dropped'
+
+
+class ChatFloodState:
+    """V10.77: Kofa tokena i bafer spajanja za jedan chat."""
+    __slots__ = ('tokens', 'updated', 'window_until', 'stage_key', 'texts', 'message', 'scheduled')
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated = now
+        self.window_until = 0.0
+        self.stage_key = None
+        self.texts = []
+        self.message = None     # poslednja poruka - za odgovor (chat) i strimovanje
+        self.scheduled = False
+
+
+class AIFloodControl:
+    """
+    V10.77: Ograničava AI pozive po chatu i spaja nalete poruka.
+
+    Prva poruka posle mira ide odmah (vodeća ivica) i otvara prozor od
+    AI_COALESCE_WINDOW sekundi; poruke stigle u prozoru se spajaju i šalju
+    jednim pozivom na kraju prozora (prateća ivica). Svaki poziv troši token iz
+    kofe chata. Bez tokena se spojene poruke odlažu do sledećeg tokena ili se
+    odbacuju (AI_FLOOD_POLICY); višak preko AI_COALESCE_MAX_MESSAGES se odbacuje.
+
+    Prateći poziv ide kroz red update-a (WEBHOOK_MODE=queue), pa se ne preklapa sa
+    obradom sledeće poruke istog chata; u 'sync' režimu ide u zasebnu nit.
+    V10.90: U ASGI režimu ga attach_dispatcher() predaje event petlji servera.
+    Ako se faza promeni pre poziva, spojene poruke se odbacuju.
+    """
+
+    def __init__(self, enabled=AI_FLOOD_CONTROL_ENABLED, capacity=AI_BUCKET_CAPACITY,
+                 refill_seconds=AI_BUCKET_REFILL_SECONDS, window=AI_COALESCE_WINDOW,
+                 max_messages=AI_COALESCE_MAX_MESSAGES, policy=AI_FLOOD_POLICY):
+        self.enabled = enabled
+        self.capacity = capacity
+        self.refill_seconds = refill_seconds
+        self.window = window
+        self.max_messages = max_messages
+        self.policy = policy
+        self._cond = threading.Condition()
+        self._chats = {}   # chat_id -> ChatFloodState
+        self._heap = []    # (rok, redni_broj, chat_id) - kraj prozora / dolazak tokena
+        self._seq = itertools.count()
+        self._pid = None
+        self._executor = None
+        self._dispatcher = None
+        self.admitted_count = 0
+        self.buffered_count = 0
+        self.flush_count = 0
+        self.deferred_count = 0
+        self.dropped_count = 0
+        self.stale_count = 0
+
+    def _ensure_started(self):
+        # Lenjo pokretanje (i ponovo posle fork-a gunicorn radnika)
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._executor = ThreadPoolExecutor(max_workers=UPDATE_WORKERS, thread_name_prefix='ai-coalesce')
+        threading.Thread(target=self._run, name='ai-flood-control', daemon=True).start()
+
+    def _refill(self, state, now):
+        state.tokens = min(self.capacity, state.tokens + (now - state.updated) / self.refill_seconds)
+        state.updated = now
+
+    def _token_wait(self, state):
+        return max(0.0, (1 - state.tokens) * self.refill_seconds)
+
+    def _schedule(self, chat_id, state, due):
+        state.scheduled = True
+        heapq.heappush(self._heap, (due, next(self._seq), chat_id))
+        self._cond.notify_all()
+
+    def admit(self, chat_id, stage_key, text, message):
+        """Odluka za poruku koja ide AI-ju: AI_ADMITTED, AI_BUFFERED ili AI_DROPPED."""
+        if not self.enabled:
+            return AI_ADMITTED
+        now = time.monotonic()
+        with self._cond:
+            self._ensure_started()
+            state = self._chats.get(chat_id)
+            if state is None:
+                state = self._chats[chat_id] = ChatFloodState(self.capacity, now)
+            self._refill(state, now)
+
+            if not state.texts and now >= state.window_until:
+                if state.tokens >= 1:
+                    state.tokens -= 1
+                    state.window_until = now + self.window
+                    self.admitted_count += 1
+                    return AI_ADMITTED
+                if self.policy == 'drop':
+                    self.dropped_count += 1
+                    return AI_DROPPED
+
+            if len(state.texts) >= self.max_messages:
+                self.dropped_count += 1
+                return AI_DROPPED
+            state.texts.append(text)
+            state.stage_key = stage_key
+            state.message = message
+            self.buffered_count += 1
+            if not state.scheduled:
+                self._schedule(chat_id, state, max(state.window_until, now + self._token_wait(state)))
+            return AI_BUFFERED
+
+    def attach_dispatcher(self, dispatch):
+        """
+        V10.90: dispatch(stage_key, text, message) preuzima prateći poziv umesto reda
+        update-a / niti - ASGI režim ga vraća u petlju, pod bravu chata i u istu
+        asinhronu isporuku kao ostale poruke chata.
+        """
+        self._dispatcher = dispatch
+
+    def cancel(self, chat_id):
+        """Faza se promenila (prelaz, /start, /stop) - spojene poruke više nisu relevantne."""
+        with self._cond:
+            state = self._chats.get(chat_id)
+            if state is not None and state.texts:
+                self.stale_count += len(state.texts)
+                state.texts, state.message = [], None
+
+    def record_stale(self, count=1):
+        with self._cond:
+            self.stale_count += count
+
+    def _fire(self, chat_id, now):
+        """Kraj prozora (pod zaključavanjem). Vraća posao za AI poziv ili None."""
+        state = self._chats.get(chat_id)
+        if state is None:
+            return None
+        state.scheduled = False
+        if not state.texts:
+            return None
+        self._refill(state, now)
+        if state.tokens < 1:
+            if self.policy == 'drop':
+                self.dropped_count += len(state.texts)
+                state.texts, state.message = [], None
+                return None
+            self.deferred_count += 1
+            self._schedule(chat_id, state, now + self._token_wait(state))
+            return None
+
+        state.tokens -= 1
+        # Poruke koje stignu tokom ovog poziva čekaju sledeći prozor
+        state.window_until = now + self.window
+        job = (state.stage_key, "\n".join(state.texts), state.message)
+        state.texts, state.message = [], None
+        self.flush_count += 1
+        return job
+
+    def _dispatch(self, job):
+        stage_key, text, message = job
+        if self._dispatcher is not None:
+            self._dispatcher(stage_key, text, message)
+            return
+        if WEBHOOK_MODE == 'queue' and update_dispatcher.submit(message.chat.id, process_coalesced_messages, stage_key, text, message):
+            return
+        self._executor.submit(process_coalesced_messages, stage_key, text, message)
+
+    def _prune(self, now):
+        for chat_id in [chat_id for chat_id, state in self._chats.items()
+                        if not state.texts and not state.scheduled and now - state.updated > AI_FLOOD_IDLE_TTL]:
+            del self._chats[chat_id]
+
+    def _run(self):
+        last_prune = time.monotonic()
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                while not self._heap or self._heap[0][0] > now:
+                    timeout = min(self._heap[0][0] - now, AI_FLOOD_IDLE_TTL) if self._heap else AI_FLOOD_IDLE_TTL
+                    self._cond.wait(timeout)
+                    now = time.monotonic()
+                    if now - last_prune > AI_FLOOD_IDLE_TTL:
+                        self._prune(now)
+                        last_prune = now
+                _, _, chat_id = heapq.heappop(self._heap)
+                job = self._fire(chat_id, now)
+            if job is not None:
+                try:
+                    self._dispatch(job)
+                except Exception as e:
+                    logging.error(f"Neuspešno pokretanje spojenog AI poziva za {chat_id}: {e}")
+
+    def stats(self):
+        with self._cond:
+            return {
+                'chats': len(self._chats),
+                'admitted': self.admitted_count,
+                'buffered': self.buffered_count,
+                'coalesced_calls': self.flush_count,
+                'deferred': self.deferred_count,
+                'dropped': self.dropped_count,
+                'stale': self.stale_count,
+            }
+
+
+ai_flood_control = AIFloodControl()
+
 
-    if "prompt" in current_stage:
-        # Ovo je tranzitna faza gde se postavlja prompt za nastavak
-        return current_stage["prompt"].strip()
+# ----------------------------------------------------
+# 5.4 DNEVNIK DOGAĐAJA I LEVAK (V10.86: Serijski upis van toka poruke)
+# ----------------------------------------------------
 
-    # Logika je da je poslednja poruka u nizu uvek pitanje koje traži odgovor
-    return current_stage.get("text", ["Signal se gubi..."])[-1].strip()
+# V10.86: Prelazi faza, odgovori, istekle/prekinute sesije i AI fallback-ovi se beleže
+# u memoriji i upisuju u game_events u serijama (EVENT_BATCH_SIZE ili EVENT_FLUSH_INTERVAL)
+EVENT_LOG_ENABLED = os.environ.get('EVENT_LOG', '1') == '1'
+EVENT_BATCH_SIZE = int(os.environ.get('EVENT_BATCH_SIZE', '500'))
+EVENT_FLUSH_INTERVAL = float(os.environ.get('EVENT_FLUSH_INTERVAL', '5.0'))
+# Kada baza ne prima upis, bafer ne raste preko ove granice (najstariji događaji se odbacuju)
+EVENT_BUFFER_LIMIT = int(os.environ.get('EVENT_BUFFER_LIMIT', '50000'))
+# /stats: brojači levka se iz baze (zajednički za sve radnike) čitaju najviše ovoliko često
+STATS_REFRESH_SECONDS = float(os.environ.get('STATS_REFRESH_SECONDS', '10'))
 
-def get_time_warning_suffix(elapsed_seconds):
-    """V10.8: Generiše upozorenje o preostalom vremenu."""
-    remaining_seconds = TIME_LIMIT_SECONDS - elapsed_seconds
-    
-    if remaining_seconds <= 0:
-        return "" # Vreme je isteklo, završavamo igru
-    elif remaining_seconds <= 10:
-        # V10.9: Promena Kolektiv u GSA
-        return "\n\n**GSA JE NA LOKACIJI! NEMA VREMENA! Odgovori SADA!**"
-    elif remaining_seconds <= 60:
-        return "\n\n**CRVENI KOD! Manje od 60 sekundi! BRZO!**"
-    elif remaining_seconds <= 120:
-        return "\n\nVeza se gubi! Ostalo nam je manje od dve minute dok nas ne lociraju!"
-    else:
-        return "" # Bez upozorenja dok ne uđe u zonu opasnosti
+# Vrsta događaja -> brojač faze u kojoj se desio
+EVENT_COUNTERS = {
+    'answer': 'answered',
+    'expired': 'expired',
+    'stop': 'stopped',
+    'ai_fallback': 'ai_fallbacks',
+}
+FUNNEL_COLUMNS = ('reached', 'answered', 'correct', 'wrong', 'expired', 'stopped', 'ai_fallbacks')
 
 
-def send_msg(message, text: Union[str, List[str]], add_warning=False, elapsed_time=0):
-    if not bot: return
+def funnel_increments(events):
+    """(faza, brojač) -> uvećanje za seriju događaja; 'reached' broji ulaske u next_stage."""
+    increments = collections.Counter()
+    for event in events:
+        if event['stage'] and event['kind'] in EVENT_COUNTERS:
+            increments[(event['stage'], EVENT_COUNTERS[event['kind']])] += 1
+        if event['next_stage']:
+            increments[(event['next_stage'], 'reached')] += 1
+        if event['kind'] == 'answer' and event['detail']:
+            increments[(event['stage'], event['detail'])] += 1
+    return increments
+
+
+class GameEventLog:
+    """
+    V10.86: Bafer događaja igre sa serijskim upisom.
+
+    record() samo dodaje rečnik u bafer (bez baze u toku poruke). Pozadinska nit
+    upisuje bafer kada dostigne EVENT_BATCH_SIZE ili posle EVENT_FLUSH_INTERVAL, i to
+    jednim INSERT-om za sve događaje uz uvećanje brojača levka u istoj transakciji.
+    Neuspeo upis vraća događaje u bafer za sledeći pokušaj. Pri gašenju radnika
+    bafer se upisuje (atexit); posle pada procesa gubi se najviše poslednja serija.
+    """
+
+    def __init__(self, enabled=EVENT_LOG_ENABLED, batch_size=EVENT_BATCH_SIZE,
+                 interval=EVENT_FLUSH_INTERVAL, limit=EVENT_BUFFER_LIMIT):
+        self.enabled = enabled
+        self.batch_size = batch_size
+        self.interval = interval
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._buffer = collections.deque()
+        self._wakeup = threading.Event()
+        self._pid = None
+        self._funnel = None       # (faza, brojač) -> broj, poslednje čitanje iz baze + sopstveni upisi
+        self._funnel_loaded = 0.0
+        self.recorded = 0
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.flush_failures = 0
+
+    def _ensure_started(self):
+        # Lenjo pokretanje (i ponovo posle fork-a gunicorn radnika)
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        threading.Thread(target=self._run, name='event-log-flusher', daemon=True).start()
+
+    def record(self, kind, chat_id, stage=None, next_stage=None, detail=None):
+        if not self.enabled:
+            return
+        event = {'created_at': int(time.time()), 'chat_id': str(chat_id), 'kind': kind,
+                 'stage': stage, 'next_stage': next_stage, 'detail': detail}
+        with self._lock:
+            self._ensure_started()
+            if len(self._buffer) >= self.limit:
+                self._buffer.popleft()
+                self.dropped += 1
+            self._buffer.append(event)
+            self.recorded += 1
+            if len(self._buffer) >= self.batch_size:
+                self._wakeup.set()
+
+    def flush(self):
+        """Upisuje ceo bafer (u serijama od EVENT_BATCH_SIZE). Vraća broj upisanih događaja."""
+        written = 0
+        with self._flush_lock:
+            while state_store is not None:
+                with self._lock:
+                    events = [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+                if not events:
+                    break
+                increments = funnel_increments(events)
+                try:
+                    state_store.write_events(events, increments)
+                except Exception as e:
+                    self.flush_failures += 1
+                    logging.error(f"GREŠKA U BAZI (upis {len(events)} događaja igre): {e}")
+                    with self._lock:
+                        # Stariji događaji ostaju ispred novijih; višak preko granice se odbacuje
+                        self._buffer.extendleft(reversed(events))
+                        while len(self._buffer) > self.limit:
+                            self._buffer.popleft()
+                            self.dropped += 1
+                    break
+                written += len(events)
+                with self._lock:
+                    self.flushes += 1
+                    self.written += len(events)
+                    if self._funnel is not None:
+                        for key, amount in increments.items():
+                            self._funnel[key] = self._funnel.get(key, 0) + amount
+        return written
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Greška u pozadinskom upisu događaja igre: {e}")
+
+    def funnel(self):
+        """
+        Brojači levka (faza, brojač) -> broj. Iz baze se čitaju najviše jednom u
+        STATS_REFRESH_SECONDS (mala tabela, bez čitanja dnevnika); između toga se
+        uvećavaju upisima ovog procesa.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._funnel is not None and now - self._funnel_loaded < STATS_REFRESH_SECONDS:
+                return dict(self._funnel)
+        funnel = state_store.load_funnel() if state_store is not None else {}
+        with self._lock:
+            self._funnel, self._funnel_loaded = funnel, now
+            return dict(funnel)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': len(self._buffer),
+                'recorded': self.recorded,
+                'written': self.written,
+                'dropped': self.dropped,
+                'flushes': self.flushes,
+                'flush_failures': self.flush_failures,
+            }
+
+
+game_events = GameEventLog()
+atexit.register(game_events.flush)
+
+
+def funnel_report():
+    """V10.86: Levak po fazi, redom faza igre; 'remaining' = ušli, a nisu otišli dalje."""
+    funnel = game_events.funnel()
+    stage_order = list(GAME_STAGES) + [key for key in END_MESSAGES if key not in GAME_STAGES]
+    stage_order += sorted({stage for stage, _ in funnel} - set(stage_order))
+    stages = []
+    for stage in stage_order:
+        row = {column: funnel.get((stage, column), 0) for column in FUNNEL_COLUMNS}
+        if not any(row.values()):
+            continue
+        if not stage.startswith('END_'):
+            row['remaining'] = max(0, row['reached'] - row['answered'] - row['expired'] - row['stopped'])
+        stages.append(dict(stage=stage, **row))
+    return {
+        'stages': stages,
+        'started': funnel.get(("START_PROVERA", 'reached'), 0),
+        'events': game_events.stats(),
+    }
+
+
+# ----------------------------------------------------
+# 6. WEBHOOK RUTE (V10.33 FIX: one_json -> de_json)
+# ----------------------------------------------------
+
+# V10.65: Režim prijema - 'sync' (obrada u samom zahtevu) ili 'queue' (brza potvrda + red)
+WEBHOOK_MODE = os.environ.get('WEBHOOK_MODE', 'sync').lower()
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', '8'))
+UPDATE_QUEUE_MAXSIZE = int(os.environ.get('UPDATE_QUEUE_MAXSIZE', '1000'))
+# Ponašanje pri punom redu: 'block' (čeka, pa 503), 'reject' (odmah 503 - Telegram ponavlja),
+# 'drop' (200 i odbacivanje), 'inline' (obrada u samom zahtevu)
+UPDATE_QUEUE_POLICY = os.environ.get('UPDATE_QUEUE_POLICY', 'block').lower()
+UPDATE_QUEUE_TIMEOUT = float(os.environ.get('UPDATE_QUEUE_TIMEOUT', '2.0'))
+
+
+class UpdateDispatcher:
+    """
+    V10.65: Ograničen red poslova sa grupom radnika.
+
+    Poslovi se grupišu po ključu (chat_id): različiti chatovi se obrađuju paralelno,
+    a poslovi istog chata strogo redom - chat je u najviše jednom radniku u isto vreme.
+    """
+
+    def __init__(self, workers=UPDATE_WORKERS, maxsize=UPDATE_QUEUE_MAXSIZE,
+                 policy=UPDATE_QUEUE_POLICY, put_timeout=UPDATE_QUEUE_TIMEOUT):
+        self._cond = threading.Condition()
+        self._mailboxes = {}              # ključ -> deque[(fn, args)]; postoji dok ključ ima posla
+        self._ready = collections.deque() # ključevi spremni za radnika (nisu u obradi)
+        self._workers = workers
+        self.maxsize = maxsize
+        self.policy = policy
+        self.put_timeout = put_timeout
+        self._pid = None
+        self.depth = 0
+        self.peak_depth = 0
+        self.accepted_count = 0
+        self.rejected_count = 0
+
+    def _ensure_started(self):
+        # Lenjo pokretanje (i ponovo posle fork-a gunicorn radnika)
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        for i in range(self._workers):
+            threading.Thread(target=self._run, name=f'update-worker-{i}', daemon=True).start()
+
+    def submit(self, key, fn, *args):
+        """Stavlja posao u red. Vraća False ako je red pun (odluku donosi pozivalac po politici)."""
+        with self._cond:
+            self._ensure_started()
+            if self.depth >= self.maxsize:
+                if self.policy == 'block':
+                    self._cond.wait_for(lambda: self.depth < self.maxsize, timeout=self.put_timeout)
+                if self.depth >= self.maxsize:
+                    self.rejected_count += 1
+                    return False
+
+            mailbox = self._mailboxes.get(key)
+            if mailbox is None:
+                mailbox = self._mailboxes[key] = collections.deque()
+                self._ready.append(key)
+            mailbox.append((fn, args))
+
+            self.depth += 1
+            self.accepted_count += 1
+            self.peak_depth = max(self.peak_depth, self.depth)
+            self._cond.notify_all()
+        return True
+
+    def drain(self, timeout=DELIVERY_DRAIN_TIMEOUT):
+        """Čeka da se red isprazni (gašenje radnika). Vraća True ako je sve obrađeno."""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._mailboxes, timeout=timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._ready)
+                key = self._ready.popleft()
+                fn, args = self._mailboxes[key].popleft()
+            try:
+                fn(*args)
+            except Exception as e:
+                logging.error(f"Nepredviđena greška u radniku reda ({key}): {e}")
+            finally:
+                with self._cond:
+                    self.depth -= 1
+                    if self._mailboxes[key]:
+                        # Sledeći posao istog chata ide na kraj reda (pravednost među chatovima)
+                        self._ready.append(key)
+                    else:
+                        del self._mailboxes[key]
+                    self._cond.notify_all()
+
+
+update_dispatcher = UpdateDispatcher()
+atexit.register(update_dispatcher.drain)
+
+
+def get_update_chat_key(update):
+    """V10.65: Ključ za redosled obrade - chat iz kog update dolazi."""
+    for msg in (update.message, update.edited_message, update.channel_post):
+        if msg is not None:
+            return msg.chat.id
+    if update.callback_query is not None:
+        if update.callback_query.message is not None:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    return update.update_id
+
+
+def process_update(update):
+    started = time.perf_counter()
     try:
-        
-        # V10.8: Dodavanje upozorenja na poslednju poruku u sekvenci
-        warning_suffix = ""
-        if add_warning and elapsed_time > 0:
-            warning_suffix = get_time_warning_suffix(elapsed_time)
-
-        if isinstance(text, list):
-            # Šalje jednu poruku za drugom sa pauzom
-            for i, part in enumerate(text):
-                final_part = part
-                # Dodaje upozorenje samo na poslednju poruku u nizu
-                if i == len(text) - 1:
-                    final_part += warning_suffix
-                
-                bot.send_chat_action(message.chat.id, 'typing')
-                time.sleep(random.uniform(1.0, 2.5)) 
-                bot.send_message(message.chat.id, final_part, parse_mode='Markdown')
-        else:
-            final_text = text + warning_suffix
-            bot.send_chat_action(message.chat.id, 'typing')
-            time.sleep(random.uniform(1.2, 2.8))
-            bot.send_message(message.chat.id, final_text, parse_mode='Markdown')
-            
+        bot.process_new_updates([update])
     except Exception as e:
-        # V10.6: Dodata provera za Bad Request (Markdown greške)
-        if "Bad Request: can't parse entities" in str(e):
-            logging.error(f"Greška Markdown formatiranja. Pokušavam slanje bez Markdowna: {str(e)}")
-            try:
-                # Pokušaj bez Markdowna
-                if isinstance(text, list):
-                    bot.send_message(message.chat.id, text[-1] + warning_suffix, parse_mode=None)
-                else:
-                    bot.send_message(message.chat.id, text + warning_suffix, parse_mode=None)
-            except Exception as e2:
-                logging.error(f"Neuspešno slanje ni bez Markdowna: {e2}")
-        else:
-            logging.error(f"Greška pri slanju poruke: {e}")
+        logging.error(f"Nepredviđena greška u obradi Telegram poruke: {e}")
+    finally:
+        UPDATE_SECONDS.observe(time.perf_counter() - started)
 
-def generate_ai_response(user_input, player, current_stage_key):
-    # V10.7: AI sada koristi get_required_phrase, koji vraća prompt za tranzitne faze
-    required_phrase = get_required_phrase(current_stage_key) 
-    ai_text = None
-    
-    try: history = json.loads(player.conversation_history)
-    except: history = []
 
-    MAX_HISTORY_ITEMS = 10
-    if len(history) > MAX_HISTORY_ITEMS:
-        history = history[-MAX_HISTORY_ITEMS:]
+def dispatch_update(update):
+    """
+    V10.65: U 'queue' režimu update ide u red i zahtev se odmah potvrđuje.
+    Vraća False samo kada Telegram treba da ponovi isporuku (pun red).
+    """
+    if WEBHOOK_MODE != 'queue':
+        process_update(update)
+        return True
 
-    full_contents = []
-    
-    # Prvi deo: Sistemske instrukcije ugrađene u prvi 'user' blok za stabilnost
-    full_contents.append({
-        # V10.11: KORISTIMO NOVI SYSTEM_INSTRUCTION
-        'role': 'user', 
-        'parts': [{'text': SYSTEM_INSTRUCTION + "\n\n--- KONTEKST FIKCIJE JE POSTAVLJEN ---"}]
-    })
-
-    # Dodavanje prethodne konverzacije (konvertovano iz JSON-a)
-    for entry in history:
-        role = 'user' if entry['role'] == 'user' else 'model' 
-        full_contents.append({'role': role, 'parts': [{'text': entry['content']}]})
+    if update_dispatcher.submit(get_update_chat_key(update), process_update, update):
+        return True
 
-    
-    # Finalni prompt sa zadatkom za AI
-    # V10.61: Provera za novu Long uvodnu fazu
-    is_transitional_phase = current_stage_key in ["FAZA_2_UVOD_LONG", "FAZA_3_FINAL_PROMPT"]
-    
-    if is_transitional_phase:
-        final_prompt_task = "Generiši kratak odgovor (maks. 3 rečenice), dajući objašnjenje i pojačavajući pritisak, a zatim OBAVEZNO zatraži od igrača da POTVRDI da je spreman za nastavak."
-        required_phrase_for_prompt = "Potvrda (nastavi/ok/spreman sam)"
-    else:
-        # V10.62 FIX: Uputstvo za AI da ne ponavlja duge A/B/C opcije, samo referencira pitanje.
-        final_prompt_task = "Generiši kratak odgovor (maks. 4 rečenice), dajući traženo objašnjenje i/ili pojačavajući pritisak, a zatim OBAVEZNO zatraži od igrača da ODGOVORI na poslednje, već postavljeno pitanje. Ne ponavljaj duge A, B, C opcije pitanja, samo referenciraj da MORAJU da odgovore. Vreme je kritično!"
-        required_phrase_for_prompt = required_phrase
-    
-    final_prompt_text = (
-        f"Korisnik je postavio kontekstualno pitanje/komentar: '{user_input}'. "
-        f"Tvoj poslednji zadatak je bio: '{required_phrase_for_prompt}'. "
-        f"{final_prompt_task} **ODGOVORI MORAJU BITI PLAIN TEXT, BEZ MARKDOWN FORMATIRANJA (npr. bez boldovanja, kurziva).**"
-    )
-    # Dodajemo finalni prompt
-    full_contents.append({'role': 'user', 'parts': [{'text': final_prompt_text}]})
+    if UPDATE_QUEUE_POLICY == 'inline':
+        logging.warning("Red update-a je pun. Obrada se vrši direktno u zahtevu.")
+        process_update(update)
+        return True
+    if UPDATE_QUEUE_POLICY == 'drop':
+        logging.error(f"Red update-a je pun ({update_dispatcher.depth}). Update {update.update_id} je odbačen.")
+        return True
 
+    logging.warning(f"Red update-a je pun ({update_dispatcher.depth}). Telegram će ponoviti update {update.update_id}.")
+    return False
 
-    if not ai_client:
-        AI_FALLBACK_MESSAGES = ["Veza je nestabilna. Ponavljaj poruku.", "Čujem samo šum… ponovi!"]
-        narrative_starter = random.choice(AI_FALLBACK_MESSAGES)
-        ai_text = f"{narrative_starter}\n\n{required_phrase}"
-    else:
+
+# V10.66: Deduplikacija update-a koje Telegram ponovo šalje posle sporog odgovora
+UPDATE_DEDUP_SIZE = int(os.environ.get('UPDATE_DEDUP_SIZE', '10000'))
+UPDATE_DEDUP_TTL = int(os.environ.get('UPDATE_DEDUP_TTL', '3600'))
+UPDATE_DEDUP_DB = os.environ.get('UPDATE_DEDUP_DB', '0') == '1'
+UPDATE_DEDUP_PRUNE_EVERY = 500
+
+
+class UpdateDeduplicator:
+    """
+    V10.66: Ograničen TTL/LRU skup već viđenih update_id vrednosti.
+
+    Lokalna memorija odgovara na većinu ponavljanja; opciono se update_id upisuje
+    i u tabelu processed_updates, pa ponovljeni update ne prolazi ni kada ga
+    Telegram isporuči drugom gunicorn radniku.
+    """
+
+    def __init__(self, maxsize=UPDATE_DEDUP_SIZE, ttl=UPDATE_DEDUP_TTL, use_db=UPDATE_DEDUP_DB):
+        self._lock = threading.Lock()
+        self._seen = collections.OrderedDict()  # update_id -> vreme prijema
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.use_db = use_db
+        self._db_inserts = 0
+        self.hits = 0
+        self.misses = 0
+        self.db_hits = 0
+
+    def _seen_locally(self, update_id, now):
+        seen_at = self._seen.get(update_id)
+        if seen_at is None:
+            return False
+        if now - seen_at > self.ttl:
+            del self._seen[update_id]
+            return False
+        self._seen.move_to_end(update_id)
+        return True
+
+    def _remember(self, update_id, now):
+        self._seen[update_id] = now
+        self._seen.move_to_end(update_id)
+        while len(self._seen) > self.maxsize:
+            self._seen.popitem(last=False)
+
+    def is_duplicate(self, update_id):
+        """Vraća True ako je update već primljen; u suprotnom ga beleži kao viđen."""
+        now = int(time.time())
+        with self._lock:
+            if self._seen_locally(update_id, now):
+                self.hits += 1
+                return True
+            self._remember(update_id, now)
+
+        if self.use_db and Session is not None and self._claim_in_db(update_id, now) is False:
+            with self._lock:
+                self.hits += 1
+                self.db_hits += 1
+            return True
+
+        with self._lock:
+            self.misses += 1
+        return False
+
+    def forget(self, update_id):
+        """Poništava beleženje (npr. kada vraćamo 503 i Telegram mora ponovo da pošalje)."""
+        with self._lock:
+            self._seen.pop(update_id, None)
+        if self.use_db and Session is not None:
+            session = Session()
+            try:
+                session.query(ProcessedUpdate).filter_by(update_id=update_id).delete()
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Neuspešno brisanje update_id {update_id} iz evidencije: {e}")
+            finally:
+                session.close()
+
+    def _claim_in_db(self, update_id, now):
+        """True - prvi put viđen, False - već obrađen u drugom radniku, None - baza nedostupna."""
+        session = Session()
         try:
-            response = ai_client.models.generate_content(
-                model=GEMINI_MODEL_NAME, 
-                contents=full_contents
-            )
-            narrative_starter = response.text.strip()
-            
-            if not narrative_starter or len(narrative_starter) < 5: 
-                 raise ValueError("AI vratio prazan odgovor.")
-                
-            ai_text = narrative_starter
-            
+            session.add(ProcessedUpdate(update_id=update_id, received_at=now))
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            return False
         except Exception as e:
-            logging.error(f"AI Call failed. Falling back. Error: {e}")
-            AI_FALLBACK_MESSAGES = ["Veza je nestabilna. Ponavljaj poruku.", "Čujem samo šum… ponovi!"]
-            narrative_starter = random.choice(AI_FALLBACK_MESSAGES)
-            ai_text = f"{narrative_starter}\n\n{required_phrase}" 
+            # Bez baze ne blokiramo obradu - lokalna deduplikacija i dalje važi
+            session.rollback()
+            logging.error(f"Deduplikacija u bazi nije uspela za {update_id}: {e}")
+            return None
+        finally:
+            session.close()
 
-    if ai_text:
-        # Ažuriranje istorije razgovora novim odgovorom bota
-        final_history = json.loads(player.conversation_history) + [{'role': 'model', 'content': ai_text}]
-        player.conversation_history = json.dumps(final_history)
-        player.general_conversation_count += 1 
+        self._db_inserts += 1
+        if self._db_inserts % UPDATE_DEDUP_PRUNE_EVERY == 0:
+            self._prune_db(now)
+        return True
 
-    return ai_text or "Signal se raspao. Pokušaj /start.", player
+    def _prune_db(self, now):
+        session = Session()
+        try:
+            session.query(ProcessedUpdate).filter(ProcessedUpdate.received_at < now - self.ttl).delete(synchronize_session=False)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logging.error(f"Neuspešno čišćenje tabele processed_updates: {e}")
+        finally:
+            session.close()
 
-def get_epilogue_message(end_key):
-    return END_MESSAGES.get(end_key, f"[{end_key}] VEZA PREKINUTA.")
 
+update_dedup = UpdateDeduplicator()
 
-# ----------------------------------------------------
-# 6. WEBHOOK RUTE (V10.33 FIX: one_json -> de_json)
-# ----------------------------------------------------
 
 @app.route('/' + BOT_TOKEN, methods=['POST'])
 def webhook():
@@ -402,8 +4403,19 @@ def webhook():
             # V10.33 FIX: Ispravljeno 'one_json' u 'de_json'
             update = telebot.types.Update.de_json(json_string) 
             
+            # V10.76: Čistač isteklih sesija radi u svakom radniku koji prima update-e
+            session_sweeper.ensure_started()
+
             if update.message or update.edited_message or update.callback_query or update.channel_post:
-                bot.process_new_updates([update])
+                # V10.66: Ponovljena isporuka istog update-a se samo potvrđuje
+                if update_dedup.is_duplicate(update.update_id):
+                    logging.info(f"Duplikat update-a {update.update_id} ignorisan.")
+                    return ''
+
+                # V10.65: Pun red -> 503, pa Telegram kasnije ponavlja isporuku
+                if not dispatch_update(update):
+                    update_dedup.forget(update.update_id)
+                    return '', 503
             else:
                 logging.info(f"Primljena neobrađena poruka tipa: {json.loads(json_string).keys()}")
 
@@ -418,16 +4430,112 @@ def webhook():
         flask.abort(403)
 
 
+def get_webhook_url():
+    return WEBHOOK_URL.rstrip('/') + '/' + BOT_TOKEN
+
+
+def ensure_webhook(force=False):
+    """
+    V10.79: Postavlja webhook samo ako Telegram već nema isti URL. Svaki radnik
+    ranije radi remove_webhook + set_webhook pri pokretanju, što je na kratko
+    gasilo webhook. Vraća True ako je webhook (već) ispravno postavljen.
+    """
+    url = get_webhook_url()
+    if not force:
+        info = bot.get_webhook_info()
+        if info.url == url:
+            logging.info("Webhook je već postavljen na ispravan URL. Bez promene.")
+            return True
+    return bot.set_webhook(url=url)
+
+
+@app.before_request
+def start_request_timer():
+    flask.g.request_started = time.perf_counter()
+
+
+@app.teardown_request
+def observe_request_time(error=None):
+    started = flask.g.get('request_started')
+    if started is not None:
+        WEBHOOK_SECONDS.observe(time.perf_counter() - started, flask.request.endpoint or 'unknown')
+
+
+def get_metrics_denial(supplied):
+    """
+    V10.90: HTTP status odbijanja za /metrics i /stats ili None kada je pristup dozvoljen.
+    Bez METRICS_TOKEN rute ne postoje (404) osim uz METRICS_PUBLIC=1; deli ga ASGI režim.
+    """
+    if not METRICS_TOKEN:
+        return None if METRICS_PUBLIC else 404
+    if not supplied or not hmac.compare_digest(supplied.encode('utf-8'), METRICS_TOKEN.encode('utf-8')):
+        return 403
+    return None
+
+
+def require_metrics_token():
+    """V10.80: Sa METRICS_TOKEN traži ?token= ili Bearer zaglavlje (V10.86: deli ga i /stats)."""
+    supplied = flask.request.args.get('token') or flask.request.headers.get('Authorization', '').replace('Bearer ', '', 1)
+    denial = get_metrics_denial(supplied)
+    if denial is not None:
+        flask.abort(denial)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_route():
+    """V10.80: Metrike za Prometheus."""
+    require_metrics_token()
+    return flask.Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/stats', methods=['GET'])
+def stats_route():
+    """V10.86: Levak igre po fazi iz unapred sabranih brojača (dnevnik događaja se ne čita)."""
+    require_metrics_token()
+    return flask.jsonify(funnel_report())
+
+
+metrics.register_stats('zavet_player_cache', player_cache.stats)
+metrics.register_stats('zavet_chat_guard', chat_guard.stats)
+metrics.register_stats('zavet_telegram_limiter', telegram_limiter.stats)
+metrics.register_stats('zavet_ai_response_cache', ai_response_cache.stats)
+metrics.register_stats('zavet_prompt_builder', prompt_builder.stats)
+metrics.register_stats('zavet_session_sweeper', session_sweeper.stats)
+metrics.register_stats('zavet_game_events', game_events.stats)
+metrics.register_stats('zavet_ai_flood', ai_flood_control.stats)
+metrics.register_stats('zavet_delivery', lambda: {
+    'sent': delivery.sent_count, 'failed': delivery.failed_count, 'pending': delivery.pending_count()})
+metrics.register_stats('zavet_update_queue', lambda: {
+    'depth': update_dispatcher.depth, 'peak_depth': update_dispatcher.peak_depth,
+    'accepted': update_dispatcher.accepted_count, 'rejected': update_dispatcher.rejected_count})
+metrics.register_stats('zavet_update_dedup', lambda: {
+    'hits': update_dedup.hits, 'misses': update_dedup.misses, 'db_hits': update_dedup.db_hits})
+metrics.register_stats('zavet_gemini', lambda: {
+    'calls': ai_gateway.calls, 'timeouts': ai_gateway.timeouts, 'errors': ai_gateway.errors,
+    'rejected': ai_gateway.rejected, 'hedges': ai_gateway.hedges, 'hedge_wins': ai_gateway.hedge_wins,
+    'hedge_delay_seconds': ai_gateway.hedge_delay() or 0.0,
+    'in_flight': ai_gateway.in_flight, 'context_cache_refreshes': prompt_context.refreshes,
+    'context_cache_failures': prompt_context.failures, 'context_cache_invalidations': prompt_context.invalidations})
+metrics.register_stats('zavet_gemini_breaker', ai_gateway.breaker.stats)
+metrics.register_stats('zavet_intent_matcher', lambda: {
+    'matches': stage_machine.intent_matcher.matches if stage_machine.intent_matcher else 0,
+    'rejections': stage_machine.intent_matcher.rejections if stage_machine.intent_matcher else 0})
+metrics.register_stats('zavet_markdown', markdown_renderer.stats)
+metrics.register_stats('zavet_http_telegram', telegram_connection_stats)
+metrics.register_stats('zavet_http_gemini', gemini_connections.stats)
+metrics.register_stats('zavet_boot_ms', lambda: dict(BOOT_REPORT))
+
+
 @app.route('/set_webhook', methods=['GET'])
 def set_webhook_route():
     if BOT_TOKEN == "DUMMY:TOKEN_FAIL":
         return "Failed: BOT_TOKEN nije postavljen.", 200
 
-    webhook_url_with_token = WEBHOOK_URL.rstrip('/') + '/' + BOT_TOKEN
+    webhook_url_with_token = get_webhook_url()
     
     try:
-        bot.remove_webhook() 
-        s = bot.set_webhook(url=webhook_url_with_token)
+        # V10.79: set_webhook zamenjuje stari URL - bez remove_webhook, pa se ne gube update-i na čekanju
+        s = ensure_webhook(force=True)
         if s:
             return f"Webhook successfully set to: {webhook_url_with_token}! Bot je spreman. Pošaljite /start!"
         else:
@@ -442,280 +4550,389 @@ def set_webhook_route():
 # 7. BOT HANDLERI (V10.61 - Vraćanje Long Uvoda)
 # ----------------------------------------------------
 
-@bot.message_handler(commands=['start', 'stop', 'pokreni'])
-def handle_commands(message):
-    
-    session = Session()
-    try:
-        if not is_game_active():
-            send_msg(message, TIME_LIMIT_MESSAGE)
-            return
+class HandlerOutcome:
+    """
+    V10.82: Ishod obrade poruke nezavisan od načina slanja - odgovori za igrača,
+    eventualni AI zahtev i da li stanje treba upisati. Isti ishod izvršava sinhroni
+    handler (delivery + ai_gateway) i ASGI režim (asgi_app.py, korutine).
+    V10.85: Metrike i kontrola naleta se primenjuju tek posle upisa (settle), jer se
+    procena posle sukoba verzija ponavlja. V10.86: isto važi za događaje igre.
+    """
+    __slots__ = ('replies', 'ai_request', 'player', 'commit', 'counts', 'events')
 
-        is_db_active = session is not None and Session is not None
+    def __init__(self):
+        self.replies = []       # [(tekst ili lista, add_warning, elapsed_time)]
+        self.ai_request = None  # (stage_key, tekst, elapsed_time) - AI odgovor na poruku
+        self.player = None
+        self.commit = False
+        self.counts = []        # [(brojač, oznaka)]
+        self.events = []        # [(vrsta, chat_id, faza, sledeća faza, detalj)]
 
-        if not is_db_active: 
-            send_msg(message, "⚠️ UPOZORENJE: Trajno stanje (DB) nije dostupno. Igrate u test modu bez pamćenja napretka.")
-            if message.text.lower() in ['/start', 'start']:
-                start_message_raw = GAME_STAGES["START_PROVERA"]["text"][0]
-                
-                # V10.60 FIX: Uklonjen glitch tekst
-                messages_to_send = [start_message_raw] 
-                
-                send_msg(message, messages_to_send)
-            return
+    def reply(self, text, add_warning=False, elapsed_time=0):
+        self.replies.append((text, add_warning, elapsed_time))
 
-        chat_id = str(message.chat.id)
+    def count(self, counter, label):
+        self.counts.append((counter, label))
 
-        if message.text.lower() in ['/start', 'start']:
-            current_time = int(time.time())
-            player = session.query(PlayerState).filter_by(chat_id=chat_id).first()
-            if player:
-                player.current_riddle = "START_PROVERA" 
-                player.solved_count = 0
-                # V10.37: Resetovanje skora
-                player.score = 0 
-                player.general_conversation_count = 0
-                player.conversation_history = '[]' 
-                player.is_disqualified = False
-                # V10.8: Postavljanje start_time
-                player.start_time = current_time 
-            else:
-                user = message.from_user
-                display_name = user.username or f"{user.first_name} {user.last_name or ''}".strip()
-                player = PlayerState(
-                    chat_id=chat_id, current_riddle="START_PROVERA", solved_count=0, 
-                    # V10.37: Resetovanje skora
-                    score=0, 
-                    conversation_history='[]',
-                    is_disqualified=False, username=display_name, general_conversation_count=0,
-                    # V10.8: Postavljanje start_time
-                    start_time=current_time
-                )
-                session.add(player)
+    def event(self, kind, chat_id, stage=None, next_stage=None, detail=None):
+        self.events.append((kind, chat_id, stage, next_stage, detail))
 
-            session.commit()
-            
-            # V10.60 FIX: Uklonjen glitch tekst, šalje se samo Provera Signala
+    def settle(self, message):
+        """Posle upisa: metrike i (V10.77) kontrola naleta za AI zahtev."""
+        for counter, label in self.counts:
+            counter.inc(label)
+        for event in self.events:
+            game_events.record(*event)
+        if self.ai_request:
+            chat_id = str(message.chat.id)
+            stage_key, text, _ = self.ai_request
+            admission = ai_flood_control.admit(chat_id, stage_key, text, message)
+            if admission != AI_ADMITTED:
+                self.ai_request = None
+            if admission == AI_DROPPED:
+                logging.info(f"Poruka za {chat_id} odbačena (kontrola naleta).")
+
+
+def commit_outcome(session, message, evaluate):
+    outcome = evaluate(session, message)
+    if outcome.commit:
+        session.commit()
+    return outcome
+
+
+def run_handler(evaluate, message):
+    """V10.85: evaluate_* i upis pod bravom chata (ponavlja se posle sukoba verzija)."""
+    outcome = run_chat_unit(str(message.chat.id), commit_outcome, message, evaluate)
+    outcome.settle(message)
+    return outcome
+
+
+def evaluate_command(session, message):
+    """V10.82: Komande /start, /stop i /pokreni nad stanjem igrača (bez slanja)."""
+    outcome = HandlerOutcome()
+    if not is_game_active():
+        outcome.reply(TIME_LIMIT_MESSAGE)
+        return outcome
+
+    is_db_active = session is not None
+
+    if not is_db_active: 
+        outcome.reply("⚠️ UPOZORENJE: Trajno stanje (DB) nije dostupno. Igrate u test modu bez pamćenja napretka.")
+        if message.text.lower() in ['/start', 'start']:
             start_message_raw = GAME_STAGES["START_PROVERA"]["text"][0]
             
-            messages_to_send = [start_message_raw]
+            # V10.60 FIX: Uklonjen glitch tekst
+            messages_to_send = [start_message_raw] 
             
-            send_msg(message, messages_to_send)
+            outcome.reply(messages_to_send)
+        return outcome
 
+    chat_id = str(message.chat.id)
 
-        elif message.text.lower() in ['/stop', 'stop']:
-            # V10.60 FIX: Dodat kompletan blok koda za /stop
-            player = session.query(PlayerState).filter_by(chat_id=chat_id).first()
-            if player and player.current_riddle:
-                # Brišemo prethodno stanje
-                session.delete(player)
-                session.commit()
-                send_msg(message, get_epilogue_message("END_STOP"))
-            else:
-                send_msg(message, "Nema aktivne veze za prekid.")
+    # V10.72: Komande menjaju stanje trajno - upis odmah, ne u sledećoj seriji
+    session.mark_durable()
+    # V10.77: Komanda poništava poruke koje čekaju zajednički AI poziv
+    ai_flood_control.cancel(chat_id)
+
+    if message.text.lower() in ['/start', 'start']:
+        current_time = int(time.time())
+        player = session.get_player(chat_id)
+        if player:
+            player.current_riddle = "START_PROVERA" 
+            player.solved_count = 0
+            # V10.37: Resetovanje skora
+            player.score = 0 
+            player.general_conversation_count = 0
+            player.conversation_history = '[]' 
+            # V10.71: Nova igra počinje bez stare istorije
+            session.clear_turns(chat_id)
+            player.is_disqualified = False
+            # V10.8: Postavljanje start_time
+            player.start_time = current_time 
+        else:
+            user = message.from_user
+            display_name = user.username or f"{user.first_name} {user.last_name or ''}".strip()
+            player = PlayerState(
+                chat_id=chat_id, current_riddle="START_PROVERA", solved_count=0, 
+                # V10.37: Resetovanje skora
+                score=0, 
+                conversation_history='[]',
+                is_disqualified=False, username=display_name, general_conversation_count=0,
+                # V10.8: Postavljanje start_time
+                start_time=current_time
+            )
+            session.add(player)
+
+        outcome.commit = True
+        outcome.event('start', chat_id, None, "START_PROVERA")
+        
+        # V10.60 FIX: Uklonjen glitch tekst, šalje se samo Provera Signala
+        start_message_raw = GAME_STAGES["START_PROVERA"]["text"][0]
+        
+        messages_to_send = [start_message_raw]
+        
+        outcome.reply(messages_to_send)
 
-        elif message.text.lower() in ['/pokreni', 'pokreni']:
-            # V10.60 FIX: Dodat kompletan blok koda za /pokreni
-            send_msg(message, "Komande nisu potrebne. Odgovori direktno na poruke. Ako želiš novi početak, koristi /start.")
+
+    elif message.text.lower() in ['/stop', 'stop']:
+        # V10.60 FIX: Dodat kompletan blok koda za /stop
+        player = session.get_player(chat_id)
+        if player and player.current_riddle:
+            # Brišemo prethodno stanje
+            session.clear_turns(chat_id)
+            session.delete(player)
+            outcome.commit = True
+            outcome.event('stop', chat_id, player.current_riddle, "END_STOP")
+            outcome.reply(get_epilogue_message("END_STOP"))
+        else:
+            outcome.reply("Nema aktivne veze za prekid.")
+
+    elif message.text.lower() in ['/pokreni', 'pokreni']:
+        # V10.60 FIX: Dodat kompletan blok koda za /pokreni
+        outcome.reply("Komande nisu potrebne. Odgovori direktno na poruke. Ako želiš novi početak, koristi /start.")
+    return outcome
+
+
+@bot.message_handler(commands=['start', 'stop', 'pokreni'])
+def handle_commands(message):
+    
+    # V10.72: Stanje ide kroz keš; V10.85: pod bravom chata
+    try:
+        outcome = run_handler(evaluate_command, message)
+        for reply in outcome.replies:
+            send_msg(message, *reply)
     except Exception as e:
         # DB log greške ostaje, ali sada ne bi trebalo da se odnosi na UndefinedColumn
         logging.error(f"GREŠKA U BAZI (handle_commands): {e}")
-        if session: session.rollback()
         send_msg(message, "Žao mi je, došlo je do greške u sistemu pri komandi. (DB FAILED)")
+
+
+def respond_with_ai(message, player, current_stage_key, user_text, elapsed_time):
+    """Odgovor AI-ja na poruku koju mašina stanja nije prepoznala (V10.77: i na spojene poruke)."""
+    ai_response, updated_player, streamed = generate_ai_response(
+        user_text, player, current_stage_key, session=open_state_session(),
+        stream_message=message, elapsed_time=elapsed_time
+    )
+
+    if streamed:
+        # V10.70: Odgovor je već strimovan u chat
+        pass
+    elif ai_response:
+        # V10.8: Dodajemo upozorenje
+        send_msg(message, ai_response, add_warning=True, elapsed_time=elapsed_time)
+    else:
+         send_msg(message, "Veza je nestabilna. Moramo brzo! Ponovi odgovor!")
+    if ai_response:
+        record_ai_turn(player.chat_id, ai_response)
+    return updated_player
+
+
+def is_coalesced_request_stale(player, stage_key):
+    """
+    V10.77: Spojene poruke se odbacuju ako je igra u međuvremenu prešla u drugu
+    fazu ili se završila (V10.82: izdvojeno, deli ga ASGI režim).
+    """
+    if not player or player.is_disqualified or player.current_riddle != stage_key:
+        return True
+    elapsed_time = int(time.time()) - player.start_time
+    current_stage = stage_machine.get(stage_key)
+    # Istek obrađuje sledeća poruka igrača ili čistač sesija
+    return elapsed_time >= TIME_LIMIT_SECONDS and current_stage.timed
+
+
+def load_coalesced_player(chat_id, stage_key):
+    """
+    V10.90: Sveže stanje igrača za spojene poruke, ili None ako su zastarele
+    (deli ga ASGI režim).
+    """
+    session = open_state_session()
+    if session is None:
+        return None
+    try:
+        player = session.get_player(chat_id)
     finally:
-        if session: session.close()
+        session.close()
+    if is_coalesced_request_stale(player, stage_key):
+        ai_flood_control.record_stale()
+        return None
+    return player
 
 
-@bot.message_handler(func=lambda message: not message.text.startswith('/'))
-def handle_general_message(message):
-    
-    session = Session()
+def process_coalesced_messages(stage_key, text, message):
+    """
+    V10.77: Jedan AI poziv za poruke spojene u prozoru kontrole naleta. Stanje se
+    čita ponovo - ako je igra u međuvremenu prešla u drugu fazu ili se završila,
+    spojene poruke se odbacuju.
+    """
     try:
-        if not is_game_active():
-            send_msg(message, TIME_LIMIT_MESSAGE)
+        player = load_coalesced_player(str(message.chat.id), stage_key)
+        if player is None:
             return
+        elapsed_time = int(time.time()) - player.start_time
+        respond_with_ai(message, player, stage_key, text, elapsed_time)
+    except Exception as e:
+        logging.error(f"GREŠKA U BAZI (process_coalesced_messages): {e}")
 
-        if session is None: 
-            send_msg(message, "GREŠKA: Trajno stanje (DB) nije dostupno. Signal prekinut.")
-            return 
 
-        chat_id = str(message.chat.id)
-        korisnikov_tekst = message.text.strip() 
+def evaluate_general_message(session, message):
+    """
+    V10.82: Odluka o poruci igrača - istek vremena, prelaz faze ili AI odgovor - bez
+    slanja. AI poziv i upis stanja izvršava pozivalac (sinhrono ili kao korutina).
+    """
+    outcome = HandlerOutcome()
+    if not is_game_active():
+        outcome.reply(TIME_LIMIT_MESSAGE)
+        return outcome
 
-        player = session.query(PlayerState).filter_by(chat_id=chat_id).first()
+    if session is None: 
+        outcome.reply("GREŠKA: Trajno stanje (DB) nije dostupno. Signal prekinut.")
+        return outcome
 
-        # KRITIČNA PROVERA: Ako ne postoji igrač ili je diskvalifikovan
-        if not player or player.is_disqualified or player.current_riddle.startswith("END_"):
-            # Igracu je već poslata poruka o prekidu veze. Sada ignorišemo dalji input.
-            return # Silent exit, bez ponavljanja poruke o prekidu veze
+    chat_id = str(message.chat.id)
+    korisnikov_tekst = message.text.strip() 
 
-        # V10.8: Provera vremenskog limita
-        elapsed_time = int(time.time()) - player.start_time
-        if elapsed_time >= TIME_LIMIT_SECONDS and player.current_riddle not in ["END_SHARE", "END_WAIT", "END_STOP", "END_NO_SIGNAL", "START_PROVERA"]: # START_PROVERA dozvoljava da se završi
-            player.current_riddle = "END_LOCATED"
-            player.is_disqualified = True
-            session.commit()
-            send_msg(message, get_epilogue_message("END_LOCATED"))
-            return
-            
-        current_stage_key = player.current_riddle
-        current_stage = GAME_STAGES.get(current_stage_key)
-        
-        if not current_stage:
-            send_msg(message, "[GREŠKA: NEPOZNATA FAZA IGRE] Pokreni /start.")
-            return
+    player = session.get_player(chat_id)
+    outcome.player = player
 
-        next_stage_key = None
-        is_intent_recognized = False
-        korisnikov_tekst_lower = korisnikov_tekst.lower().strip() 
-        # V10.61: Robusnija tokenizacija
-        korisnikove_reci = set(korisnikov_tekst_lower.replace(',', ' ').replace('?', ' ').replace('.', ' ').split())
-        
-        # 1. KORAK: PROVERA KLJUČNIH REČI I TRANZICIJA 
-        
-        # V10.61: Provera START_PROVERA (tranzicija na LONG)
-        if current_stage_key == "START_PROVERA":
-            if korisnikov_tekst_lower.strip() in ["ne", "ne vidim", "ne vidimo", "necu"]:
-                next_stage_key = "END_NO_SIGNAL" 
-                is_intent_recognized = True
-            else:
-                # Bilo koji drugi odgovor se smatra uspostavljenom vezom.
-                next_stage_key = "FAZA_2_UVOD_LONG" 
-                is_intent_recognized = True
-        
-        # V10.61: Provera LONG UVODNE FAZE
-        elif current_stage_key == "FAZA_2_UVOD_LONG":
-            for keyword, next_key in current_stage["responses"].items():
-                keyword_reci = set(keyword.split())
-                
-                # Provera unosa (isto kao V10.57)
-                if len(keyword_reci) == 1:
-                    if korisnikov_tekst_lower.strip() == keyword:
-                        next_stage_key = next_key
-                        is_intent_recognized = True
-                        break
-                else:
-                    if keyword_reci.issubset(korisnikove_reci): 
-                        next_stage_key = next_key 
-                        is_intent_recognized = True
-                        break
-        
-        # Provera TEST FAZA (TEST_1, TEST_2, TEST_3, TEST_4, FINAL_PROMPT)
-        elif current_stage_key.startswith("FAZA_2_TEST") or current_stage_key == "FAZA_3_FINAL_PROMPT":
-            
-            # 🚨 PROVERA ZA FAZE SA TROSTRUKIM IZBOROM (TESTOVI 1, 2, 3):
-            if current_stage_key in ["FAZA_2_TEST_1", "FAZA_2_TEST_2", "FAZA_2_TEST_3"]: 
-                
-                # Provera da li je odgovor tačno "a", "b", ili "c" (celokupan input)
-                if korisnikov_tekst_lower in current_stage["responses"]:
-                    next_stage_key = current_stage["responses"][korisnikov_tekst_lower]
-                    is_intent_recognized = True
-                    
-                    # Logika bodovanja: Ako je odgovor tačan, dodajemo 1 na skor
-                    if korisnikov_tekst_lower == current_stage.get("correct_response"):
-                        player.score += 1
-
-            # V10.46: Posebna logika za FAZA_2_TEST_4 (Evaluacija skora)
-            elif current_stage_key == "FAZA_2_TEST_4":
-                if korisnikov_tekst_lower in current_stage["responses"]:
-                    is_intent_recognized = True
-                    # Bodovanje
-                    if korisnikov_tekst_lower == current_stage.get("correct_response"):
-                        player.score += 1
-                    
-                    # EVALUACIJA I ODREĐIVANJE SLEDEĆE FAZE
-                    if player.score == 4:
-                        next_stage_key = "FAZA_3_FINAL_PROMPT" # Prošao test, nastavlja na finalno pitanje
-                    else:
-                        next_stage_key = "END_FAILED_TEST" # Nije prošao, kraj igre
-
-            # Redovna provera za fazu FAZA_3_FINAL_PROMPT
-            elif current_stage_key == "FAZA_3_FINAL_PROMPT":
-                for keyword, next_key in current_stage["responses"].items():
-                    keyword_reci = set(keyword.split()) 
-                    
-                    # V10.57 FIX: Ista logika za jednosložne/višesložne odgovore
-                    if len(keyword_reci) == 1:
-                        if korisnikov_tekst_lower.strip() == keyword:
-                            next_stage_key = next_key
-                            is_intent_recognized = True
-                            break
-                    else:
-                        if keyword_reci.issubset(korisnikove_reci): 
-                            next_stage_key = next_key 
-                            is_intent_recognized = True
-                            break
+    # KRITIČNA PROVERA: Ako ne postoji igrač ili je diskvalifikovan
+    if not player or player.is_disqualified or player.current_riddle.startswith("END_"):
+        # Igracu je već poslata poruka o prekidu veze. Sada ignorišemo dalji input.
+        return outcome # Silent exit, bez ponavljanja poruke o prekidu veze
 
+    current_stage_key = player.current_riddle
+    # V10.74: Faza iz prevedene tabele prelaza
+    current_stage = stage_machine.get(current_stage_key)
 
-        # OBRADA REZULTATA
-        if is_intent_recognized:
-            # 3. KORAK: AKO JE PREPOZNAT KLJUČNI ODGOVOR (Prelazak u novu fazu)
-            player.current_riddle = next_stage_key
-            
-            if next_stage_key.startswith("END_"):
-                epilogue_message = get_epilogue_message(next_stage_key)
-                send_msg(message, epilogue_message)
-                
-                # BRISANJE STANJA IGRAČA NAKON ZAVRŠETKA IGRE
-                session.delete(player) 
-            else:
-                next_stage_data = GAME_STAGES.get(next_stage_key)
-                if next_stage_data:
-                    # Slanje sekvence poruka za novu fazu (jedna po jedna)
-                    response_text = next_stage_data["text"]
-                    
-                    # V10.8: Dodajemo upozorenje
-                    send_msg(message, response_text, add_warning=True, elapsed_time=elapsed_time)
-                    
-                else:
-                    send_msg(message, "[GREŠKA: NEPOZNATA SLEDEĆA FAZA] Signal se gubi.")
+    # V10.8: Provera vremenskog limita
+    elapsed_time = int(time.time()) - player.start_time
+    if elapsed_time >= TIME_LIMIT_SECONDS and (current_stage is None or current_stage.timed): # START_PROVERA dozvoljava da se završi
+        player.current_riddle = "END_LOCATED"
+        player.is_disqualified = True
+        outcome.count(SESSION_EXPIRATIONS, 'message')
+        outcome.event('expired', chat_id, current_stage_key, "END_LOCATED", 'message')
+        session.mark_durable()
+        outcome.commit = True
+        outcome.reply(get_epilogue_message("END_LOCATED"))
+        return outcome
+    
+    if not current_stage:
+        outcome.reply("[GREŠKA: NEPOZNATA FAZA IGRE] Pokreni /start.")
+        return outcome
+
+    outcome.commit = True
+    korisnikov_tekst_lower = korisnikov_tekst.lower().strip() 
+    korisnikove_reci = tokenize_words(korisnikov_tekst_lower)
+    
+    # 1. KORAK: PROVERA KLJUČNIH REČI I TRANZICIJA (V10.74: jedan pogled u tabelu prelaza)
+    transition = stage_machine.resolve(current_stage_key, korisnikov_tekst, player.score)
+    is_intent_recognized = transition is not None
+    if is_intent_recognized and transition.confidence < 1.0:
+        logging.info(f"Približno prepoznat odgovor '{transition.keyword}' za {chat_id} u fazi {current_stage_key} (pouzdanost {transition.confidence}).")
+
+    # OBRADA REZULTATA
+    if is_intent_recognized:
+        # 3. KORAK: AKO JE PREPOZNAT KLJUČNI ODGOVOR (Prelazak u novu fazu)
+        # Logika bodovanja: Ako je odgovor tačan, dodajemo 1 na skor
+        player.score += transition.score_delta
+        next_stage_key = transition.next_stage
+        player.current_riddle = next_stage_key
+        outcome.count(STAGE_TRANSITIONS, next_stage_key)
+        # V10.86: Tačnost se beleži samo za pitanja testa (faze sa correct_response)
+        correctness = None
+        if current_stage.correct_response is not None:
+            correctness = 'correct' if transition.score_delta > 0 else 'wrong'
+        outcome.event('answer', chat_id, current_stage_key, next_stage_key, correctness)
+        # V10.72: Prelaz faze se odmah upisuje u bazu
+        session.mark_durable()
+        # V10.77: Spojene poruke iz prethodne faze se više ne šalju AI-ju
+        ai_flood_control.cancel(chat_id)
         
-        if not is_intent_recognized:
-            # 4. KORAK: Ako NIJE PREPOZNATO (Igrač je postavio pitanje / Nerelevantan odgovor)
-            
-            # V10.61: Provera za LONG UVOD
-            is_transitional_phase = current_stage_key in ["FAZA_2_UVOD_LONG", "FAZA_3_FINAL_PROMPT"]
-            
-            # Ako je u tranzitnoj fazi ili je postavio pitanje
-            if is_transitional_phase or len(korisnikove_reci) > 0: # Uvek prolazi AI ako je tekst duzi od 0
+        if transition.is_terminal:
+            epilogue_message = get_epilogue_message(next_stage_key)
+            outcome.reply(epilogue_message)
             
-                ai_response, updated_player = generate_ai_response(korisnikov_tekst, player, current_stage_key)
-                player = updated_player 
+            # BRISANJE STANJA IGRAČA NAKON ZAVRŠETKA IGRE
+            session.clear_turns(chat_id)
+            session.delete(player) 
+        else:
+            next_stage_data = stage_machine.get(next_stage_key)
+            if next_stage_data:
+                # Slanje sekvence poruka za novu fazu (jedna po jedna)
+                response_text = list(next_stage_data.text)
+                
+                # V10.8: Dodajemo upozorenje
+                outcome.reply(response_text, add_warning=True, elapsed_time=elapsed_time)
                 
-                if ai_response:
-                    # V10.8: Dodajemo upozorenje
-                    send_msg(message, ai_response, add_warning=True, elapsed_time=elapsed_time)
-                else:
-                     send_msg(message, "Veza je nestabilna. Moramo brzo! Ponovi odgovor!")
             else:
-                 # Ignorisanje praznog unosa
-                 pass
+                outcome.reply("[GREŠKA: NEPOZNATA SLEDEĆA FAZA] Signal se gubi.")
+    
+    if not is_intent_recognized:
+        # 4. KORAK: Ako NIJE PREPOZNATO (Igrač je postavio pitanje / Nerelevantan odgovor)
+        
+        # V10.61: Provera za LONG UVOD (V10.74: oznaka 'transitional' u fazi)
+        is_transitional_phase = current_stage.transitional
+        
+        # Ako je u tranzitnoj fazi ili je postavio pitanje
+        if is_transitional_phase or len(korisnikove_reci) > 0: # Uvek prolazi AI ako je tekst duzi od 0
+        
+            # V10.77: Nalet poruka ide u jedan zajednički AI poziv (ili se odbacuje) - V10.85: u settle()
+            outcome.ai_request = (current_stage_key, korisnikov_tekst, elapsed_time)
+        else:
+             # Ignorisanje praznog unosa
+             pass
+    return outcome
 
-        session.commit()
+
+@bot.message_handler(func=lambda message: not message.text.startswith('/'))
+def handle_general_message(message):
+    
+    # V10.72: Stanje ide kroz keš; V10.85: odluka i upis pod bravom chata, AI poziv van nje
+    try:
+        outcome = run_handler(evaluate_general_message, message)
+        for reply in outcome.replies:
+            send_msg(message, *reply)
+        if outcome.ai_request:
+            respond_with_ai(message, outcome.player, *outcome.ai_request)
     except Exception as e:
         logging.error(f"GREŠKA U BAZI (handle_general_message): {e}")
-        if session: session.rollback() 
         send_msg(message, "Žao mi je, došlo je do kritične greške u prijemu poruke. Veza je nestabilna. (DB FAILED)")
-    finally:
-        if session: session.close()
 
 
 # ----------------------------------------------------
-# 8. POKRETANJE APLIKACIJE (Isto kao V9.4)
+# 8. POKRETANJE APLIKACIJE (V10.79: Jednom po procesu, bez resetovanja webhooka)
 # ----------------------------------------------------
 
-if __name__ != '__main__':
-    initialize_database() 
-    
+# V10.79: Gemini klijent se pravi u pozadini posle pokretanja, da prvi igrač ne čeka uvoz
+GEMINI_WARMUP = os.environ.get('GEMINI_WARMUP', '1') == '1'
+_startup_lock = threading.Lock()
+_startup_done = False
+
+
+def startup():
+    """
+    V10.79: Inicijalizacija procesa - baza, pozadinski poslovi i webhook. Poziva se
+    jednom (ponovni poziv ne radi ništa). Na kraju se loguje izveštaj o trajanju
+    koraka, za praćenje hladnog starta pri skaliranju.
+    """
+    global _startup_done
+    with _startup_lock:
+        if _startup_done:
+            return
+        _startup_done = True
+
+    boot_mark('moduli')
+    markdown_renderer.preload(static_message_texts())
+    boot_mark('tekstovi')
+    initialize_database()
+    boot_mark('baza')
+    session_sweeper.ensure_started()
+
     if BOT_TOKEN != "DUMMY:TOKEN_FAIL":
-        webhook_url_with_token = WEBHOOK_URL.rstrip('/') + '/' + BOT_TOKEN
-        
         try:
-            bot.remove_webhook()
-            success = bot.set_webhook(url=webhook_url_with_token)
+            success = ensure_webhook()
             
             if success:
-                 logging.info(f"Webhook uspešno postavljen: {webhook_url_with_token}")
+                 logging.info(f"Webhook spreman: {get_webhook_url()}")
             else:
                  logging.error(f"Neuspešno postavljanje Webhooka. Telegram API odbio zahtev.")
         except ApiTelegramException as e:
@@ -724,3 +4941,15 @@ if __name__ != '__main__':
             logging.critical(f"Kritična nepoznata greška pri postavljanju Webhooka: {e}")
     else:
         logging.critical("Webhook inicijalizacija preskočena jer BOT_TOKEN nedostaje. Proverite Render.")
+    boot_mark('webhook')
+
+    if GEMINI_API_KEY and GEMINI_WARMUP:
+        threading.Thread(target=get_ai_client, name='gemini-warmup', daemon=True).start()
+
+    BOOT_REPORT['ukupno'] = round((time.perf_counter() - BOOT_STARTED) * 1000, 1)
+    report = ", ".join(f"{step}={ms:.0f}ms" for step, ms in BOOT_REPORT.items())
+    logging.info(f"Pokretanje radnika {os.getpid()} završeno: {report}")
+
+
+if __name__ != '__main__':
+    startup()
@@ -0,0 +1,189 @@
+"""
+Provera prekidača kola i hedging-a oko Gemini poziva (V10.88).
+
+Pravi generate_ai_response() se poziva iz više niti prema lažnom Gemini-ju
+(tools/fake_gemini.py) kome se kvarovi menjaju dok test traje:
+
+    ispad    - zdrav Gemini, zatim svi zahtevi padaju posle --outage-latency
+               sekundi, pa oporavak. Meri se koliko dugo igrač čeka na odgovor
+               (ili rezervni odgovor) pre otvaranja kola, dok je kolo otvoreno i
+               posle probnih poziva.
+    rep      - deo zahteva (--slow-rate) kasni --slow-latency sekundi. Isti niz
+               poziva se meri bez i sa hedging-om (p50/p95/p99 i broj zahteva).
+
+Upotreba:
+    python tools/ai_fault_check.py
+    python tools/ai_fault_check.py --threads 16 --slow-rate 0.1 --slow-latency 3
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+STAGE = "FAZA_2_TEST_1"
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Prekidač kola i hedging Gemini poziva pod kvarovima")
+    parser.add_argument("--threads", type=int, default=8, help="istovremenih poziva (niti obrade)")
+    parser.add_argument("--calls", type=int, default=80, help="poziva po fazi")
+    parser.add_argument("--latency", type=float, default=0.1, help="kašnjenje zdravog Gemini-ja (s)")
+    parser.add_argument("--outage-latency", type=float, default=1.0, help="koliko traje neuspešan zahtev tokom ispada (s)")
+    parser.add_argument("--open-seconds", type=float, default=3.0, help="GEMINI_BREAKER_OPEN_SECONDS")
+    parser.add_argument("--slow-rate", type=float, default=0.04)
+    parser.add_argument("--slow-latency", type=float, default=2.0)
+    return parser.parse_args()
+
+
+def configure_environment(args):
+    """Podešavanja moraju biti postavljena pre uvoza flask_app."""
+    from tools import fake_gemini, fake_telegram
+
+    server, gemini = fake_gemini.start_server(0, latency=args.latency, jitter=args.latency / 4)
+    os.environ.update({
+        "BOT_TOKEN": "123456:FAULTCHECK",
+        "STATE_BACKEND": "memory",
+        "SESSION_SWEEP": "0",
+        "GEMINI_API_KEY": "faultcheck",
+        "GEMINI_BASE_URL": f"http://127.0.0.1:{server.server_address[1]}",
+        # Bez keša odgovora i keša instrukcija - svaki poziv ide do lažnog servera
+        "AI_CACHE_SIZE": "0",
+        "GEMINI_PROMPT_MODE": "system",
+        "GEMINI_MAX_CONCURRENCY": str(args.threads * 2),
+        "GEMINI_BREAKER_OPEN_SECONDS": str(args.open_seconds),
+        "GEMINI_HEDGE": "1",
+    })
+    fake_telegram.install(latency=0.0)
+    return gemini
+
+
+class Runner:
+    def __init__(self, game, threads):
+        self.game = game
+        self.threads = threads
+        self.counter = iter(range(10 ** 9))
+
+    def player(self):
+        return self.game.PlayerState(
+            chat_id="990000", username="igrac", current_riddle=STAGE, solved_count=0, score=0,
+            is_disqualified=False, general_conversation_count=0, conversation_history='[]',
+            start_time=int(time.time()),
+        )
+
+    def run(self, calls):
+        """Vraća listu (trajanje, razlog rezervnog odgovora ili None) po pozivu."""
+        fallbacks = self.game.AI_FALLBACKS
+        results = []
+        lock = threading.Lock()
+        todo = iter(range(calls))
+
+        def worker():
+            for _ in todo:
+                before = dict(fallbacks._values)
+                started = time.perf_counter()
+                self.game.generate_ai_response(f"ko si ti {next(self.counter)}?", self.player(), STAGE)
+                elapsed = time.perf_counter() - started
+                # Razlog se čita iz brojača (približno - niti rade istovremeno)
+                after = dict(fallbacks._values)
+                reason = next((key[0] for key, value in after.items() if value > before.get(key, 0)), None)
+                with lock:
+                    results.append((elapsed, reason))
+
+        threads = [threading.Thread(target=worker) for _ in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+
+def report(label, results, gemini=None, requests_before=0):
+    latencies = [elapsed for elapsed, _ in results]
+    reasons = {}
+    for _, reason in results:
+        reasons[reason or "gemini"] = reasons.get(reason or "gemini", 0) + 1
+    row = "".join(f"{percentile(latencies, p) * 1000:>9.0f}" for p in (50, 95, 99, 100))
+    requests = f"{gemini.requests - requests_before:>9}" if gemini else ""
+    print(f"{label:<24}{row}{requests}   {reasons}")
+
+
+def outage_scenario(args, game, gemini, runner):
+    print(f"\n== Ispad Gemini-ja (zahtev pada posle {args.outage_latency:.1f}s, kolo otvoreno {args.open_seconds:.0f}s)")
+    print(f"{'faza':<24}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}{'zahteva':>9}   odgovori")
+    breaker = game.ai_gateway.breaker
+
+    before = gemini.requests
+    report("zdrav", runner.run(args.calls), gemini, before)
+
+    gemini.set_faults(error_rate=1.0, latency=args.outage_latency)
+    before = gemini.requests
+    report("ispad", runner.run(args.calls), gemini, before)
+    print(f"{'':<24}stanje prekidača: {breaker.state}, otvaranja: {breaker.trips}")
+
+    # Probe dok Gemini još ne radi - kolo se ponovo otvara
+    time.sleep(args.open_seconds + 0.2)
+    before = gemini.requests
+    report("proba tokom ispada", runner.run(args.threads), gemini, before)
+    print(f"{'':<24}stanje prekidača: {breaker.state}, otvaranja: {breaker.trips}")
+
+    # Gemini radi ponovo: probe zatvaraju kolo (ostali pozivi za to vreme dobijaju rezervni odgovor)
+    gemini.set_faults(error_rate=0.0, latency=args.latency)
+    time.sleep(args.open_seconds + 0.2)
+    before = gemini.requests
+    report("proba posle oporavka", runner.run(args.threads), gemini, before)
+    before = gemini.requests
+    report("oporavak", runner.run(args.calls), gemini, before)
+    print(f"{'':<24}stanje prekidača: {breaker.state}, otvaranja: {breaker.trips}")
+
+
+def tail_scenario(args, game, gemini, runner):
+    print(f"\n== Spori rep ({args.slow_rate:.0%} zahteva kasni dodatnih {args.slow_latency:.1f}s)")
+    print(f"{'režim':<24}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}{'zahteva':>9}   odgovori")
+    gateway = game.ai_gateway
+    # Uzorci kašnjenja zdravog Gemini-ja za p95 prag
+    runner.run(game.GEMINI_HEDGE_MIN_SAMPLES * 2)
+    gemini.set_faults(slow_rate=args.slow_rate, slow_latency=args.slow_latency)
+    for hedging in (False, True):
+        gateway.hedging = hedging
+        hedges, wins = gateway.hedges, gateway.hedge_wins
+        before = gemini.requests
+        report("sa hedging-om" if hedging else "bez hedging-a", runner.run(args.calls * 2), gemini, before)
+        if hedging:
+            delay = gateway.hedge_delay() or 0.0
+            print(f"{'':<24}prag: {delay * 1000:.0f} ms, zaštitnih poziva: {gateway.hedges - hedges}, "
+                  f"pobeda zaštitnog: {gateway.hedge_wins - wins}")
+    gemini.set_faults(slow_rate=0.0)
+
+
+def main():
+    args = parse_args()
+    gemini = configure_environment(args)
+
+    import logging
+    logging.disable(logging.CRITICAL)  # očekivane greške poziva bi zatrpale izveštaj
+    import flask_app
+
+    runner = Runner(flask_app, args.threads)
+    flask_app.get_ai_client()
+    runner.run(args.threads)  # zagrevanje konekcija
+    outage_scenario(args, flask_app, gemini, runner)
+    tail_scenario(args, flask_app, gemini, runner)
+    # Pozadinske niti i asinhroni Gemini klijent se ne gase uredno - izlazimo odmah
+    sys.stdout.flush()
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+"""
+Provera usklađivanja istog chata između radnika (V10.85).
+
+Više procesa (kao gunicorn radnici, svaki sa svojim kešom stanja) istovremeno
+obrađuje odgovore istih igrača nad zajedničkom bazom. Svaki igrač kreće od
+FAZA_2_TEST_1 i dobija --messages istih odgovora ("b") raspoređenih po
+procesima u isto vreme. Pošto su odgovori isti, ispravan ishod ne zavisi od
+redosleda: to je stanje posle --messages uzastopnih odgovora. Izgubljen upis
+(dva radnika pročitaju isto stanje, poslednji upis pobeđuje) se vidi kao
+pogrešna faza ili skor.
+
+Svaki režim CHAT_CONCURRENCY se meri na novoj bazi. Izveštaj pokazuje i cenu
+usklađivanja: koliko se čekalo na bravu (u procesu i u bazi) i koliko je obrada
+ponovljeno posle sukoba verzija.
+
+Upotreba:
+    python tools/concurrency_check.py --workers 4 --chats 50
+    python tools/concurrency_check.py --db postgresql://localhost/zavet_bench --modes local,lock
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+START_STAGE = "FAZA_2_TEST_1"
+ANSWER = "b"
+FIRST_CHAT_ID = 810000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Istovremeni odgovori istog igrača na više procesa")
+    parser.add_argument("--workers", type=int, default=4, help="broj procesa (gunicorn radnika)")
+    parser.add_argument("--threads", type=int, default=4, help="niti po procesu")
+    parser.add_argument("--chats", type=int, default=40, help="broj igrača")
+    parser.add_argument("--messages", type=int, default=3, help="odgovora po igraču (raspoređeno po procesima)")
+    parser.add_argument("--db", default="sqlite", help="'sqlite' ili SQLAlchemy URL (npr. postgresql://...)")
+    parser.add_argument("--modes", default="local,auto", help="CHAT_CONCURRENCY režimi ('auto' = podrazumevani)")
+    parser.add_argument("--no-cache", action="store_true", help="PLAYER_CACHE=0")
+    # Interno: jedan radnik u zasebnom procesu
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--start-at", type=float, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def configure_environment(args, database_url, mode):
+    os.environ.update({
+        "BOT_TOKEN": "123456:CONCURRENCY",
+        "DATABASE_URL": database_url,
+        "SESSION_SWEEP": "0",
+        "PACING_ENABLED": "0",
+        "TELEGRAM_GLOBAL_RATE": "1000000",
+        "TELEGRAM_CHAT_RATE": "1000000",
+        "GEMINI_API_KEY": "",
+        "PLAYER_CACHE": "0" if args.no_cache else "1",
+    })
+    if mode != "auto":
+        os.environ["CHAT_CONCURRENCY"] = mode
+    else:
+        os.environ.pop("CHAT_CONCURRENCY", None)
+
+
+def import_game():
+    from tools import fake_telegram
+
+    fake_telegram.install(latency=0.0)
+    import logging
+    logging.disable(logging.WARNING)
+    import flask_app
+    return flask_app
+
+
+def expected_state(game, messages):
+    """Stanje posle `messages` uzastopnih odgovora (None = igra završena i obrisana)."""
+    stage, score = START_STAGE, 0
+    for _ in range(messages):
+        transition = game.stage_machine.resolve(stage, ANSWER, score)
+        if transition is None:
+            continue
+        score += transition.score_delta
+        stage = transition.next_stage
+        if transition.is_terminal:
+            return None
+    return stage, score
+
+
+def seed_players(game, chats):
+    now = int(time.time())
+    batch = []
+    for i in range(chats):
+        chat_id = str(FIRST_CHAT_ID + i)
+        player = game.PlayerState(
+            chat_id=chat_id, username=f"igrac{i}", current_riddle=START_STAGE, solved_count=0, score=0,
+            is_disqualified=False, general_conversation_count=0, conversation_history='[]', start_time=now,
+        )
+        batch.append((chat_id, player, [], True, None))
+    game.state_store.write_batch(batch)
+
+
+def run_child(args):
+    """Jedan radnik: svoj deo odgovora za sve igrače, u isto vreme kao ostali."""
+    game = import_game()
+    import telebot
+    from tools.fake_telegram import make_update
+
+    worker = args.child
+    shares = [j for j in range(args.messages) if j % args.workers == worker]
+    errors = []
+
+    def play(thread_index):
+        for i in range(thread_index, args.chats, args.threads):
+            chat_id = FIRST_CHAT_ID + i
+            for j in shares:
+                update_id = (i * args.messages + j) + 1
+                update = telebot.types.Update.de_json(json.dumps(make_update(update_id, chat_id, ANSWER)))
+                try:
+                    game.process_update(update)
+                except Exception as e:
+                    errors.append(str(e))
+
+    time.sleep(max(0.0, args.start_at - time.time()))
+    threads = [threading.Thread(target=play, args=(t,)) for t in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    game.delivery.drain(timeout=30)
+    game.player_cache.flush()
+
+    conflicts = {key[0]: value for key, value in game.STATE_CONFLICTS._values.items()}
+    print(json.dumps({"guard": game.chat_guard.stats(), "conflicts": conflicts, "errors": errors}))
+    sys.stdout.flush()
+    os._exit(0)
+
+
+def run_mode(args, mode):
+    if args.db == "sqlite":
+        database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='zavet-concurrency-'), 'state.db')}"
+    else:
+        database_url = args.db
+    configure_environment(args, database_url, mode)
+    # Baza i igrači se pripremaju u zasebnom procesu, da roditelj ostane bez keša i niti
+    setup = (
+        "import sys; sys.path.insert(0, %r)\n"
+        "from tools import concurrency_check as cc\n"
+        "game = cc.import_game()\n"
+        "game.Base.metadata.drop_all(game.Engine, tables=[game.PlayerState.__table__, game.ConversationTurn.__table__])\n"
+        "game.Base.metadata.create_all(game.Engine)\n"
+        "cc.seed_players(game, %d)\n"
+        "import os; os._exit(0)\n" % (ROOT, args.chats)
+    )
+    subprocess.run([sys.executable, "-c", setup], check=True, env=dict(os.environ))
+
+    start_at = time.time() + 3.0  # svi radnici kreću u istom trenutku, posle pokretanja
+    children = [
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--child", str(worker), "--start-at", str(start_at),
+             "--workers", str(args.workers), "--threads", str(args.threads),
+             "--chats", str(args.chats), "--messages", str(args.messages)],
+            stdout=subprocess.PIPE, text=True, env=dict(os.environ),
+        )
+        for worker in range(args.workers)
+    ]
+    results = [json.loads(child.communicate()[0].strip().splitlines()[-1]) for child in children]
+    elapsed = time.time() - start_at
+
+    check = (
+        "import sys, json; sys.path.insert(0, %r)\n"
+        "from tools import concurrency_check as cc\n"
+        "game = cc.import_game()\n"
+        "expected = cc.expected_state(game, %d)\n"
+        "wrong = []\n"
+        "for i in range(%d):\n"
+        "    player = game.state_store.load_player(str(cc.FIRST_CHAT_ID + i))\n"
+        "    actual = (player.current_riddle, player.score) if player else None\n"
+        "    if actual != expected: wrong.append(actual)\n"
+        "print(json.dumps({'expected': expected, 'wrong': wrong}))\n"
+        "import os; sys.stdout.flush(); os._exit(0)\n" % (ROOT, args.messages, args.chats)
+    )
+    output = subprocess.run([sys.executable, "-c", check], check=True, capture_output=True, text=True,
+                            env=dict(os.environ)).stdout
+    verdict = json.loads(output.strip().splitlines()[-1])
+    return results, verdict, elapsed
+
+
+def print_report(mode, results, verdict, args, elapsed):
+    conflicts = {}
+    for result in results:
+        for key, value in result["conflicts"].items():
+            conflicts[key] = conflicts.get(key, 0) + value
+    guard_mode = results[0]["guard"]["mode"] if results else "?"
+    local_waits = sum(result["guard"]["local_waits"] for result in results)
+    database_waits = sum(result["guard"]["database_waits"] for result in results)
+    errors = sum(len(result["errors"]) for result in results)
+    wrong = verdict["wrong"]
+    print(f"\n[{mode} -> {guard_mode}] ispravnih igrača: {args.chats - len(wrong)}/{args.chats}, "
+          f"očekivano {verdict['expected']}, trajanje {elapsed:.2f}s")
+    print(f"  čekanja na bravu: u procesu {local_waits}, u bazi {database_waits}; sukobi verzija: {conflicts or 0}; "
+          f"greške: {errors}")
+    if wrong:
+        summary = {}
+        for actual in wrong:
+            summary[str(actual)] = summary.get(str(actual), 0) + 1
+        print(f"  pogrešna stanja: {summary}")
+
+
+def main():
+    args = parse_args()
+    if args.child is not None:
+        run_child(args)
+        return
+    print(f"Radnika: {args.workers} x {args.threads} niti, igrača: {args.chats}, "
+          f"odgovora po igraču: {args.messages}, baza: {args.db}, keš: {'ne' if args.no_cache else 'da'}")
+    for mode in args.modes.split(","):
+        results, verdict, elapsed = run_mode(args, mode)
+        print_report(mode, results, verdict, args, elapsed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+"""
+Lažni Gemini API server za lokalno testiranje AI sloja (V10.67).
+
+Odgovara na generateContent i streamGenerateContent (SSE) pozive kao pravi API,
+uz podesivo kašnjenje, pa se rok po pozivu, ograničenje istovremenih poziva i
+strimovanje mogu proveriti bez pravog ključa.
+
+V10.88: Ubacivanje kvarova - deo zahteva vraća 503 UNAVAILABLE (--error-rate), a
+deo kasni dodatno (--slow-rate/--slow-latency, spori rep). Kvarovi se menjaju i
+dok server radi: state.set_faults(...) ili POST /_faults sa istim poljima u JSON-u.
+
+V10.89: Keširani kontekst (cachedContents: kreiranje, brisanje, cachedContent u
+pozivu). Kontekst manji od --cache-min-tokens se odbija kao na pravom API-ju, a
+poziv sa nepoznatim ili isteklim kešom vraća 404 (state.drop_caches() simulira
+brisanje na serveru).
+
+Upotreba:
+    python tools/fake_gemini.py --port 8089 --latency 0.5
+    python tools/fake_gemini.py --error-rate 0.5 --slow-rate 0.05 --slow-latency 5
+    curl -d '{"error_rate": 1.0}' http://127.0.0.1:8089/_faults
+    GEMINI_API_KEY=fake GEMINI_BASE_URL=http://127.0.0.1:8089 gunicorn flask_app:app
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FAKE_REPLIES = [
+    "Nema vremena za objašnjenja. Lociraće me! Odgovori na poslednje pitanje.",
+    "Ja sam Dimitrije iz Zaveta. Signal slabi - potvrdi da si spreman!",
+    "Zavet je poslednja linija odbrane. Brzo, odgovori pre nego što nas pronađu.",
+]
+
+
+class FakeGeminiState:
+    def __init__(self, latency=0.0, jitter=0.0, chunk_delay=0.05, error_rate=0.0, slow_rate=0.0, slow_latency=0.0,
+                 cache_min_tokens=1024):
+        self.latency = latency
+        self.jitter = jitter
+        self.chunk_delay = chunk_delay
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.failed = 0
+        self.slowed = 0
+        self.cache_min_tokens = cache_min_tokens
+        self.caches = {}  # ime -> (tokeni, istek)
+        self.cache_creates = 0
+        self.cache_rejects = 0
+        self.cache_deletes = 0
+        self.cache_misses = 0
+
+    def drop_caches(self):
+        """Briše sve keševe kao da su istekli na serveru."""
+        with self.lock:
+            self.caches.clear()
+
+    def create_cache(self, body):
+        """(status, odgovor) za POST cachedContents."""
+        tokens = body_text_chars(body) // 4
+        with self.lock:
+            if tokens < self.cache_min_tokens:
+                self.cache_rejects += 1
+                return 400, {"error": {"code": 400, "status": "INVALID_ARGUMENT", "message": (
+                    f"Cached content is too small. total_token_count={tokens}, "
+                    f"min_total_token_count={self.cache_min_tokens}")}}
+            self.cache_creates += 1
+            name = f"cachedContents/fake-{self.cache_creates}"
+            ttl = float(str(body.get("ttl") or "3600s").rstrip("s"))
+            self.caches[name] = (tokens, time.time() + ttl)
+        expire = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + ttl))
+        return 200, {"name": name, "model": body.get("model"), "displayName": body.get("displayName"),
+                     "expireTime": expire, "usageMetadata": {"totalTokenCount": tokens}}
+
+    def delete_cache(self, name):
+        with self.lock:
+            if self.caches.pop(name, None) is None:
+                return 404, {"error": {"code": 404, "status": "NOT_FOUND", "message": f"{name} not found"}}
+            self.cache_deletes += 1
+        return 200, {}
+
+    def cached_tokens(self, name):
+        """Broj tokena keša, ili None kada keš ne postoji ili je istekao."""
+        with self.lock:
+            entry = self.caches.get(name)
+            if entry is None or entry[1] < time.time():
+                self.cache_misses += 1
+                return None
+            return entry[0]
+
+    def set_faults(self, error_rate=None, slow_rate=None, slow_latency=None, latency=None):
+        """Menja kvarove dok server radi (None = bez promene)."""
+        with self.lock:
+            for name, value in (("error_rate", error_rate), ("slow_rate", slow_rate),
+                                ("slow_latency", slow_latency), ("latency", latency)):
+                if value is not None:
+                    setattr(self, name, float(value))
+
+    def draw_fault(self):
+        """Za jedan zahtev: (vrati grešku, dodatno kašnjenje)."""
+        with self.lock:
+            if random.random() < self.error_rate:
+                self.failed += 1
+                return True, 0.0
+            if random.random() < self.slow_rate:
+                self.slowed += 1
+                return False, self.slow_latency
+            return False, 0.0
+
+
+def build_response(text, prompt_chars, cached_tokens=0):
+    prompt_tokens = max(1, prompt_chars // 4) + cached_tokens
+    reply_tokens = max(1, len(text) // 4)
+    return {
+        "candidates": [{
+            "content": {"role": "model", "parts": [{"text": text}]},
+            "finishReason": "STOP",
+            "index": 0,
+        }],
+        "usageMetadata": {
+            "promptTokenCount": prompt_tokens,
+            "candidatesTokenCount": reply_tokens,
+            "totalTokenCount": prompt_tokens + reply_tokens,
+            "cachedContentTokenCount": cached_tokens,
+        },
+        "modelVersion": "fake-gemini",
+    }
+
+
+def prompt_text_chars(raw):
+    """Dužina teksta prompta (sadržaj i system_instruction) - osnova za promptTokenCount."""
+    try:
+        body = json.loads(raw or b"{}")
+    except ValueError:
+        return len(raw)
+    return body_text_chars(body)
+
+
+def body_text_chars(body):
+    blocks = list(body.get("contents") or [])
+    if body.get("systemInstruction"):
+        blocks.append(body["systemInstruction"])
+    return sum(len(part.get("text") or "") for block in blocks for part in block.get("parts") or [])
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, fmt, *args):
+            pass
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_stream(self, text, prompt_chars, cached_tokens=0):
+            # SSE odgovor (alt=sse): tekst po rečima, sa pauzom između delova
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            words = text.split(" ")
+            for i, word in enumerate(words):
+                chunk = word if i == len(words) - 1 else word + " "
+                payload = json.dumps(build_response(chunk, prompt_chars, cached_tokens))
+                self.wfile.write(f"data: {payload}\r\n\r\n".encode("utf-8"))
+                self.wfile.flush()
+                time.sleep(state.chunk_delay)
+            self.close_connection = True
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length)
+
+            if self.path == "/_faults":
+                state.set_faults(**json.loads(raw or b"{}"))
+                self._send_json(200, {"error_rate": state.error_rate, "slow_rate": state.slow_rate,
+                                      "slow_latency": state.slow_latency, "latency": state.latency})
+                return
+
+            if self.path.split("?")[0].endswith("/cachedContents"):
+                self._send_json(*state.create_cache(json.loads(raw or b"{}")))
+                return
+
+            streaming = ":streamGenerateContent" in self.path
+            if ":generateContent" not in self.path and not streaming:
+                self._send_json(404, {"error": {"code": 404, "message": "Not found", "status": "NOT_FOUND"}})
+                return
+
+            with state.lock:
+                state.requests += 1
+                state.in_flight += 1
+                state.peak_in_flight = max(state.peak_in_flight, state.in_flight)
+            try:
+                fail, extra_latency = state.draw_fault()
+                time.sleep(max(0.0, state.latency + random.uniform(-state.jitter, state.jitter)) + extra_latency)
+                if fail:
+                    self._send_json(503, {"error": {"code": 503, "message": "The model is overloaded.",
+                                                    "status": "UNAVAILABLE"}})
+                    return
+                cached_tokens = 0
+                cache_name = json.loads(raw or b"{}").get("cachedContent")
+                if cache_name:
+                    cached_tokens = state.cached_tokens(cache_name)
+                    if cached_tokens is None:
+                        self._send_json(404, {"error": {"code": 404, "status": "NOT_FOUND",
+                                                        "message": "CachedContent not found (or permission denied)"}})
+                        return
+                reply = random.choice(FAKE_REPLIES)
+                prompt_chars = prompt_text_chars(raw)
+                if streaming:
+                    self._send_stream(reply, prompt_chars, cached_tokens)
+                else:
+                    self._send_json(200, build_response(reply, prompt_chars, cached_tokens))
+            finally:
+                with state.lock:
+                    state.in_flight -= 1
+
+        def do_DELETE(self):
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            path = self.path.split("?")[0]
+            if "/cachedContents/" not in path:
+                self._send_json(404, {"error": {"code": 404, "message": "Not found", "status": "NOT_FOUND"}})
+                return
+            self._send_json(*state.delete_cache("cachedContents/" + path.split("/cachedContents/", 1)[1]))
+
+    return Handler
+
+
+class FakeGeminiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Klijent je otkazao zahtev (istek roka ili poraženi zaštitni poziv) - nije greška servera
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+
+def start_server(port=0, latency=0.0, jitter=0.0, **faults):
+    """
+    Pokreće server u pozadinskoj niti. Vraća (server, state); adresa je server.server_address.
+    faults: error_rate, slow_rate, slow_latency, cache_min_tokens (videti FakeGeminiState).
+    """
+    state = FakeGeminiState(latency=latency, jitter=jitter, **faults)
+    server = FakeGeminiServer(("127.0.0.1", port), make_handler(state))
+    threading.Thread(target=server.serve_forever, name="fake-gemini", daemon=True).start()
+    return server, state
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lažni Gemini API server")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.3, help="kašnjenje odgovora u sekundama")
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="udeo zahteva koji vraćaju 503")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="udeo zahteva sa dodatnim kašnjenjem")
+    parser.add_argument("--slow-latency", type=float, default=5.0, help="dodatno kašnjenje sporih zahteva (s)")
+    parser.add_argument("--cache-min-tokens", type=int, default=1024, help="najmanji keširani kontekst")
+    args = parser.parse_args()
+
+    server, state = start_server(args.port, args.latency, args.jitter, error_rate=args.error_rate,
+                                 slow_rate=args.slow_rate, slow_latency=args.slow_latency,
+                                 cache_min_tokens=args.cache_min_tokens)
+    print(f"Lažni Gemini sluša na http://127.0.0.1:{server.server_address[1]}")
+    try:
+        while True:
+            time.sleep(5)
+            print(f"zahtevi={state.requests} u_letu={state.in_flight} vrh={state.peak_in_flight} "
+                  f"greške={state.failed} spori={state.slowed}")
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
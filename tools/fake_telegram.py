@@ -0,0 +1,250 @@
+"""
+Lažni Telegram Bot API za lokalno testiranje (V10.75).
+
+Zamenjuje HTTP sloj pyTelegramBotAPI-ja (apihelper.CUSTOM_REQUEST_SENDER), pa
+webhook, slanje i izmena poruka rade bez mreže i pravog tokena. Svaki poziv se
+beleži, uz podesivo kašnjenje po pozivu. V10.81: Isti odgovori i preko HTTP-a
+(TELEGRAM_API_URL), kada treba meriti i trošak HTTP klijenta. V10.83: Tekst sa
+parse_mode se proverava kao na pravom API-ju - neispravan Markdown vraća 400
+"can't parse entities".
+
+Upotreba (pre uvoza flask_app):
+    from tools import fake_telegram
+    telegram = fake_telegram.install(latency=0.05)
+    import flask_app
+    ...
+    print(telegram.counts())
+
+    python tools/fake_telegram.py --port 8081 --latency 0.05
+    TELEGRAM_API_URL=http://127.0.0.1:8081 gunicorn flask_app:app
+"""
+import argparse
+import collections
+import json
+import ssl
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from telebot import apihelper
+
+
+MARKDOWN_V2_RESERVED = frozenset("_*[]()~`>#+-=|{}.!")
+
+
+def markdown_v2_error(text):
+    """Opis greške parsiranja MarkdownV2 (pojednostavljena pravila Bot API-ja), ili None."""
+    entities = []
+    code = None
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if char == "\\":
+            i += 2
+            continue
+        if code:
+            if text.startswith(code, i):
+                i += len(code)
+                code = None
+            else:
+                i += 1
+            continue
+        if char == "`":
+            code = "```" if text.startswith("```", i) else "`"
+            i += len(code)
+            continue
+        if char in "*_~":
+            if entities and entities[-1] == char:
+                entities.pop()
+            elif char in entities:
+                return f"Can't find end of {char} entity"
+            else:
+                entities.append(char)
+        elif char in MARKDOWN_V2_RESERVED:
+            return f"Character '{char}' is reserved and must be escaped with the preceding '\\'"
+        i += 1
+    if code or entities:
+        return "Can't find end of the entity"
+    return None
+
+
+def markdown_error(text):
+    """Isto za stari 'Markdown': oznake *, _ i ` moraju biti uparene, a [ zatvoren."""
+    open_char = None
+    for i, char in enumerate(text):
+        if open_char:
+            if char == open_char:
+                open_char = None
+        elif char in "*_`":
+            open_char = char
+        elif char == "[":
+            open_char = "]"
+    if open_char:
+        return f"Can't find end of the entity starting at byte offset {len(text)}"
+    return None
+
+
+class FakeResponse:
+    """Minimalni odgovor koji apihelper._check_result očekuje."""
+
+    reason = "OK"
+
+    def __init__(self, payload, status_code=200):
+        self.payload = payload
+        self.status_code = status_code
+        self.text = json.dumps(payload)
+
+    def json(self):
+        return self.payload
+
+
+class FakeTelegramState:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = []  # (vreme, metod, parametri)
+        self.parse_errors = 0
+        self.connections = 0  # prihvaćene TCP konekcije (samo HTTP režim)
+        self._message_id = 0
+
+    def counts(self):
+        with self.lock:
+            return dict(collections.Counter(name for _, name, _ in self.calls))
+
+    def sent_texts(self, chat_id=None):
+        with self.lock:
+            return [params.get("text") for _, name, params in self.calls
+                    if name == "sendMessage" and (chat_id is None or str(params.get("chat_id")) == str(chat_id))]
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+
+    def _next_message_id(self):
+        with self.lock:
+            self._message_id += 1
+            return self._message_id
+
+    def handle(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        name = url.rsplit("/", 1)[-1]
+        params = dict(params or {})
+        with self.lock:
+            self.calls.append((time.time(), name, params))
+        if self.latency:
+            time.sleep(self.latency)
+
+        if name == "getWebhookInfo":
+            return FakeResponse({"ok": True, "result": {"url": "", "has_custom_certificate": False, "pending_update_count": 0}})
+        if name in ("sendMessage", "editMessageText"):
+            parse_mode = params.get("parse_mode")
+            check = {"MarkdownV2": markdown_v2_error, "Markdown": markdown_error}.get(parse_mode)
+            error = check(params.get("text", "")) if check else None
+            if error:
+                with self.lock:
+                    self.parse_errors += 1
+                return FakeResponse({"ok": False, "error_code": 400,
+                                     "description": f"Bad Request: can't parse entities: {error}"}, 400)
+            return FakeResponse({"ok": True, "result": {
+                "message_id": int(params.get("message_id") or self._next_message_id()),
+                "date": int(time.time()),
+                "chat": {"id": int(params["chat_id"]), "type": "private"},
+                "text": params.get("text", ""),
+            }})
+        return FakeResponse({"ok": True, "result": True})
+
+
+def install(latency=0.0):
+    """Preusmerava sve Bot API pozive na lažni server i vraća njegovo stanje."""
+    state = FakeTelegramState(latency)
+    apihelper.CUSTOM_REQUEST_SENDER = state.handle
+    return state
+
+
+def make_update(update_id, chat_id, text):
+    """Telegram update (JSON) sa tekstualnom porukom, kakav stiže na webhook."""
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "Test", "username": f"igrac{chat_id}"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, fmt, *args):
+            pass
+
+        def setup(self):
+            super().setup()
+            with state.lock:
+                state.connections += 1
+
+        def _handle(self):
+            url = urlsplit(self.path)
+            params = dict(parse_qsl(url.query))
+            length = int(self.headers.get("Content-Length") or 0)
+            if length:
+                body = self.rfile.read(length).decode("utf-8")
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    params.update(json.loads(body))
+                else:
+                    params.update(parse_qsl(body))
+            # Putanja je /bot<token>/<metod>
+            response = state.handle(self.command.lower(), url.path, params)
+            payload = response.text.encode("utf-8")
+            self.send_response(response.status_code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        do_GET = _handle
+        do_POST = _handle
+
+    return Handler
+
+
+def start_server(port=0, latency=0.0, certfile=None, keyfile=None):
+    """
+    Pokreće HTTP server u pozadinskoj niti. Vraća (server, state); adresa je server.server_address.
+    V10.84: Sa certfile/keyfile server radi preko TLS-a (merenje troška uspostavljanja veze).
+    """
+    state = FakeTelegramState(latency)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(state))
+    server.daemon_threads = True
+    if certfile:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        # Rukovanje (handshake) teče u niti zahteva, ne u niti koja prihvata konekcije
+        server.socket = context.wrap_socket(server.socket, server_side=True, do_handshake_on_connect=False)
+    threading.Thread(target=server.serve_forever, name="fake-telegram", daemon=True).start()
+    return server, state
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lažni Telegram Bot API server")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.05, help="kašnjenje odgovora u sekundama")
+    args = parser.parse_args()
+
+    server, state = start_server(args.port, args.latency)
+    print(f"Lažni Telegram sluša na http://127.0.0.1:{server.server_address[1]}")
+    try:
+        while True:
+            time.sleep(5)
+            print(state.counts())
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
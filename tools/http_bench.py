@@ -0,0 +1,150 @@
+"""
+Benchmark izlaznog HTTP sloja ka Telegram Bot API-ju (V10.84).
+
+Isti niz send_message poziva (kroz telegram_call, kao u isporuci) meri se u
+tri režima HTTP_POOL_MODE, svaki u zasebnom procesu:
+    shared - jedna sesija sa poolom konekcija (podrazumevano),
+    thread - podrazumevano ponašanje telebot-a (sesija po niti),
+    none   - nova konekcija za svaki poziv.
+Server je lažni Telegram (tools/fake_telegram.py) preko HTTP-a, a uz --tls
+preko TLS-a sa privremenim samopotpisanim sertifikatom (potreban openssl),
+pa se vidi i trošak TLS rukovanja po poruci.
+
+Upotreba:
+    python tools/http_bench.py --messages 1000 --concurrency 8
+    python tools/http_bench.py --tls --latency 0.02
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+MODES = ("shared", "thread", "none")
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark HTTP konekcija ka Telegramu")
+    parser.add_argument("--messages", type=int, default=1000, help="broj poruka po režimu")
+    parser.add_argument("--concurrency", type=int, default=8, help="broj niti koje šalju (kao DELIVERY_WORKERS)")
+    parser.add_argument("--latency", type=float, default=0.0, help="kašnjenje lažnog servera po pozivu (s)")
+    parser.add_argument("--tls", action="store_true", help="server preko TLS-a")
+    parser.add_argument("--modes", default=",".join(MODES))
+    # Interno: jedan režim u zasebnom procesu
+    parser.add_argument("--child", choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument("--url", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def make_certificate(directory):
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", keyfile, "-out", certfile,
+         "-days", "1", "-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1"],
+        check=True, capture_output=True,
+    )
+    return certfile, keyfile
+
+
+def run_child(args):
+    """Šalje poruke u jednom režimu i ispisuje rezultat kao JSON (poslednji red)."""
+    os.environ.update({
+        "BOT_TOKEN": "123456:HTTPBENCH",
+        "TELEGRAM_API_URL": args.url,
+        "HTTP_POOL_MODE": args.child,
+        "STATE_BACKEND": "memory",
+        "SESSION_SWEEP": "0",
+        "GEMINI_WARMUP": "0",
+        "TELEGRAM_GLOBAL_RATE": "1000000",
+        "TELEGRAM_CHAT_RATE": "1000000",
+    })
+    import logging
+    logging.disable(logging.WARNING)
+    import flask_app
+
+    latencies = []
+    lock = threading.Lock()
+    counter = iter(range(args.messages))
+
+    def sender():
+        own = []
+        for i in counter:
+            chat_id = 700000 + i % 50
+            started = time.perf_counter()
+            flask_app.telegram_call(chat_id, flask_app.bot.send_message, chat_id, f"poruka {i}")
+            own.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(own)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=sender) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    print(json.dumps({"elapsed": elapsed, "latencies": latencies}))
+    sys.stdout.flush()
+    os._exit(0)
+
+
+def run_mode(args, mode, url, state, env):
+    before = state.connections
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", mode, "--url", url,
+         "--messages", str(args.messages), "--concurrency", str(args.concurrency)],
+        check=True, capture_output=True, text=True, env=env,
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    # Pokretanje (getWebhookInfo/setWebhook) otvara najviše jednu konekciju više
+    result["connections"] = state.connections - before
+    return result
+
+
+def main():
+    args = parse_args()
+    if args.child:
+        run_child(args)
+        return
+
+    from tools import fake_telegram
+
+    env = dict(os.environ)
+    certfile = keyfile = None
+    if args.tls:
+        certfile, keyfile = make_certificate(tempfile.mkdtemp(prefix="zavet-http-bench-"))
+        # requests (apihelper) veruje privremenom sertifikatu
+        env["REQUESTS_CA_BUNDLE"] = certfile
+    server, state = fake_telegram.start_server(0, latency=args.latency, certfile=certfile, keyfile=keyfile)
+    scheme = "https" if args.tls else "http"
+    url = f"{scheme}://127.0.0.1:{server.server_address[1]}"
+
+    print(f"Poruka po režimu: {args.messages}, niti: {args.concurrency}, server: {scheme}, "
+          f"kašnjenje servera: {args.latency * 1000:.0f} ms\n")
+    print(f"{'režim':<8}{'poruka/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'konekcija':>11}{'po poruci':>11}")
+    for mode in args.modes.split(","):
+        result = run_mode(args, mode, url, state, env)
+        latencies = result["latencies"]
+        row = [percentile(latencies, p) * 1000 for p in (50, 95, 99)]
+        print(f"{mode:<8}{len(latencies) / result['elapsed']:>10.0f}" + "".join(f"{value:>9.2f}" for value in row)
+              + f"{result['connections']:>11}{result['connections'] / max(1, len(latencies)):>11.3f}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Poređenje prepoznavanja odgovora sa i bez približnog poklapanja (V10.75).
+
+Za svaki primer iz korpusa (faza, tekst, očekivana sledeća faza ili null kada
+odgovor treba da ode AI-ju; skor je 0, pa poslednje pitanje vodi
+u END_FAILED_TEST) meri se koliko poruka je rešeno lokalno, koliko
+tačno, koliko lažno prepoznatih, i koliko poziva ka Gemini-ju se izbegne.
+
+Upotreba:
+    python tools/intent_benchmark.py
+    python tools/intent_benchmark.py --corpus tools/intent_corpus.json --threshold 0.8 --verbose
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("STATE_BACKEND", "memory")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools import fake_telegram  # noqa: E402
+
+fake_telegram.install()
+
+import flask_app  # noqa: E402
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "intent_corpus.json")
+
+
+def evaluate(machine, corpus, verbose=False, label=""):
+    resolved = correct = false_positive = missed = 0
+    started = time.perf_counter()
+    for sample in corpus:
+        transition = machine.resolve(sample["stage"], sample["text"], 0)
+        got = transition.next_stage if transition else None
+        expected = sample["expected"]
+        if got is not None:
+            resolved += 1
+        if got == expected:
+            correct += 1
+        elif got is not None:
+            false_positive += 1
+        else:
+            missed += 1
+        if verbose and got != expected:
+            print(f"  [{label}] {sample['stage']:<20} {sample['text']!r:<28} očekivano={expected} dobijeno={got}")
+    elapsed = time.perf_counter() - started
+    total = len(corpus)
+    # Poruka koju mašina stanja ne reši ide Gemini-ju
+    return {
+        "resolved": resolved,
+        "accuracy": correct / total,
+        "false_positives": false_positive,
+        "missed": missed,
+        "ai_fallback_rate": (total - resolved) / total,
+        "us_per_message": elapsed / total * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark prepoznavanja odgovora")
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS)
+    parser.add_argument("--threshold", type=float, default=flask_app.FUZZY_MATCH_THRESHOLD)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    with open(args.corpus, encoding="utf-8") as f:
+        corpus = json.load(f)
+
+    baseline = flask_app.StageMachine(flask_app.GAME_STAGES, flask_app.END_MESSAGES, fuzzy=False)
+    fuzzy = flask_app.StageMachine(flask_app.GAME_STAGES, flask_app.END_MESSAGES, fuzzy=True)
+    fuzzy.intent_matcher.threshold = args.threshold
+
+    results = {
+        "tačno poklapanje": evaluate(baseline, corpus, args.verbose, "tačno"),
+        f"približno (prag {args.threshold})": evaluate(fuzzy, corpus, args.verbose, "približno"),
+    }
+    should_resolve = sum(1 for sample in corpus if sample["expected"] is not None)
+    print(f"Korpus: {len(corpus)} poruka, {should_resolve} treba rešiti lokalno\n")
+    print(f"{'režim':<24}{'rešeno':>8}{'tačnost':>10}{'lažno':>8}{'AI udeo':>10}{'µs/poruka':>12}")
+    for name, r in results.items():
+        print(f"{name:<24}{r['resolved']:>8}{r['accuracy']:>10.1%}{r['false_positives']:>8}"
+              f"{r['ai_fallback_rate']:>10.1%}{r['us_per_message']:>12.1f}")
+
+    base, new = results.values()
+    print(f"\nSmanjenje poziva ka Gemini-ju: {base['ai_fallback_rate'] - new['ai_fallback_rate']:.1%} poruka")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+"""
+Benchmark celog toka igre bez mreže (V10.81).
+
+N istovremenih igrača prolazi igru od /start do FAZA_3_FINAL_PROMPT kroz pravi
+webhook() (Flask test klijent), uz nasumične poruke van teme koje idu AI-ju.
+Telegram i Gemini su lažni (tools/fake_telegram.py, tools/fake_gemini.py), a
+stanje je u SQLite-u, lokalnom Postgres-u ili u memoriji.
+
+Izveštaj: p50/p95/p99 trajanja webhook zahteva i obrade update-a, update-a u
+sekundi i broj SQL upita po update-u. Veštačke pauze 'kucanja' su isključene
+(PACING_ENABLED=0), kao i ograničenje slanja, osim uz --pacing.
+
+Uz --asgi (V10.90) isti tok ide kroz asgi_app: zahtevi iz niti igrača se predaju
+event petlji servera, Telegram je lažni HTTP server (AsyncTeleBot), a na kraju
+lifespan gašenje čeka obradu (i spojene poruke) i isporuku.
+
+Upotreba:
+    python tools/loadtest.py --players 50
+    python tools/loadtest.py --players 200 --mode queue --offtopic 0.5 --gemini-latency 0.4
+    python tools/loadtest.py --db postgresql://localhost/zavet_bench --players 100
+    python tools/loadtest.py --telegram-http --players 20
+    python tools/loadtest.py --asgi --players 100 --offtopic 0.6
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+OFFTOPIC_MESSAGES = [
+    "ko si ti?",
+    "šta je Zavet?",
+    "gde se nalaziš?",
+    "zašto baš ja?",
+    "kakva je to provera?",
+    "ko je GSA?",
+    "da li je ovo šala?",
+    "koliko imamo vremena?",
+]
+
+# Odgovori koji vode od START_PROVERA do FAZA_3_FINAL_PROMPT (sva pitanja testa tačno)
+GAME_SCRIPT = ["da", "spreman sam", "b", "b", "c", "b"]
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark toka igre (webhook -> handler)")
+    parser.add_argument("--players", type=int, default=50, help="broj istovremenih igrača")
+    parser.add_argument("--offtopic", type=float, default=0.3, help="verovatnoća poruke van teme pre svakog odgovora")
+    parser.add_argument("--unique-offtopic", action="store_true", help="jedinstvene poruke (bez pogodaka u AI kešu)")
+    parser.add_argument("--think-time", type=float, default=0.0, help="pauza igrača između poruka (s)")
+    parser.add_argument("--mode", choices=["sync", "queue"], default="sync", help="WEBHOOK_MODE")
+    parser.add_argument("--asgi", action="store_true", help="asgi_app umesto Flask webhook-a (Telegram preko HTTP-a)")
+    parser.add_argument("--db", default="sqlite", help="'sqlite', 'memory' ili SQLAlchemy URL (npr. postgresql://...)")
+    parser.add_argument("--gemini-latency", type=float, default=0.3)
+    parser.add_argument("--telegram-latency", type=float, default=0.02)
+    parser.add_argument("--telegram-http", action="store_true", help="lažni Telegram preko HTTP-a (TELEGRAM_API_URL)")
+    parser.add_argument("--pacing", action="store_true", help="zadrži pauze 'kucanja' i ograničenje slanja")
+    parser.add_argument("--seed", type=int, default=7)
+    return parser.parse_args()
+
+
+def configure_environment(args):
+    """Podešavanja moraju biti postavljena pre uvoza flask_app."""
+    from tools import fake_gemini, fake_telegram
+
+    os.environ["BOT_TOKEN"] = "123456:LOADTEST"
+    os.environ["WEBHOOK_MODE"] = args.mode
+    os.environ.setdefault("UPDATE_QUEUE_MAXSIZE", str(max(1000, args.players * 20)))
+    os.environ["SESSION_SWEEP"] = "0"
+    if not args.pacing:
+        os.environ["PACING_ENABLED"] = "0"
+        os.environ["TELEGRAM_GLOBAL_RATE"] = "1000000"
+        os.environ["TELEGRAM_CHAT_RATE"] = "1000000"
+
+    if args.db == "memory":
+        os.environ["STATE_BACKEND"] = "memory"
+    elif args.db == "sqlite":
+        path = os.path.join(tempfile.mkdtemp(prefix="zavet-loadtest-"), "state.db")
+        os.environ["STATE_BACKEND"] = "sqlite"
+        os.environ["DATABASE_URL"] = f"sqlite:///{path}"
+    else:
+        os.environ["DATABASE_URL"] = args.db
+
+    if args.asgi:
+        args.telegram_http = True  # AsyncTeleBot ide samo preko HTTP-a
+
+    gemini_server, gemini = fake_gemini.start_server(0, latency=args.gemini_latency, jitter=args.gemini_latency / 4)
+    os.environ["GEMINI_API_KEY"] = "loadtest"
+    os.environ["GEMINI_BASE_URL"] = f"http://127.0.0.1:{gemini_server.server_address[1]}"
+
+    if args.telegram_http:
+        telegram_server, telegram = fake_telegram.start_server(0, latency=args.telegram_latency)
+        os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{telegram_server.server_address[1]}"
+    else:
+        telegram = fake_telegram.install(latency=args.telegram_latency)
+    return gemini, telegram
+
+
+class AsgiClient:
+    """Zahtevi iz niti igrača idu u event petlju ASGI servera (sa lifespan porukama)."""
+
+    def __init__(self, asgi_module):
+        self.app = asgi_module.app
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name='asgi-loop', daemon=True).start()
+        self._lifespan_events = None
+        self._lifespan_replies = None
+        self._lifespan_task = None
+
+    def call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def _lifespan(self, event_type):
+        if self._lifespan_task is None:
+            self._lifespan_events, self._lifespan_replies = asyncio.Queue(), asyncio.Queue()
+            self._lifespan_task = asyncio.ensure_future(
+                self.app({'type': 'lifespan'}, self._lifespan_events.get, self._lifespan_replies.put)
+            )
+        await self._lifespan_events.put({'type': event_type})
+        await self._lifespan_replies.get()
+
+    def startup(self):
+        self.call(self._lifespan('lifespan.startup'))
+
+    def shutdown(self):
+        # Gašenje čeka zadatke obrade (i spojene poruke), isporuku i upis keša stanja
+        self.call(self._lifespan('lifespan.shutdown'))
+
+    async def _request(self, method, path, body, headers):
+        messages = []
+        received = False
+
+        async def receive():
+            nonlocal received
+            if not received:
+                received = True
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+            await asyncio.Event().wait()
+
+        async def send(message):
+            messages.append(message)
+
+        await self.app({'type': 'http', 'method': method, 'path': path, 'headers': headers,
+                        'query_string': b''}, receive, send)
+        return messages[0]['status']
+
+    def post(self, path, body):
+        return self.call(self._request('POST', path, body.encode('utf-8'), [(b'content-type', b'application/json')]))
+
+
+class LoadTest:
+    def __init__(self, app_module, args, asgi_module=None):
+        self.fa = app_module
+        self.args = args
+        self.asgi_module = asgi_module
+        self.asgi = AsgiClient(asgi_module) if asgi_module else None
+        self.lock = threading.Lock()
+        self.webhook_latencies = []
+        self.processing_latencies = []
+        self.statuses = {}
+        self.queries = 0
+        self.update_ids = iter(range(1, 10 ** 9))
+        self.finished_players = 0
+
+    def install_probes(self):
+        fa = self
+        if self.fa.Engine is not None:
+            from sqlalchemy import event
+
+            @event.listens_for(self.fa.Engine, "before_cursor_execute")
+            def count_query(conn, cursor, statement, parameters, context, executemany):
+                with fa.lock:
+                    fa.queries += 1
+
+        if self.asgi is not None:
+            # ASGI: obrada je zadatak u petlji (process_update_async)
+            original_async = self.asgi_module.process_update_async
+
+            async def timed_process_update_async(update):
+                started = time.perf_counter()
+                try:
+                    await original_async(update)
+                finally:
+                    with fa.lock:
+                        fa.processing_latencies.append(time.perf_counter() - started)
+
+            self.asgi_module.process_update_async = timed_process_update_async
+            return
+
+        # Trajanje obrade se meri oko process_update (u 'queue' režimu to je rad radnika reda)
+        original = self.fa.process_update
+
+        def timed_process_update(update):
+            started = time.perf_counter()
+            try:
+                original(update)
+            finally:
+                with fa.lock:
+                    fa.processing_latencies.append(time.perf_counter() - started)
+
+        self.fa.process_update = timed_process_update
+
+    def post(self, client, chat_id, text):
+        from tools.fake_telegram import make_update
+
+        with self.lock:
+            update_id = next(self.update_ids)
+        body = json.dumps(make_update(update_id, chat_id, text))
+        started = time.perf_counter()
+        if self.asgi is not None:
+            status = self.asgi.post("/" + self.fa.BOT_TOKEN, body)
+        else:
+            status = client.post("/" + self.fa.BOT_TOKEN, data=body, content_type="application/json").status_code
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.webhook_latencies.append(elapsed)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def play(self, chat_id, rng):
+        client = self.fa.app.test_client() if self.asgi is None else None
+        self.post(client, chat_id, "/start")
+        for answer in GAME_SCRIPT + ["da"]:
+            if rng.random() < self.args.offtopic:
+                text = rng.choice(OFFTOPIC_MESSAGES)
+                if self.args.unique_offtopic:
+                    text = f"{text} ({chat_id}-{rng.randint(0, 10 ** 6)})"
+                self.post(client, chat_id, text)
+                time.sleep(self.args.think_time)
+            self.post(client, chat_id, answer)
+            time.sleep(self.args.think_time)
+        with self.lock:
+            self.finished_players += 1
+
+    def warm_up(self):
+        # Gemini klijent i keš instrukcija se prave pre merenja (u produkciji to radi startup)
+        self.fa.get_ai_client()
+        self.fa.prompt_context.get_config()
+
+    def run(self):
+        self.install_probes()
+        self.warm_up()
+        if self.asgi is not None:
+            self.asgi.startup()
+        threads = []
+        started = time.perf_counter()
+        for i in range(self.args.players):
+            rng = random.Random(self.args.seed * 100003 + i)
+            thread = threading.Thread(target=self.play, args=(900000 + i, rng), daemon=True)
+            threads.append(thread)
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Do kraja: red update-a, odložene AI poruke i isporuka
+        if self.asgi is not None:
+            # Spojene poruke čekaju kraj prozora kontrole naleta pre nego što postanu zadaci
+            time.sleep(self.fa.AI_COALESCE_WINDOW)
+            self.asgi.shutdown()
+        else:
+            self.fa.update_dispatcher.drain(timeout=120)
+            self.fa.delivery.drain(timeout=120)
+            self.fa.player_cache.flush()
+        return time.perf_counter() - started
+
+
+def print_report(test, elapsed, gemini, telegram):
+    updates = len(test.webhook_latencies)
+    print(f"\nIgrača: {test.args.players} (završilo {test.finished_players}), update-a: {updates}, "
+          f"trajanje: {elapsed:.2f}s, režim: {'asgi' if test.asgi else test.args.mode}, "
+          f"baza: {test.fa.state_store.name}")
+    print(f"Propusnost: {updates / elapsed:.1f} update-a/s  HTTP statusi: {test.statuses}")
+    print(f"\n{'ms':<26}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for label, values in (("webhook zahtev", test.webhook_latencies), ("obrada update-a", test.processing_latencies)):
+        row = [percentile(values, p) * 1000 for p in (50, 95, 99, 100)]
+        print(f"{label:<26}" + "".join(f"{value:>9.1f}" for value in row))
+
+    per_update = test.queries / updates if updates else 0.0
+    print(f"\nSQL upita: {test.queries} ({per_update:.2f} po update-u)")
+    print(f"Gemini zahteva: {gemini.requests} (vrh istovremenih: {gemini.peak_in_flight})")
+    print(f"Telegram pozivi: {telegram.counts()} (odbijen Markdown: {telegram.parse_errors})")
+    print(f"Keš stanja: {test.fa.player_cache.stats()}")
+    print(f"Kontrola naleta: {test.fa.ai_flood_control.stats()}")
+
+
+def main():
+    args = parse_args()
+    gemini, telegram = configure_environment(args)
+
+    import logging
+    logging.disable(logging.WARNING)  # ispisuju se samo greške
+    import flask_app
+    asgi_module = None
+    if args.asgi:
+        import asgi_app as asgi_module
+
+    test = LoadTest(flask_app, args, asgi_module)
+    elapsed = test.run()
+    print_report(test, elapsed, gemini, telegram)
+    # Pozadinske niti i asinhroni Gemini klijent se ne gase uredno - izlazimo odmah
+    sys.stdout.flush()
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
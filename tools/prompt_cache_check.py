@@ -0,0 +1,145 @@
+"""
+Provera keša persona instrukcija (PromptContextCache) nad lažnim Gemini-jem (V10.89).
+
+Lažni server (tools/fake_gemini.py) implementira cachedContents kao pravi API:
+odbija kontekst manji od minimuma, vraća 404 za nepoznat keš i prijavljuje
+cachedContentTokenCount. Proverava se:
+
+    - podrazumevani režim je 'system', a 'cache' ispod minimuma prelazi u 'system'
+    - keš se pravi jednom, pozivi ga referenciraju i Gemini prijavljuje keširane tokene
+    - neuspešno kreiranje se ne ponavlja do GEMINI_CACHE_RETRY_SECONDS
+    - dok jedna nit pravi keš, ostale ne čekaju mrežni poziv
+    - osvežavanje briše stari keš
+    - greška koja nije 404/403 (prazan odgovor, 503) ne odbacuje keš
+    - keš obrisan na serveru (404) se odbacuje, uz pauzu pre novog
+
+Upotreba:
+    python tools/prompt_cache_check.py
+"""
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CONTENTS = [{'role': 'user', 'parts': [{'text': 'ko si ti?'}]}]
+
+
+def configure_environment():
+    """Podešavanja moraju biti postavljena pre uvoza flask_app."""
+    from tools import fake_gemini, fake_telegram
+
+    server, gemini = fake_gemini.start_server(0, latency=0.01, cache_min_tokens=1024)
+    os.environ.update({
+        "BOT_TOKEN": "123456:CACHECHECK",
+        "STATE_BACKEND": "memory",
+        "SESSION_SWEEP": "0",
+        "GEMINI_API_KEY": "cachecheck",
+        "GEMINI_BASE_URL": f"http://127.0.0.1:{server.server_address[1]}",
+        "GEMINI_BREAKER": "0",
+    })
+    os.environ.pop("GEMINI_PROMPT_MODE", None)
+    fake_telegram.install(latency=0.0)
+    return gemini
+
+
+class Checks:
+    def __init__(self):
+        self.failed = 0
+
+    def expect(self, condition, description):
+        print(f"{'OK    ' if condition else 'GREŠKA'} {description}")
+        self.failed += 0 if condition else 1
+
+
+def main():
+    gemini = configure_environment()
+    import logging
+    logging.disable(logging.CRITICAL)
+    import flask_app as game
+    from google.genai import errors
+    from tools import fake_gemini
+
+    checks = Checks()
+    instruction_tokens = len(game.PROMPT_INSTRUCTION) // 4
+
+    checks.expect(game.prompt_context.mode == 'system', "podrazumevani režim je 'system'")
+    small = game.PromptContextCache(mode='cache')
+    checks.expect(small.mode == 'system',
+                  f"'cache' sa instrukcijama od ~{instruction_tokens} tokena (minimum 1024) prelazi u 'system'")
+
+    # Ispod minimuma na serveru: jedno odbijanje, pa pauza do GEMINI_CACHE_RETRY_SECONDS
+    rejected = game.PromptContextCache(mode='cache', min_tokens=0)
+    configs = [rejected.get_config() for _ in range(3)]
+    checks.expect(all(not rejected.is_cached_config(c) for c in configs) and gemini.cache_rejects == 1,
+                  f"odbijen keš se ne pokušava ponovo odmah (pokušaja: {gemini.cache_rejects})")
+
+    gemini.cache_min_tokens = instruction_tokens - 10
+    context = game.PromptContextCache(mode='cache', min_tokens=0)
+    config = context.get_config()
+    checks.expect(context.is_cached_config(config) and gemini.cache_creates == 1, f"keš napravljen: {config.cached_content}")
+    context.get_config()
+    checks.expect(gemini.cache_creates == 1, "sledeći poziv koristi isti keš")
+
+    response = game.ai_gateway.generate(CONTENTS, deadline=5, config=config)
+    cached = response.usage_metadata.cached_content_token_count or 0
+    checks.expect(cached >= instruction_tokens - 10, f"Gemini prijavljuje keširane tokene ({cached})")
+    checks.expect(context.sent_instruction(config) == '', "keširane instrukcije ne ulaze u budžet poziva")
+
+    # Dok jedna nit pravi keš, druga dobija system_instruction bez čekanja
+    context._expires_at = 0
+    context._lock.acquire()
+    started = time.perf_counter()
+    waiting_config = context.get_config()
+    waited = time.perf_counter() - started
+    context._lock.release()
+    checks.expect(not context.is_cached_config(waiting_config) and waited < 0.05,
+                  f"bez čekanja na nit koja pravi keš ({waited * 1000:.1f} ms)")
+
+    old_name = config.cached_content
+    config = context.get_config()
+    checks.expect(config.cached_content != old_name and gemini.cache_deletes == 1 and old_name not in gemini.caches,
+                  f"osvežavanje briše stari keš ({old_name} -> {config.cached_content})")
+
+    for error in (ValueError("AI vratio prazan odgovor."), errors.ServerError(503, {"error": {"message": "x"}})):
+        dropped = context.invalidate(config, error)
+        checks.expect(not dropped and context.get_config().cached_content == config.cached_content,
+                      f"{type(error).__name__} ne odbacuje keš")
+
+    # Keš obrisan na serveru: poziv vraća 404, keš se odbacuje i ne pravi se odmah novi
+    gemini.drop_caches()
+    creates = gemini.cache_creates
+    try:
+        game.ai_gateway.generate(CONTENTS, deadline=5, config=config)
+        error = None
+    except Exception as e:
+        error = e
+    checks.expect(getattr(error, 'code', None) == 404, f"poziv sa obrisanim kešom vraća 404 ({type(error).__name__})")
+    checks.expect(context.invalidate(config, error), "404 odbacuje keš")
+    fallback = context.get_config()
+    checks.expect(not context.is_cached_config(fallback) and gemini.cache_creates == creates,
+                  f"posle 404 system_instruction još {game.GEMINI_CACHE_LOST_RETRY_SECONDS}s, bez novog keša")
+    context._retry_at = 0
+    checks.expect(context.is_cached_config(context.get_config()) and gemini.cache_creates == creates + 1,
+                  "posle pauze se pravi novi keš")
+
+    # Ceo tok kroz generate_ai_response: 404 -> rezervni odgovor i odbačen keš
+    game.prompt_context = context
+    gemini.drop_caches()
+    player = game.PlayerState(chat_id="990001", current_riddle="FAZA_2_TEST_1", score=0, solved_count=0,
+                              is_disqualified=False, general_conversation_count=0, conversation_history='[]',
+                              start_time=int(time.time()))
+    invalidations = context.invalidations
+    game.generate_ai_response("ko si ti?", player, "FAZA_2_TEST_1")
+    checks.expect(context.invalidations == invalidations + 1, "generate_ai_response odbacuje keš posle 404")
+    text, _, _ = game.generate_ai_response("ko si ti zapravo?", player, "FAZA_2_TEST_1")
+    checks.expect(text in fake_gemini.FAKE_REPLIES, "sledeći poziv radi sa system_instruction")
+
+    print(f"\nProvera: {'sve u redu' if not checks.failed else f'{checks.failed} neuspešnih'}")
+    sys.stdout.flush()
+    os._exit(1 if checks.failed else 0)
+
+
+if __name__ == "__main__":
+    main()